@@ -4,11 +4,16 @@ This module contains the mesh class. This class is the triangular surface where
 """
 import numpy as np
 from scipy.spatial import cKDTree
-import collections
+import collections.abc
+import hashlib
+import os
+import shutil
+import tempfile
+import zlib
 #from tvtk.api import tvtk
 #from tvtk.common import configure_input
 import scipy.sparse as sp
-from scipy.sparse.linalg import spsolve
+from scipy.sparse.linalg import splu, eigsh
 
 
 class Mesh:
@@ -22,60 +27,79 @@ class Mesh:
         verts (array): a numpy array that contains all the nodes of the mesh. verts[i,j], where i is the node index and j=[0,1,2] is the coordinate (x,y,z).
         connectivity (array): a numpy array that contains all the connectivity of the triangles of the mesh. connectivity[i,j], where i is the triangle index and j=[0,1,2] is node index.
         normals (array): a numpy array that contains all the normals of the triangles of the mesh. normals[i,j], where i is the triangle index and j=[0,1,2] is normal coordinate (x,y,z).
-        node_to_tri (dict): a dictionary that relates a node to the triangles that it is connected. It is the inverse relation of connectivity. The triangles are stored as a list for each node.
+        node_to_tri_indptr (array): a numpy int32 array with the CSR row pointers of the node to triangle relation, shape (nNodes+1,).
+        node_to_tri_indices (array): a numpy int32 array with the CSR column indices of the node to triangle relation. The triangles connected to node i are node_to_tri_indices[node_to_tri_indptr[i]:node_to_tri_indptr[i+1]], in ascending order. It is the inverse relation of connectivity.
+        node_to_tri (NodeToTri): a read-only mapping that relates a node to the triangles that it is connected, node_to_tri[i] is the array of triangles connected to node i. It is a view of the two CSR arrays above.
         tree (scipy.spatial.cKDTree): a k-d tree to compute the distance from any point to the closest node in the mesh.
+        vertex_normals (array): the normals of the nodes, average of the normals of their triangles, computed on first access.
         
     """
-    def __init__(self,filename  = None, verts = None, connectivity = None):
+    def __init__(self,filename  = None, verts = None, connectivity = None, sidecar = False):
         if filename is not None:
-            verts, connectivity = self.loadOBJ(filename)
+            verts, connectivity = self.loadOBJ(filename, sidecar = sidecar)
         self.verts=np.array(verts)
         self.connectivity=np.array(connectivity)
-        self.normals=np.zeros(self.connectivity.shape)
-        self.node_to_tri=collections.defaultdict(list)
-        for i in range(len(self.connectivity)):
-            for j in range(3):
-                self.node_to_tri[self.connectivity[i,j]].append(i)
-            u=self.verts[self.connectivity[i,1],:]-self.verts[self.connectivity[i,0],:]
-            v=self.verts[self.connectivity[i,2],:]-self.verts[self.connectivity[i,0],:]
-            n=np.cross(u,v)
-            self.normals[i,:]=n/np.linalg.norm(n)
-        self.tree=cKDTree(verts)
-        self.centroids = (self.verts[self.connectivity[:,0],:] + self.verts[self.connectivity[:,1],:] + self.verts[self.connectivity[:,2],:])/3.
+        u=self.verts[self.connectivity[:,1],:]-self.verts[self.connectivity[:,0],:]
+        v=self.verts[self.connectivity[:,2],:]-self.verts[self.connectivity[:,0],:]
+        n=np.cross(u,v)
+        self.normals=n/np.linalg.norm(n, axis = 1)[:,None]
+        # inverse relation of connectivity in CSR format
+        nodes = self.connectivity.ravel()
+        order = np.argsort(nodes, kind = 'stable')
+        self.node_to_tri_indices = (order // 3).astype(np.int32)
+        counts = np.bincount(nodes, minlength = self.verts.shape[0])
+        self.node_to_tri_indptr = np.concatenate(([0], np.cumsum(counts))).astype(np.int32)
+        self.node_to_tri = NodeToTri(self.node_to_tri_indptr, self.node_to_tri_indices)
+        self.tree=cKDTree(self.verts)
+        self.centroids = self.verts[self.connectivity].mean(axis = 1)
+        self._vertex_normals = None
 
-        
-    def loadOBJ(self,filename):  
-        """This function reads a .obj mesh file
+    @property
+    def vertex_normals(self):
+        """The normals of the nodes, as the normalized average of the normals of their triangles, shape (nNodes, 3). They are computed on first access and cached.
+        """
+        if self._vertex_normals is None:
+            vertex_normals = np.zeros(self.verts.shape)
+            np.add.at(vertex_normals, self.connectivity.ravel(), np.repeat(self.normals, 3, axis = 0))
+            self._vertex_normals = vertex_normals/np.linalg.norm(vertex_normals, axis = 1)[:,None]
+        return self._vertex_normals
+
+    def loadOBJ(self,filename, sidecar = False):  
+        """This function reads a .obj mesh file. The whole file is tokenized at once instead of line by line. Faces can be given as v, v/vt, v//vn or v/vt/vn, only the vertex index is kept.
         
         Args:
             filename (str): the path and filename of the .obj file.
+            sidecar (bool): if True, the parsed mesh is stored in filename + '.npz' and later calls load it from there, as long as it is newer than the .obj file.
             
         Returns:
              verts (array): a numpy array that contains all the nodes of the mesh. verts[i,j], where i is the node index and j=[0,1,2] is the coordinate (x,y,z).
              connectivity (array): a numpy array that contains all the connectivity of the triangles of the mesh. connectivity[i,j], where i is the triangle index and j=[0,1,2] is node index.
         """
-        numVerts = 0  
-        verts = []  
-        norms = []   
-        connectivity=[]
-        for line in open(filename, "r"):  
-            vals = line.split()
-            if len(vals)>0:
-                if vals[0] == "v":  
-                    v = list(map(float, vals[1:4]))
-                    verts.append(v)  
-                if vals[0] == "vn":  
-                    n = list(map(float, vals[1:4]))
-                    norms.append(n)  
-                if vals[0] == "f": 
-                    con=[]
-                    for f in vals[1:]:  
-                        w = f.split("/")  
-  #                      print w
-                        # OBJ Files are 1-indexed so we must subtract 1 below  
-                        con.append(int(w[0])-1)
-                        numVerts += 1  
-                    connectivity.append(con)
+        sidecar_file = filename + '.npz'
+        if sidecar and os.path.exists(sidecar_file) and os.path.getmtime(sidecar_file) >= os.path.getmtime(filename):
+            data = np.load(sidecar_file)
+            return data['verts'], data['connectivity']
+        
+        with open(filename, 'rb') as f:
+            lines = [l.lstrip() for l in f.read().split(b'\n')] # indented lines are valid too
+        v_lines = [l for l in lines if l[:2] in (b'v ', b'v\t')]
+        f_lines = [l for l in lines if l[:2] in (b'f ', b'f\t')]
+        # parse all the vertex lines at once
+        values = np.fromstring(b' '.join(v_lines).translate(bytes.maketrans(b'v\t\r', b'   ')).decode(), sep = ' ')
+        if len(v_lines) == 0 or values.size % len(v_lines) != 0:
+            raise ValueError('Inconsistent number of vertex coordinates in %s' % filename)
+        verts = values.reshape(len(v_lines), -1)[:,:3] # drop optional w or vertex colors
+        # parse all the face lines at once, v/vt/vn becomes v vt vn
+        values = np.fromstring(b' '.join(f_lines).translate(bytes.maketrans(b'f/\t\r', b'    ')).decode(), dtype = np.int64, sep = ' ')
+        stride = len(f_lines[0].split()[1].replace(b'//', b'/').split(b'/')) if len(f_lines) > 0 else 1
+        if values.size != 3*stride*len(f_lines):
+            raise ValueError('Only triangular faces with the same v/vt/vn syntax are supported')
+        connectivity = values.reshape(-1, 3*stride)[:,::stride]
+        # OBJ Files are 1-indexed so we must subtract 1, negative indices are relative to the end
+        connectivity = np.where(connectivity > 0, connectivity - 1, connectivity + verts.shape[0])
+        
+        if sidecar:
+            np.savez(sidecar_file, verts = verts, connectivity = connectivity)
         return verts, connectivity
 
     def project_new_point(self, point, verts_to_search = 1):
@@ -99,6 +123,62 @@ class Mesh:
         return projected_point, intriangle
 
 
+    def project_points(self, points, verts_to_search = 1, tol = 1e-3):
+        """This function projects a batch of points to the surface defined by the mesh. It is the vectorized version of project_new_point: for each point, the triangles connected to its verts_to_search closest nodes are checked at once, nodes are tried from the closest to the furthest and, for each node, triangles from the closest to the furthest.
+
+        Args:
+            points (array): coordinates of the points to project, shape (nPoints, 3).
+            verts_to_search (int): the number of closest nodes whose triangles are checked.
+            tol (float): tolerance of the in-triangle test on the sum of the barycentric coordinates.
+        Returns:
+             projected_points (array): the coordinates of the projected points, shape (nPoints, 3). If a point could not be projected, the closest node is returned.
+             intriangle (array): the index of the triangle where each projected point lies, shape (nPoints,). If the point is outside surface, intriangle=-1.
+             barycentric (array): the barycentric coordinates of the projected points with respect to the nodes of their triangle, shape (nPoints, 3). They are -1 for points outside the surface.
+        """
+        points = np.atleast_2d(points)
+        nPoints = points.shape[0]
+        d, nodes = self.tree.query(points, verts_to_search)
+        nodes = nodes.reshape(nPoints, -1)
+        # gather the candidate triangles of every (point, node) pair from the CSR index
+        start = self.node_to_tri_indptr[nodes].ravel()
+        count = self.node_to_tri_indptr[nodes + 1].ravel() - start
+        point_id = np.repeat(np.repeat(np.arange(nPoints), nodes.shape[1]), count)
+        node_rank = np.repeat(np.tile(np.arange(nodes.shape[1]), nPoints), count)
+        node = np.repeat(nodes.ravel(), count)
+        offset = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        triangles = self.node_to_tri_indices[np.repeat(start, count) + offset]
+        # project to the vertex plane and then to the triangle plane (closest point projection)
+        p = points[point_id]
+        vn = self.vertex_normals[node]
+        pre_projected = p - vn*np.sum((p - self.verts[node])*vn, axis = 1)[:,None]
+        v0 = self.verts[self.connectivity[triangles,0]]
+        n = self.normals[triangles]
+        CPP = np.sum((pre_projected - v0)*n, axis = 1)
+        q = pre_projected - CPP[:,None]*n
+        # barycentric coordinates
+        u = self.verts[self.connectivity[triangles,1]] - v0
+        v = self.verts[self.connectivity[triangles,2]] - v0
+        w = q - v0
+        uu, uv, vv = np.sum(u*u, axis = 1), np.sum(u*v, axis = 1), np.sum(v*v, axis = 1)
+        wu, wv = np.sum(w*u, axis = 1), np.sum(w*v, axis = 1)
+        denom = uu*vv - uv**2
+        r = (vv*wu - uv*wv)/denom
+        t = (uu*wv - uv*wu)/denom
+        inside = (r >= 0) & (t >= 0) & (r + t <= 1. + tol)
+        # first valid candidate of each point
+        order = np.lexsort((np.abs(CPP), node_rank, ~inside, point_id))
+        first = order[np.unique(point_id[order], return_index = True)[1]]
+        first = first[inside[first]]
+        
+        projected_points = self.verts[nodes[:,0]].astype(float)
+        intriangle = -np.ones(nPoints, dtype = int)
+        barycentric = -np.ones((nPoints, 3))
+        ids = point_id[first]
+        projected_points[ids] = q[first]
+        intriangle[ids] = triangles[first]
+        barycentric[ids] = np.stack((1. - r[first] - t[first], r[first], t[first]), axis = 1)
+        return projected_points, intriangle, barycentric
+
     def project_point_check(self, point, node):
         """This function projects any point to the surface defined by the mesh.
         
@@ -159,23 +239,83 @@ class Mesh:
                     break
         return projected_point, intriangle, r, t
                 
-    # def writeVTU(self,filename, verts, connectivity, scalars = None, vectors = None):
-    #     tvtk.Triangle().cell_type
-    #     tri_type = tvtk.Triangle().cell_type
-    #     ug = tvtk.UnstructuredGrid(points=verts)
-    #     ug.set_cells(tri_type, connectivity)
-        
-    #     if scalars is not None:
-    #         ug.point_data.scalars = scalars
-    #         ug.point_data.scalars.name = 'phi'
-            
-    #     if vectors is not None:
-    #         ug.cell_data.vectors = vectors
-    #         ug.cell_data.vectors.name = 'X'
-    
-    #     w = tvtk.XMLUnstructuredGridWriter(file_name=filename)
-    #     configure_input(w,ug)
-    #     w.write()
+    def writeVTU(self, filename, verts = None, connectivity = None, scalars = None, vectors = None, point_data = None, cell_data = None, compress = False):
+        """This function writes the mesh and nodal or element fields to a VTK XML unstructured grid (.vtu) file. The arrays are stored as appended raw binary data, written directly from the numpy buffers, and optionally compressed with zlib.
+        
+        Args:
+            filename (str): the path and filename of the .vtu file.
+            verts (array): the coordinates of the nodes. If None, the nodes of the mesh are used.
+            connectivity (array): the connectivity of the triangles. If None, the connectivity of the mesh is used.
+            scalars (array): a nodal field, stored with the name 'phi'.
+            vectors (array): an element field, stored with the name 'X'.
+            point_data (dict): more nodal fields, name: array with shape (nNodes,) or (nNodes, nComponents).
+            cell_data (dict): more element fields, name: array with shape (nElem,) or (nElem, nComponents).
+            compress (bool): if True, the arrays are compressed with zlib.
+        """
+        verts = self.verts if verts is None else verts
+        connectivity = self.connectivity if connectivity is None else connectivity
+        point_data = dict(point_data) if point_data is not None else {}
+        cell_data = dict(cell_data) if cell_data is not None else {}
+        if scalars is not None:
+            point_data['phi'] = scalars
+        if vectors is not None:
+            cell_data['X'] = vectors
+        nNodes, nElem = verts.shape[0], connectivity.shape[0]
+        
+        def little_endian(a):
+            a = np.ascontiguousarray(a)
+            if a.dtype == bool:
+                a = a.astype(np.uint8)
+            return a.astype(a.dtype.newbyteorder('<'), copy = False)
+        
+        pieces = {'PointData': [], 'CellData': [], 'Points': [], 'Cells': []}
+        for name, a in point_data.items():
+            pieces['PointData'].append((name, little_endian(a)))
+        for name, a in cell_data.items():
+            pieces['CellData'].append((name, little_endian(a)))
+        pieces['Points'].append((None, little_endian(verts)))
+        pieces['Cells'].append(('connectivity', little_endian(connectivity.astype(np.int64).ravel()))) # flat, one component, as VTK readers require
+        pieces['Cells'].append(('offsets', np.arange(3, 3*nElem + 1, 3, dtype = np.int64)))
+        pieces['Cells'].append(('types', np.full(nElem, 5, dtype = np.uint8))) # VTK_TRIANGLE
+        
+        # binary blocks of every array, compressed ones are kept in memory to know their size
+        blocks = []
+        offset = 0
+        xml = {}
+        for section, arrays in pieces.items():
+            xml[section] = []
+            for name, a in arrays:
+                nbytes = a.nbytes
+                if compress:
+                    blocksize = 1 << 20
+                    chunks = [zlib.compress(memoryview(a).cast('B')[i:i + blocksize]) for i in range(0, max(nbytes, 1), blocksize)]
+                    header = np.array([len(chunks), blocksize, nbytes - blocksize*(len(chunks) - 1)] + [len(c) for c in chunks], dtype = '<u8')
+                    block = [header] + chunks
+                    size = header.nbytes + sum(len(c) for c in chunks)
+                else:
+                    header = np.array([nbytes], dtype = '<u8')
+                    block = [header, a]
+                    size = header.nbytes + nbytes
+                components = a.shape[1] if a.ndim > 1 else 1
+                vtk_type = {'f': 'Float', 'i': 'Int', 'u': 'UInt'}[a.dtype.kind] + str(8*a.dtype.itemsize)
+                name = '' if name is None else ' Name="%s"' % name
+                xml[section].append('<DataArray type="%s"%s NumberOfComponents="%i" format="appended" offset="%i"/>' % (vtk_type, name, components, offset))
+                blocks.append(block)
+                offset += size
+        
+        compressor = ' compressor="vtkZLibDataCompressor"' if compress else ''
+        with open(filename, 'wb') as f:
+            f.write(('<?xml version="1.0"?>\n'
+                     '<VTKFile type="UnstructuredGrid" version="1.0" byte_order="LittleEndian" header_type="UInt64"%s>\n'
+                     '<UnstructuredGrid>\n'
+                     '<Piece NumberOfPoints="%i" NumberOfCells="%i">\n' % (compressor, nNodes, nElem)).encode())
+            for section in pieces:
+                f.write(('<%s>\n%s\n</%s>\n' % (section, '\n'.join(xml[section]), section)).encode())
+            f.write(b'</Piece>\n</UnstructuredGrid>\n<AppendedData encoding="raw">\n_')
+            for block in blocks:
+                for data in block:
+                    f.write(memoryview(data))
+            f.write(b'\n</AppendedData>\n</VTKFile>\n')
                 
     def Bmatrix(self,element):
         nodeCoords = self.verts[self.connectivity[element]]
@@ -197,6 +337,50 @@ class Mesh:
         
         return B, J        
         
+    def localFrames(self):
+        """This function computes the in-plane orthonormal basis of all the elements. e1 points from the first to the second node of each triangle.
+        
+        Returns:
+             e1 (array): a numpy array with the first basis vector of all the elements, shape (nElem, 3).
+             e2 (array): a numpy array with the second basis vector of all the elements, shape (nElem, 3).
+        """
+        nodeCoords = self.verts[self.connectivity]
+        d21 = nodeCoords[:,1,:] - nodeCoords[:,0,:]
+        d31 = nodeCoords[:,2,:] - nodeCoords[:,0,:]
+        e1 = d21/np.linalg.norm(d21, axis = 1)[:,None]
+        e2 = d31 - np.sum(d31*e1, axis = 1)[:,None]*e1
+        e2 = e2/np.linalg.norm(e2, axis = 1)[:,None] # normalize
+        return e1, e2
+        
+    def Bmatrices(self):
+        """This function computes the B matrices and jacobians of all the elements at once. It is the vectorized version of Bmatrix.
+        
+        Returns:
+             B (array): a numpy array with the B matrices of all the elements. B[i,:,:] is the 2x3 matrix of triangle i.
+             J (array): a numpy array with the jacobian of all the elements. J[i] is the jacobian of triangle i.
+        """
+        nodeCoords = self.verts[self.connectivity]
+        e1, e2 = self.localFrames()
+        # local coordinates of the nodes, with the first node at the origin
+        local = nodeCoords - nodeCoords[:,:1,:]
+        x = np.einsum('ijk,ik->ij', local, e1)
+        y = np.einsum('ijk,ik->ij', local, e2)
+        
+        x21 = x[:,1] - x[:,0]
+        x13 = x[:,0] - x[:,2]
+        x32 = x[:,2] - x[:,1]
+        
+        y23 = y[:,1] - y[:,2]
+        y31 = y[:,2] - y[:,0]
+        y12 = y[:,0] - y[:,1]
+        
+        J = x13*y23 - y31*x32
+        
+        B = np.stack((np.stack((y23, y31, y12), axis = 1),
+                      np.stack((x32, x13, x21), axis = 1)), axis = 1)
+        
+        return B, J
+        
     def gradient(self, element, u):
         nodeCoords = self.verts[self.connectivity[element]]
         e1 = (nodeCoords[1,:] - nodeCoords[0,:])/np.linalg.norm(nodeCoords[1,:] - nodeCoords[0,:])
@@ -225,6 +409,24 @@ class Mesh:
         
         return np.dot(R,grad)      
         
+    def gradients(self, u):
+        """This function computes the gradient of a nodal field in all the elements at once. It is the vectorized version of gradient.
+        
+        Args:
+            u (array): the nodal field, shape (nNodes,) or (nNodes, nFields) for several fields at once.
+            
+        Returns:
+             grad (array): the gradients in global coordinates, shape (nElem, 3) or (nElem, 3, nFields).
+        """
+        B, J = self.Bmatrices()
+        e1, e2 = self.localFrames()
+        # gradients in the local frame of each element
+        g = np.einsum('lij,lj...->li...', B, np.asarray(u)[self.connectivity])
+        g /= J.reshape((-1, 1) + (1,)*(g.ndim - 2))
+        e1 = e1.reshape(e1.shape + (1,)*(g.ndim - 2))
+        e2 = e2.reshape(e2.shape + (1,)*(g.ndim - 2))
+        return e1*g[:,None,0] + e2*g[:,None,1]
+        
     def StiffnessMatrix(self,B,J):    
         return np.dot(B.T,B)/(2.*J)
     def MassMatrix(self,J):
@@ -237,134 +439,467 @@ class Mesh:
         
         
     def computeGeodesic(self, nodes, nodeVals, filename = None, K = None, M = None, dt = 10.0):
-        nNodes = self.verts.shape[0]
-        nElem = self.connectivity.shape[0]
+        """This function computes the geodesic distance from a set of nodes with the heat method. The factorizations are computed once per time step and reused by the next calls, see GeodesicSolver.
         
-#        K = sp.lil_matrix((nNodes, nNodes))
-#        M = sp.lil_matrix((nNodes, nNodes))
+        Args:
+            nodes (array): the indices of the source nodes.
+            nodeVals (array): the value of the distance at the source nodes.
+            filename (str): if given, the result is written to this .vtu file.
+            K (array): the stiffness matrix. If None, it is assembled.
+            M (array): the mass matrix. If None, it is assembled.
+            dt (float): the time step of the heat equation.
+            
+        Returns:
+             ATglobal (array): the geodesic distance at every node, shape (nNodes,).
+             Xs (array): the normalized gradient of the heat solution in every element, shape (nElem, 3).
+        """
+        if (K is not None) and (M is not None):
+            solver = GeodesicSolver(self, dt = dt, K = K, M = M)
+        else:
+            solver = self.geodesicSolver(dt)
+        ATglobal, Xs = solver.solve(nodes, nodeVals)
 
-        F = np.zeros((nNodes,1))
-        
-        u0 = np.zeros((nNodes,1))
-        
-        u0[nodes] = 1e6
-        
-        #dt = 10.0
-        
-        if (K is None) or (M is None):
-            K = np.zeros((nNodes,nNodes))
-            M = np.zeros((nNodes,nNodes))
-            for el, tri in enumerate(self.connectivity):
-                j, i = np.meshgrid(tri,tri)
-                B, J = self.Bmatrix(el) 
-                k = self.StiffnessMatrix(B,J)
-                m = self.MassMatrix(J)
-                K[i, j] += k
-                M[i,j] += m
+        if filename is not None:
+            self.writeVTU(filename, self.verts, self.connectivity, ATglobal, Xs)
             
+        return ATglobal, Xs
+    
+    def geodesicSolver(self, dt = 10.0):
+        """This function returns the GeodesicSolver of the mesh for a time step. Solvers are cached, so the matrices are assembled and factorized only once.
+        
+        Args:
+            dt (float): the time step of the heat equation.
             
+        Returns:
+             solver (GeodesicSolver): the solver.
+        """
+        if not hasattr(self, '_geodesic_solvers'):
+            self._geodesic_solvers = {}
+        if dt not in self._geodesic_solvers:
+            self._geodesic_solvers[dt] = GeodesicSolver(self, dt = dt)
+        return self._geodesic_solvers[dt]
+    
+    def computeLaplace(self, nodes, nodeVals, filename = None):
+        """This function solves the Laplace equation with Dirichlet conditions on a set of nodes. The factorization of the stiffness matrix is computed once and reused by the next calls, even with different nodes, see PoissonSolver.
         
-        activeNodes = list(range(nNodes))
-        for known in nodes:
-            activeNodes.remove(known)
+        Args:
+            nodes (array): the indices of the nodes with Dirichlet conditions.
+            nodeVals (array): the values of the solution at the nodes.
+            filename (str): if given, the result is written to this .vtu file.
+            
+        Returns:
+             Tglobal (array): the solution at every node, shape (nNodes,).
+        """
+        nNodes = self.verts.shape[0]
+        Tglobal = self.poissonSolver().solve(np.zeros(nNodes), nodes, nodeVals)
+
+        if filename is not None:
+            self.writeVTU(filename, self.verts, self.connectivity, Tglobal, None)
             
-        jActive, iActive = np.meshgrid(activeNodes, activeNodes)
+        return Tglobal
+    
+    def poissonSolver(self):
+        """This function returns the PoissonSolver of the mesh. The solver is cached, so the stiffness matrix is assembled and factorized only once.
         
-        jKnown, iKnown = np.meshgrid(nodes, activeNodes)
+        Returns:
+             solver (PoissonSolver): the solver.
+        """
+        if not hasattr(self, '_poisson_solver'):
+            self._poisson_solver = PoissonSolver(self)
+        return self._poisson_solver
         
-        A1 = sp.csr.csr_matrix(M + dt*K)
-        u = spsolve(A1, u0)[:,None]
-      #  u = np.linalg.solve(M + dt*K,u0)
+    def computeLaplacian(self, dense = False):
+        """This function assembles the stiffness and mass matrices of the mesh. All the element matrices are computed in one vectorized pass and assembled in sparse format.
         
-        Xs = np.zeros((nElem,3))
-        Js = np.zeros((nElem,1))
+        Args:
+            dense (bool): if True, the matrices are returned as dense numpy arrays. Only recommended for small meshes.
+            
+        Returns:
+             K (scipy.sparse.csr_matrix): the stiffness matrix, shape (nNodes, nNodes).
+             M (scipy.sparse.csr_matrix): the mass matrix, shape (nNodes, nNodes).
+        """
+        nNodes = self.verts.shape[0]
         
+        B, J = self.Bmatrices()
+        k = np.einsum('lij,lik->ljk', B, B)/(2.*J[:,None,None])
+        m = self.MassMatrix(1.0)[None,:,:]*J[:,None,None]
         
-        for k,tri in enumerate(self.connectivity):
-            j, i = np.meshgrid(tri,tri)
-            B, J = self.Bmatrix(k) 
-            Js[k] = J
-            X = self.gradient(k,u[tri,0])
-            Xs[k,:] = X/np.linalg.norm(X)
-            Xnr = np.dot(B,u[tri,0]) # not rotated
-            Xnr /= np.linalg.norm(Xnr)
-            f = self.ForceVector(B,J,Xnr)
-            F[tri,0] -= f
-        A2 = sp.csr.csr_matrix(K[iActive, jActive])
-        AT = spsolve(A2, F[activeNodes,0]-np.dot(K[iKnown, jKnown],nodeVals))
-      #  AT = np.linalg.solve(K[iActive, jActive],F[activeNodes,0]-np.dot(K[iKnown, jKnown],nodeVals))    
+        i = np.repeat(self.connectivity, 3, axis = 1).ravel()
+        j = np.tile(self.connectivity, (1, 3)).ravel()
         
-        ATglobal = np.zeros(nNodes)
+        K = sp.coo_matrix((k.ravel(), (i, j)), shape = (nNodes, nNodes)).tocsr()
+        M = sp.coo_matrix((m.ravel(), (i, j)), shape = (nNodes, nNodes)).tocsr()
         
-        ATglobal[activeNodes] = AT
-        ATglobal[nodes] = nodeVals
+        if dense:
+            return K.toarray(), M.toarray()
 
-        if filename is not None:
-            self.writeVTU(filename, self.verts, self.connectivity, ATglobal, Xs)
+        return K,M
+
+    def eigenpairs(self, k, sigma = -1e-6, tol = 0., cache = None):
+        """This function computes the k smallest eigenpairs of the generalized eigenvalue problem K phi = lambda M phi, where K and M are the sparse stiffness and mass matrices of the mesh. Shift-invert Lanczos is used, so only the requested pairs are computed.
+        
+        Args:
+            k (int): the number of eigenpairs to compute.
+            sigma (float): the shift used for the shift-invert mode. It has to be slightly negative since K is singular.
+            tol (float): relative accuracy of the eigenvalues. 0 means machine precision.
+            cache (EigenpairsCache): if given, the eigenpairs are loaded from this on-disk cache when available, and stored in it otherwise.
             
-        return ATglobal, Xs
+        Returns:
+             eigenvalues (array): a numpy array with the k smallest eigenvalues in ascending order, shape (k,).
+             eigenvectors (array): a numpy array with the M-orthonormal eigenvectors, shape (k, nNodes). eigenvectors[i,:] corresponds to eigenvalues[i]. This is the layout expected by the Riemannian classifiers.
+        """
+        if cache is not None:
+            key = cache.key(self, k, sigma, tol)
+            pairs = cache.load(key)
+            if pairs is not None:
+                return pairs
+        K, M = self.computeLaplacian()
+        eigenvalues, eigenvectors = eigsh(K, k = k, M = M, sigma = sigma, which = 'LM', tol = tol)
+        order = np.argsort(eigenvalues)
+        eigenvalues, eigenvectors = eigenvalues[order], eigenvectors[:,order].T
+        if cache is not None:
+            cache.save(key, eigenvalues, eigenvectors)
+        return eigenvalues, eigenvectors
+
+
+class NodeToTri(collections.abc.Mapping):
+    """Read-only mapping from a node index to the triangles connected to it, backed by the CSR arrays of the node to triangle relation. mesh.node_to_tri[i] is the array of triangles connected to node i, in ascending order.
+
+    Args:
+        indptr (array): the CSR row pointers, shape (nNodes+1,).
+        indices (array): the CSR column indices (triangle indices).
+    """
+    def __init__(self, indptr, indices):
+        self.indptr = indptr
+        self.indices = indices
+
+    def __getitem__(self, node):
+        if not 0 <= node < len(self):
+            raise KeyError(node)
+        return self.indices[self.indptr[node]:self.indptr[node+1]]
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+
+class PoissonSolver:
+    """Class that solves Poisson problems K u = F on a mesh with Dirichlet conditions on a set of nodes. The stiffness matrix is assembled and factorized once, so problems with different nodes, values or right hand sides only cost triangular solves.
     
-    def computeLaplace(self, nodes, nodeVals, filename = None):
-        nNodes = self.verts.shape[0]
-        nElem = self.connectivity.shape[0]
+    The Dirichlet conditions are imposed with Lagrange multipliers on a factorization of K + eps*M, where eps is a tiny regularization that removes the constant null space of K, so the factorization does not depend on the nodes. Since (K + eps*M) 1 = eps*M 1, the constant mode of every solve, which is 1/eps times larger than the rest, is split off and handled in closed form, so no precision is lost to cancellation. One step of iterative refinement removes the error introduced by the regularization. The Lagrange multiplier system of the last set of nodes is kept, so solving again with the same nodes is cheaper.
+    
+    Args:
+        mesh (Mesh): the mesh.
+        K (array): the stiffness matrix. If None, it is assembled.
+        M (array): the mass matrix. If None, it is assembled.
+        eps (float): relative regularization of K.
         
-        K = np.zeros((nNodes,nNodes))
-        F = np.zeros((nNodes,1))
+    Attributes:
+        mesh (Mesh): the mesh.
+        factor (scipy.sparse.linalg.SuperLU): the factorization of K plus the regularization.
+        regularization (scipy.sparse.csc_matrix): the regularization added to K, eps*M scaled by the ratio of the traces of K and M.
+    """
+    def __init__(self, mesh, K = None, M = None, eps = 1e-10):
+        self.mesh = mesh
+        if (K is None) or (M is None):
+            K, M = mesh.computeLaplacian()
+        K, M = sp.csc_matrix(K), sp.csc_matrix(M)
+        self.regularization = eps*K.diagonal().sum()/M.diagonal().sum()*M
+        self.factor = splu(K + self.regularization)
+        # mass of the constant mode, without and with the regularization
+        self._m1 = np.asarray(M.sum(axis = 1)).ravel()
+        self._mass = self._m1.sum()
+        self._shift = self.regularization.sum()
+        self._nodes = None
+        
+    def projectedSolve(self, b):
+        """This function solves (K + eps*M) z = b for the part of b that is M-orthogonal to the constants, so z has no constant mode.
         
+        Args:
+            b (array): the right hand side, shape (nNodes,) or (nNodes, nRHS).
             
+        Returns:
+             z (array): the solution, with the same shape as b.
+        """
+        b = np.asarray(b, dtype = float)
+        z = self.factor.solve(b - np.multiply.outer(self._m1, b.sum(axis = 0))/self._mass)
+        return z - (self._m1 @ z)/self._mass
+        
+    def solve(self, F, nodes, nodeVals):
+        """This function solves K u = F with u = nodeVals at nodes.
         
-        activeNodes = list(range(nNodes))
-        for known in nodes:
-            activeNodes.remove(known)
+        Args:
+            F (array): the right hand side, shape (nNodes,) or (nNodes, nRHS).
+            nodes (array): the indices of the nodes with Dirichlet conditions.
+            nodeVals (array): the values of the solution at the nodes, shape (nDirichlet,) or (nDirichlet, nRHS).
             
-        jActive, iActive = np.meshgrid(activeNodes, activeNodes)
+        Returns:
+             u (array): the solution at every node, with the same shape as F.
+        """
+        nodes = np.atleast_1d(nodes)
+        nodeVals = np.asarray(nodeVals, dtype = float)
+        if nodeVals.ndim < np.ndim(F):
+            nodeVals = nodeVals.reshape(-1, 1)
+        nodeVals = np.broadcast_to(nodeVals, nodes.shape + np.shape(F)[1:])
+        if self._nodes is None or not np.array_equal(nodes, self._nodes):
+            # Lagrange multipliers for the Dirichlet conditions
+            E = np.zeros((self.mesh.verts.shape[0], nodes.shape[0]))
+            E[nodes, np.arange(nodes.shape[0])] = 1.
+            self._zE = self.projectedSolve(E)
+            self._C = np.linalg.inv(self._zE[nodes])
+            self._h = self._C.sum(axis = 1)
+            self._nodes = nodes.copy()
+        zE, C, h = self._zE, self._C, self._h
+        def dirichlet(F, nodeVals):
+            # the constant modes of the solves of F and of the multipliers
+            # cancel each other, their net amplitude is delta
+            zF = self.projectedSolve(F)
+            v = C @ (nodeVals - zF[nodes])
+            delta = (np.sum(F, axis = 0) + v.sum(axis = 0))/(self._shift + h.sum())
+            return zF + zE @ (v - np.multiply.outer(h, delta)) + delta
+        u = dirichlet(F, nodeVals)
+        # iterative refinement, the correction is zero at the nodes
+        u += dirichlet(self.regularization @ u, 0.)
+        u[nodes] = nodeVals
+        return u
+        
+    def solveColumns(self, F, nodes, nodeVals = 0.):
+        """This function solves K u = F for several right hand sides, each one with a single Dirichlet node of its own.
         
-        jKnown, iKnown = np.meshgrid(nodes, activeNodes)
+        Args:
+            F (array): the right hand sides, shape (nNodes, nRHS).
+            nodes (array): the Dirichlet node of every column, shape (nRHS,).
+            nodeVals (array): the value of the solution at the node of every column.
+            
+        Returns:
+             u (array): the solutions at every node, shape (nNodes, nRHS).
+        """
+        nodes = np.atleast_1d(nodes)
+        cols = np.arange(nodes.shape[0])
+        E = np.zeros((self.mesh.verts.shape[0], nodes.shape[0]))
+        E[nodes, cols] = 1.
+        zE = self.projectedSolve(E)
+        a = zE[nodes, cols]
+        def dirichlet(F, nodeVals):
+            # see solve, with one multiplier per column
+            zF = self.projectedSolve(F)
+            v = (nodeVals - zF[nodes, cols])/a
+            delta = (F.sum(axis = 0) + v)/(self._shift + 1./a)
+            return zF + zE*(v - delta/a) + delta
+        u = dirichlet(F, nodeVals)
+        u += dirichlet(self.regularization @ u, 0.)
+        u[nodes, cols] = nodeVals
+        return u
+
+
+class GeodesicSolver:
+    """Class that computes geodesic distances on a mesh with the heat method. The sparse matrices M + dt*K and K are assembled and factorized once, so every new set of sources only costs triangular solves. Several sets of sources can be solved together as a multiple right hand side problem.
+    
+    The Poisson problem with Dirichlet conditions at the sources is solved with a PoissonSolver, so its factorization does not depend on the sources either.
+    
+    Args:
+        mesh (Mesh): the mesh.
+        dt (float): the time step of the heat equation.
+        K (array): the stiffness matrix. If None, it is assembled.
+        M (array): the mass matrix. If None, it is assembled.
         
+    Attributes:
+        mesh (Mesh): the mesh.
+        dt (float): the time step of the heat equation.
+        B (array): the B matrices of all the elements, shape (nElem, 2, 3).
+        e1, e2 (array): the local frames of all the elements, shape (nElem, 3).
+        heat (scipy.sparse.linalg.SuperLU): the factorization of M + dt*K.
+        poisson (PoissonSolver): the solver of the Poisson problem.
+    """
+    def __init__(self, mesh, dt = 10.0, K = None, M = None):
+        self.mesh = mesh
+        self.dt = dt
+        if (K is None) or (M is None):
+            K, M = mesh.computeLaplacian()
+            self.poisson = mesh.poissonSolver()
+        else:
+            K, M = sp.csc_matrix(K), sp.csc_matrix(M)
+            self.poisson = PoissonSolver(mesh, K = K, M = M)
+        self.B, J = mesh.Bmatrices()
+        self.e1, self.e2 = mesh.localFrames()
+        self.heat = splu(sp.csc_matrix(M + dt*K))
         
+    def heatGradient(self, u):
+        """This function computes the normalized gradient of the heat solutions and the divergence vector.
         
-        Js = np.zeros((nElem,1))
+        Args:
+            u (array): the heat solutions, shape (nNodes, nSets).
+            
+        Returns:
+             Xs (array): the normalized gradients in every element, shape (nElem, 3, nSets).
+             F (array): the right hand side of the Poisson problem, shape (nNodes, nSets).
+        """
+        connectivity = self.mesh.connectivity
+        nNodes = self.mesh.verts.shape[0]
+        Xnr = np.einsum('lij,ljs->lis', self.B, u[connectivity]) # not rotated
+        Xnr /= np.linalg.norm(Xnr, axis = 1)[:,None,:]
+        Xs = self.e1[:,:,None]*Xnr[:,None,0,:] + self.e2[:,:,None]*Xnr[:,None,1,:]
+        f = np.einsum('lji,ljs->lis', self.B, Xnr)/2.
+        F = np.zeros((nNodes, u.shape[1]))
+        np.add.at(F, connectivity.ravel(), -f.reshape(-1, u.shape[1]))
+        return Xs, F
+        
+    def solve(self, nodes, nodeVals):
+        """This function computes the geodesic distance from one set of sources.
         
+        Args:
+            nodes (array): the indices of the source nodes.
+            nodeVals (array): the value of the distance at the source nodes.
+            
+        Returns:
+             ATglobal (array): the geodesic distance at every node, shape (nNodes,).
+             Xs (array): the normalized gradient of the heat solution in every element, shape (nElem, 3).
+        """
+        nodes = np.atleast_1d(nodes)
+        nodeVals = np.broadcast_to(np.asarray(nodeVals, dtype = float), nodes.shape)
+        nNodes = self.mesh.verts.shape[0]
+        u0 = np.zeros((nNodes,1))
+        u0[nodes] = 1e6
+        u = self.heat.solve(u0)
+        Xs, F = self.heatGradient(u)
+        ATglobal = self.poisson.solve(F[:,0], nodes, nodeVals)
+        return ATglobal, Xs[:,:,0]
+    
+    def distances(self, sources):
+        """This function computes the geodesic distance from every node in sources, each one taken as a single source. All the sources are solved together.
         
-        for k,tri in enumerate(self.connectivity):
-            j, i = np.meshgrid(tri,tri)
-            B, J = self.Bmatrix(k) 
-            Js[k] = J
-            k = self.StiffnessMatrix(B,J)
-            K[i, j] += k
+        Args:
+            sources (array): the indices of the source nodes, shape (nSources,).
             
-        T = np.linalg.solve(K[iActive, jActive],F[activeNodes,0]-np.dot(K[iKnown, jKnown],nodeVals))    
+        Returns:
+             distances (array): distances[i,j] is the geodesic distance from sources[i] to node j, shape (nSources, nNodes).
+        """
+        sources = np.atleast_1d(sources)
+        nSources = sources.shape[0]
+        nNodes = self.mesh.verts.shape[0]
+        u0 = np.zeros((nNodes, nSources))
+        u0[sources, np.arange(nSources)] = 1e6
+        u = self.heat.solve(u0)
+        Xs, F = self.heatGradient(u)
+        # each column has its own Dirichlet condition
+        return self.poisson.solveColumns(F, sources).T
+
+
+class EigenpairsCache:
+    """Class that stores the eigenpairs of meshes on disk, so they are computed only once per geometry. Each entry is a folder named after a hash of the mesh and of the eigensolver parameters, with the eigenvalues and eigenvectors saved as .npy files that are loaded memory-mapped. When the total size exceeds max_size, the least recently used entries are removed.
+    
+    Args:
+        path (str): the folder where the eigenpairs are stored. It is created if it does not exist.
+        max_size (int): maximum size of the cache in bytes. If None, the cache is not bounded.
         
-        Tglobal = np.zeros(nNodes)
+    Attributes:
+        path (str): the folder where the eigenpairs are stored.
+        max_size (int): maximum size of the cache in bytes.
+    """
+    def __init__(self, path, max_size = None):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok = True)
         
-        Tglobal[activeNodes] = T
-        Tglobal[nodes] = nodeVals
-
-        if filename is not None:
-            self.writeVTU(filename, self.verts, self.connectivity, Tglobal, None)
-            
-        return Tglobal
-    def computeLaplacian(self):
-        nNodes = self.verts.shape[0]
+    def key(self, mesh, k, sigma, tol):
+        """This function computes the key of an entry. The vertices already include any scaling applied to the geometry, so scaled copies of a mesh get different keys.
         
-        K = np.zeros((nNodes,nNodes))
-        M = np.zeros((nNodes,nNodes))
-
+        Args:
+            mesh (Mesh): the mesh.
+            k (int): the number of eigenpairs.
+            sigma (float): the shift used by the eigensolver.
+            tol (float): the tolerance used by the eigensolver.
+            
+        Returns:
+             key (str): the hexadecimal hash identifying the entry.
+        """
+        h = hashlib.sha256()
+        verts = np.ascontiguousarray(mesh.verts, dtype = np.float64)
+        connectivity = np.ascontiguousarray(mesh.connectivity, dtype = np.int64)
+        h.update(np.array(verts.shape, dtype = np.int64).tobytes())
+        h.update(verts.tobytes())
+        h.update(np.array(connectivity.shape, dtype = np.int64).tobytes())
+        h.update(connectivity.tobytes())
+        h.update(repr((int(k), float(sigma), float(tol))).encode())
+        return h.hexdigest()
+    
+    def load(self, key):
+        """This function loads an entry of the cache.
         
-        for k,tri in enumerate(self.connectivity):
-            j, i = np.meshgrid(tri,tri)
-            B, J = self.Bmatrix(k) 
-            k = self.StiffnessMatrix(B,J)
-            K[i, j] += k
-            m = self.MassMatrix(J)
-            M[i,j] += m
+        Args:
+            key (str): the key of the entry.
             
-
-        return K,M
-
-
-
-
-      
+        Returns:
+             eigenvalues (array): the memory-mapped eigenvalues, or None if the entry is not in the cache.
+             eigenvectors (array): the memory-mapped eigenvectors, shape (k, nNodes).
+        """
+        folder = os.path.join(self.path, key)
+        try:
+            eigenvalues = np.load(os.path.join(folder, 'eigenvalues.npy'), mmap_mode = 'r')
+            eigenvectors = np.load(os.path.join(folder, 'eigenvectors.npy'), mmap_mode = 'r')
+        except (OSError, ValueError):
+            return None
+        # mark the entry as recently used
+        os.utime(folder)
+        return eigenvalues, eigenvectors
+    
+    def save(self, key, eigenvalues, eigenvectors):
+        """This function stores an entry in the cache and evicts old entries if the cache is too big. The entry is written to a temporary folder and renamed, so concurrent readers never see partial files.
+        
+        Args:
+            key (str): the key of the entry.
+            eigenvalues (array): the eigenvalues.
+            eigenvectors (array): the eigenvectors, shape (k, nNodes).
+        """
+        folder = os.path.join(self.path, key)
+        tmp = tempfile.mkdtemp(prefix = '.tmp-', dir = self.path)
+        np.save(os.path.join(tmp, 'eigenvalues.npy'), np.ascontiguousarray(eigenvalues))
+        np.save(os.path.join(tmp, 'eigenvectors.npy'), np.ascontiguousarray(eigenvectors))
+        try:
+            os.rename(tmp, folder)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp, ignore_errors = True)
+        self.evict(keep = key)
+        
+    def size(self):
+        """This function returns the size of the cache in bytes."""
+        return sum(size for _, _, size in self.entries())
+        
+    def entries(self):
+        """This function lists the entries of the cache.
         
+        Returns:
+             entries (list): a list of (key, last access time, size in bytes) tuples, from the least to the most recently used.
+        """
+        entries = []
+        for key in os.listdir(self.path):
+            folder = os.path.join(self.path, key)
+            if key.startswith('.') or not os.path.isdir(folder):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder))
+                entries.append((key, os.path.getmtime(folder), size))
+            except OSError:
+                continue
+        return sorted(entries, key = lambda e: e[1])
     
+    def evict(self, keep = None):
+        """This function removes the least recently used entries until the cache fits in max_size.
+        
+        Args:
+            keep (str): the key of an entry that must not be removed.
+        """
+        if self.max_size is None:
+            return
+        entries = self.entries()
+        total = sum(size for _, _, size in entries)
+        for key, _, size in entries:
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self.path, key), ignore_errors = True)
+            total -= size
@@ -21,3 +21,4 @@ from jaxbo import initializers
 from jaxbo import optimizers
 from jaxbo import acquisitions
 from jaxbo import mcmc_models
+from jaxbo import active_learning
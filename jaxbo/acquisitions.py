@@ -2,44 +2,75 @@ import jax.numpy as np
 from jax import jit
 from jax.scipy.stats import norm
 
-# Caution: all functions are designed for single point evaluation
-# (use vmap to vectorize)
+# Caution: the functions below are designed for single point evaluation
+# (use vmap to vectorize, or the *_batch versions further down)
 
 @jit
 def EI(mean, std, best):
+    return EI_batch(mean, std, best)[0]
+
+@jit
+def LCB(mean, std, kappa = 2.0):
+    return LCB_batch(mean, std, kappa)[0]
+
+@jit
+def US(std):
+    return US_batch(std)[0]
+
+@jit
+def LW_LCB(mean, std, weights, kappa = 2.0):
+    return LW_LCB_batch(mean, std, weights, kappa)[0]
+
+@jit
+def LW_US(std, weights):
+    return LW_US_batch(std, weights)[0]
+
+@jit
+def CLSF(mean, std, kappa = 1.0):
+    return CLSF_batch(mean, std, kappa)[0]
+
+@jit
+def LW_CLSF(mean, std, weights, kappa = 1.0):
+    return LW_CLSF_batch(mean, std, weights, kappa)[0]
+
+# Batched versions: mean, std (and weights) hold the predictions at all M
+# candidates, as returned by one call to predict, and all M values are returned
+
+@jit
+def EI_batch(mean, std, best):
     # from https://people.orie.cornell.edu/pfrazier/Presentations/2011.11.INFORMS.Tutorial.pdf
     delta = -(mean - best)
     deltap = -(mean - best)
-    deltap = np.clip(deltap, a_min=0.)
+    deltap = np.clip(deltap, 0.)
     Z = delta/std
     EI = deltap - np.abs(deltap)*norm.cdf(-Z) + std*norm.pdf(Z)
-    return -EI[0]
+    return -EI
 
 @jit
-def LCB(mean, std, kappa = 2.0):
+def LCB_batch(mean, std, kappa = 2.0):
     lcb = mean - kappa*std
-    return lcb[0]
+    return lcb
 
 @jit
-def US(std):
-    return -std[0]
+def US_batch(std):
+    return -std
 
 @jit
-def LW_LCB(mean, std, weights, kappa = 2.0):
+def LW_LCB_batch(mean, std, weights, kappa = 2.0):
     lw_lcb = mean - kappa*std*weights
-    return lw_lcb[0]
+    return lw_lcb
 
 @jit
-def LW_US(std, weights):
+def LW_US_batch(std, weights):
     lw_us = std*weights
-    return -lw_us[0]
+    return -lw_us
 
 @jit
-def CLSF(mean, std, kappa = 1.0):
+def CLSF_batch(mean, std, kappa = 1.0):
     acq = np.log(np.abs(mean)+1e-8) - kappa*np.log(std+1e-8)
-    return acq[0]
+    return acq
 
 @jit
-def LW_CLSF(mean, std, weights, kappa = 1.0):
+def LW_CLSF_batch(mean, std, weights, kappa = 1.0):
     acq = np.log(np.abs(mean)+1e-8) - kappa*(np.log(std+1e-8) + np.log(weights+1e-8))
-    return acq[0]
+    return acq
@@ -0,0 +1,231 @@
+import os
+import time
+import multiprocessing
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor, \
+                               wait, FIRST_COMPLETED
+
+import numpy as onp
+import jax.numpy as np
+import jax.random as random
+from jax.tree_util import tree_leaves
+
+
+# A stand-in simulator replaying stored AF inducibility labels
+class ReplaySimulator():
+    """ Returns the label stored in data/<fidelity>_train-<case>.npz for a
+        pacing site (vertex index) listed in data/train_points.csv, after
+        sleeping `delay` seconds to mimic the cost of a simulation.
+        data_dir defaults to the data folder of this repository, whatever
+        the working directory. """
+    # Initialize the class
+    def __init__(self, case, fidelity = 'HF', data_dir = None, delay = 0.0):
+        if data_dir is None:
+            data_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+        points = onp.genfromtxt(os.path.join(data_dir, 'train_points.csv'))
+        self.vertices = points[:,3].astype(int)
+        data = onp.load(os.path.join(data_dir, '%s_train-%s.npz' % (fidelity, case)))
+        self.labels = dict(zip(self.vertices, data['output']))
+        self.delay = delay
+
+    def __call__(self, x):
+        time.sleep(self.delay)
+        return float(self.labels[int(onp.asarray(x).ravel()[0])])
+
+
+# A closed-loop sequential design driver
+class ActiveLearner():
+    """ Owns the train -> acquisition -> simulate -> retrain loop. Pacing
+        sites chosen with model.compute_next_batch_gs are submitted to a pool
+        of num_workers simulations; every time one completes, its label is
+        added and the model is retrained while the others keep running.
+          simulators: dict {fidelity: callable(x) -> label}, e.g.
+                      {'LF': ReplaySimulator(case, 'LF'), 'HF': ...}
+          X_cand: (M, D) candidates (vertex indices for the mesh models)
+          settings: training settings of the first fit; update_settings
+                    (default: settings) are used for the retraining, e.g.
+                    with warm_start and a short warmup
+          multifidelity: build {'XL', 'XH', 'y'} batches from the 'LF' and
+                         'HF' observations instead of {'X', 'y'}
+          executor: 'thread', 'process' (spawned workers; the simulators
+                    must be picklable) or a concurrent.futures.Executor
+          costs: {fidelity: cost} of one simulation, used by run with
+                 fidelity = 'auto' to pick the fidelity as well as the site
+                 (model.compute_next_batch_fidelity)
+          checkpoint: file holding the observations, the simulations
+                      still running and the history, written after every
+                      completed simulation and read back on construction
+        Further keyword arguments (bounds, max_memory, GMM weights, ...)
+        are passed on to the model's predict and acquisition. """
+    # Initialize the class
+    def __init__(self, model, simulators, X_cand, settings, update_settings = None,
+                 multifidelity = False, num_workers = 4, executor = 'thread',
+                 costs = None, checkpoint = None, **kwargs):
+        self.model = model
+        self.simulators = simulators
+        self.X_cand = onp.reshape(X_cand, (len(X_cand), -1))
+        self.settings = settings
+        self.update_settings = settings if update_settings is None else update_settings
+        self.multifidelity = multifidelity
+        self.num_workers = num_workers
+        self.executor = executor
+        self.costs = costs
+        self.checkpoint = checkpoint
+        self.kwargs = kwargs
+        self.X = {fidelity: [] for fidelity in simulators}
+        self.y = {fidelity: [] for fidelity in simulators}
+        self.pending = []
+        self.history = []
+        self.samples = None
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self.load()
+
+    def add(self, x, y, fidelity = 'HF'):
+        """ Record an observation, e.g. the initial design. """
+        self.X[fidelity].append(onp.asarray(x).ravel())
+        self.y[fidelity].append(float(y))
+
+    def batch(self):
+        """ Training data in the layout expected by the model. """
+        D = self.X_cand.shape[1]
+        X = {f: onp.reshape(onp.array(x), (len(x), D)) for f, x in self.X.items()}
+        y = {f: onp.array(v) for f, v in self.y.items()}
+        if self.multifidelity:
+            return {'XL': X['LF'], 'XH': X['HF'],
+                    'y': np.concatenate([y['LF'], y['HF']])}
+        fidelity, = self.X
+        return {'X': X[fidelity], 'y': np.array(y[fidelity])}
+
+    def fit(self, rng_key):
+        settings = self.settings if self.samples is None else self.update_settings
+        tic = time.time()
+        self.samples = self.model.train(self.batch(), rng_key, settings)
+        return time.time() - tic
+
+    def predict_kwargs(self, rng_key):
+        num_samples = tree_leaves(self.samples)[0].shape[0]
+        return dict(self.kwargs, samples = self.samples, batch = self.batch(),
+                    rng_key = rng_key, rng_keys = random.split(rng_key, num_samples))
+
+    def available(self, fidelity):
+        """ Mask of the candidates not observed or running at a fidelity. """
+        taken = {tuple(x) for x in self.X[fidelity]} | \
+                {tuple(x) for x, f in self.pending if f == fidelity}
+        return onp.array([tuple(x) not in taken for x in self.X_cand])
+
+    def select(self, q, rng_key, fidelity = 'HF'):
+        """ q new (candidate, fidelity) pairs, excluding the ones observed
+            or running. fidelity = 'auto' scores both fidelities by
+            uncertainty reduction per unit cost. """
+        kwargs = self.predict_kwargs(rng_key)
+        if fidelity == 'auto':
+            mask = onp.stack([self.available('LF'), self.available('HF')])
+            q = min(q, int(mask.sum()))
+            if q == 0:
+                return []
+            X_new, fidelities = self.model.compute_next_batch_fidelity(
+                self.X_cand, q, (self.costs['LF'], self.costs['HF']),
+                available = mask, **kwargs)
+            return [(onp.asarray(x).ravel(), f) for x, f in zip(X_new, fidelities)]
+        mask = self.available(fidelity)
+        q = min(q, int(mask.sum()))
+        if q == 0:
+            return []
+        X_new = self.model.compute_next_batch_gs(self.X_cand[mask], q, **kwargs)
+        return [(onp.asarray(x).ravel(), fidelity) for x in X_new]
+
+    def pool(self):
+        if isinstance(self.executor, Executor):
+            return self.executor
+        if self.executor == 'process':
+            return ProcessPoolExecutor(self.num_workers,
+                                       mp_context = multiprocessing.get_context('spawn'))
+        return ThreadPoolExecutor(self.num_workers)
+
+    def run(self, budget, rng_key, fidelity = 'HF', verbose = False):
+        """ Submit up to `budget` new simulations at the given fidelity, or
+            at the most informative one per unit cost if fidelity is 'auto'
+            (simulations resumed from a checkpoint count towards it), and
+            keep the pool busy until they have all completed. Returns the
+            posterior samples of the last fit; self.history records, per
+            completed simulation, the elapsed wall time, the training time
+            and the number of observations. """
+        pool = self.pool()
+        try:
+            return self.loop(pool, budget, rng_key, fidelity, verbose)
+        finally:
+            # Also on errors, e.g. a failed simulation: the queued ones are
+            # dropped and stay in self.pending for a resumed run
+            if not isinstance(self.executor, Executor):
+                pool.shutdown(cancel_futures = True)
+
+    def loop(self, pool, budget, rng_key, fidelity, verbose):
+        """ The body of run, with the simulations submitted to pool. """
+        futures = {}
+        for x, f in self.pending:
+            futures[pool.submit(self.simulators[f], x)] = (x, f)
+        submitted = len(futures)
+        tic = time.time()
+        rng_key, key = random.split(rng_key)
+        train_time = self.fit(key)
+        while True:
+            # Fill the free workers with the next batch of pacing sites
+            q = min(self.num_workers - len(futures), budget - submitted)
+            if q > 0:
+                rng_key, key = random.split(rng_key)
+                for x, f in self.select(q, key, fidelity):
+                    futures[pool.submit(self.simulators[f], x)] = (x, f)
+                    self.pending.append((x, f))
+                    submitted += 1
+            if not futures:
+                break
+            # Retrain as soon as any simulation completes
+            done, _ = wait(futures, return_when = FIRST_COMPLETED)
+            for future in done:
+                x, f = futures.pop(future)
+                self.add(x, future.result(), f)
+                self.pending = [(xp, fp) for xp, fp in self.pending
+                                if not (fp == f and onp.array_equal(xp, x))]
+            self.history.append({'time': time.time() - tic,
+                                 'train_time': train_time,
+                                 'num_obs': {f: len(v) for f, v in self.y.items()},
+                                 'num_running': len(futures)})
+            self.save()
+            if verbose:
+                print('%.1fs: %s observations, %d running, last fit %.1fs' %
+                      (self.history[-1]['time'], self.history[-1]['num_obs'],
+                       len(futures), train_time))
+            rng_key, key = random.split(rng_key)
+            train_time = self.fit(key)
+        return self.samples
+
+    def save(self):
+        if self.checkpoint is None:
+            return
+        data = {'pending_X': onp.array([x for x, f in self.pending]),
+                'pending_fidelity': onp.array([f for x, f in self.pending], dtype=str),
+                'history_time': onp.array([h['time'] for h in self.history]),
+                'history_train_time': onp.array([h['train_time'] for h in self.history]),
+                'history_num_obs': onp.array([[h['num_obs'][f] for f in self.X]
+                                              for h in self.history], dtype=int).reshape((-1, len(self.X))),
+                'history_num_running': onp.array([h['num_running'] for h in self.history], dtype=int)}
+        for f in self.X:
+            data['X_' + f] = onp.array(self.X[f])
+            data['y_' + f] = onp.array(self.y[f])
+        # Write then rename, so that an interrupted run keeps the last checkpoint
+        with open(self.checkpoint + '.tmp', 'wb') as f:
+            onp.savez(f, **data)
+        os.replace(self.checkpoint + '.tmp', self.checkpoint)
+
+    def load(self):
+        data = onp.load(self.checkpoint)
+        for f in self.X:
+            self.X[f] = list(data['X_' + f])
+            self.y[f] = [float(v) for v in data['y_' + f]]
+        self.pending = [(x, str(f)) for x, f in zip(data['pending_X'], data['pending_fidelity'])]
+        self.history = [{'time': float(t), 'train_time': float(tt),
+                         'num_obs': {f: int(n) for f, n in zip(self.X, num_obs)},
+                         'num_running': int(r)}
+                        for t, tt, num_obs, r in zip(data['history_time'],
+                                                     data['history_train_time'],
+                                                     data['history_num_obs'],
+                                                     data['history_num_running'])]
@@ -1,6 +1,6 @@
 
 import jax.numpy as np
-from jax import jit
+from jax import jit, vmap
 
 @jit
 def RBF(x1, x2, params):
@@ -38,3 +38,7 @@ def RatQuad(x1, x2, params):
             np.expand_dims(x2 / lengthscales, 0)
     r2 = np.sum(diffs**2, axis=2)
     return output_scale * np.power(1.0 + (0.5/alpha) * r2, -alpha)
+
+def diag(kernel, x, params):
+    """ Diagonal of kernel(x, x, params) without forming the full matrix. """
+    return vmap(lambda x: kernel(x[None,:], x[None,:], params)[0,0])(x)
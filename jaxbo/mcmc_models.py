@@ -1,17 +1,28 @@
+import numpy as onp
 import jax.numpy as np
 import jax.random as random
-from jax import vmap, jit
+from jax import vmap, jit, jacfwd, value_and_grad, lax, block_until_ready, device_get, local_device_count
+from jax.flatten_util import ravel_pytree
+from jax.tree_util import tree_leaves, tree_map
 from jax.scipy.linalg import cholesky, solve_triangular
 from jax.scipy.special import expit as sigmoid
 
 from jaxbo.models import GPmodel
 import jaxbo.kernels as kernels
+import jaxbo.utils as utils
 
-from numpyro import sample, deterministic, handlers
+from numpyro import sample, deterministic, handlers, validation_enabled
 import numpyro.distributions as dist
-from numpyro.infer import MCMC, NUTS, SA
+from numpyro.distributions.transforms import biject_to
+from numpyro.infer import MCMC, NUTS, SA, SVI, Trace_ELBO, Predictive
+from numpyro.infer.util import constrain_fn
+from numpyro.infer.autoguide import AutoNormal, AutoLowRankMultivariateNormal
+from numpyro.optim import Adam
+from numpyro.diagnostics import print_summary
 
 from functools import partial
+import time
+import warnings
 
 # A minimal MCMC model class (inherits from GPmodel)
 class MCMCmodel(GPmodel):
@@ -21,36 +32,491 @@ class MCMCmodel(GPmodel):
 
     # helper function for doing hmc inference
     def train(self, batch, rng_key, settings, verbose = False):
-        kernel = NUTS(self.model,
-                      target_accept_prob = settings['target_accept_prob'])
+        """ Run NUTS and return the posterior samples of all chains merged
+            along the leading axis, as in MCMC.get_samples().
+            settings['chain_method'] selects how chains are run:
+              'parallel' (default): one chain per host device. Expose one
+                  device per CPU core by calling
+                  numpyro.set_host_device_count(n) before JAX is used;
+                  falls back to 'sequential', with a warning, if there are
+                  too few devices (as numpyro's MCMC does).
+              'sequential': chains run one after the other.
+              'vectorized': chains are batched with vmap on one device.
+            The total wall time (in seconds) is stored in self.wall_time and,
+            for sequential chains, the wall time of each chain in
+            self.chain_times (None otherwise, since concurrent chains share
+            one wall time). settings['method'] = 'svi' or 'laplace'
+            selects variational inference (see train_svi) or the Laplace
+            approximation (see train_laplace) instead.
+            With settings['warm_start'] = True, NUTS continues from the
+            previous NUTS run, unless SVI or Laplace training came after it
+            (see warm_start): the adapted step size and inverse
+            mass matrix are reused and only the step size is adapted further,
+            so num_warmup can be cut to a few dozen steps when a handful of
+            training points have been appended. """
+        if settings.get('method', 'nuts') in ['svi', 'laplace']:
+            # The last NUTS state no longer describes the current posterior
+            self.warm_state = None
+            if settings['method'] == 'svi':
+                return self.train_svi(batch, rng_key, settings, verbose)
+            return self.train_laplace(batch, rng_key, settings, verbose)
+        num_chains = settings['num_chains']
+        chain_method = settings.get('chain_method', 'parallel')
+        if chain_method == 'parallel' and local_device_count() < num_chains:
+            warnings.warn('There are not enough devices to run parallel chains: '
+                          'expected %d but got %d, chains will be drawn sequentially. '
+                          'Call numpyro.set_host_device_count(%d) before JAX is used '
+                          'to run them in parallel on CPU.'
+                          % (num_chains, local_device_count(), num_chains))
+            chain_method = 'sequential'
+        start = time.time()
+        batch = self.prepare_batch(batch)
+        if settings.get('warm_start', False) and getattr(self, 'warm_state', None) is not None:
+            rng_key, key_warm = random.split(rng_key)
+            warm = self.warm_start(batch, key_warm, num_chains)
+        else:
+            warm = None
+        if chain_method == 'sequential':
+            # Run and time each chain separately, with the keys MCMC would use
+            keys = random.split(rng_key, num_chains) if num_chains > 1 else [rng_key]
+            chains, states, times = [], [], []
+            for c, key in enumerate(keys):
+                tic = time.time()
+                chain_warm = None if warm is None else tree_map(lambda x: x[c], warm)
+                mcmc = self.mcmc(settings, 1, chain_method, chain_warm)
+                mcmc.run(key, batch, init_params =
+                         None if warm is None else chain_warm['z'])
+                chains.append(block_until_ready(mcmc.get_samples()))
+                states.append(mcmc.last_state)
+                times.append(time.time() - tic)
+            grouped = tree_map(lambda *x: np.stack(x), *chains)
+            state = tree_map(lambda *x: np.stack(x), *states)
+        else:
+            # Chains run concurrently and share the same wall time; a single
+            # kernel is shared, so they start from the chain-averaged
+            # step size and mass matrix
+            mcmc = self.mcmc(settings, num_chains, chain_method,
+                             None if warm is None else tree_map(lambda x: x.mean(0), warm))
+            init_params = None if warm is None else \
+                          warm['z'] if num_chains > 1 else tree_map(lambda x: x[0], warm['z'])
+            mcmc.run(rng_key, batch, init_params = init_params)
+            grouped = block_until_ready(mcmc.get_samples(group_by_chain=True))
+            state = mcmc.last_state if num_chains > 1 else \
+                    tree_map(lambda x: x[None], mcmc.last_state)
+            times = None
+        self.wall_time = time.time() - start
+        self.chain_times = None if times is None else onp.array(times)
+        self.warm_state = device_get({'z': state.z,
+                                      'step_size': state.adapt_state.step_size,
+                                      'inverse_mass_matrix': state.adapt_state.inverse_mass_matrix})
+        if verbose:
+            print_summary(grouped)
+            print('Wall time (%s): %.1fs' % (chain_method, self.wall_time))
+            if times is not None:
+                print('Wall time per chain: %s' % ', '.join('%.1fs' % t for t in times))
+        return tree_map(lambda x: x.reshape((-1,) + x.shape[2:]), grouped)
+
+    def warm_start(self, batch, rng_key, num_chains):
+        """ Per-chain initial values (unconstrained), step size and diagonal
+            inverse mass matrix from the last state of the previous NUTS run,
+            extended to the current batch, whose training points must be
+            those of the previous run with new ones appended (per fidelity).
+            Sites that grew (the whitened latents eta) get fresh N(0, 1)
+            coordinates with unit inverse mass for the new points. If the new
+            points all come last in the latent vector (single fidelity, or
+            only high fidelity points added) the old coordinates are kept,
+            which leaves the latent function at the old points unchanged.
+            Otherwise (e.g. low fidelity points added before the high
+            fidelity block) the latents are whitened again (see rewhiten),
+            so the latent function at the old points is still unchanged.
+            Chains are reused cyclically if there are more chains than in
+            the previous run. """
+        with validation_enabled(False):
+            trace = handlers.trace(handlers.seed(self.model, rng_key)).get_trace(batch)
+        shapes = {name: np.shape(site['value']) for name, site in trace.items()
+                  if site['type'] == 'sample' and not site['is_observed']}
+        old = self.warm_state
+        for name, x in old['z'].items():
+            if len(shapes[name]) and shapes[name][0] < x.shape[1]:
+                raise ValueError('Cannot warm start site %s with %d training points from a '
+                                 'run with %d; training points can only be appended, train '
+                                 'without warm_start instead' % (name, shapes[name][0], x.shape[1]))
+        idx = np.arange(num_chains) % old['step_size'].shape[0]
+        keys = dict(zip(shapes, random.split(rng_key, len(shapes))))
+        def extend(name, x, fill):
+            # x has a leading chain axis; pad the first site axis
+            n = shapes[name][0] - x.shape[1] if len(shapes[name]) else 0
+            if n == 0:
+                return x
+            new = fill(keys[name], (x.shape[0], n) + x.shape[2:])
+            return np.concatenate([x, new], axis=1)
+        z = {name: extend(name, x[idx], random.normal)
+             for name, x in old['z'].items()}
+        ones = lambda key, shape: np.ones(shape)
+        inverse_mass_matrix = {}
+        for names, imm in old['inverse_mass_matrix'].items():
+            # Flat diagonal over the sites in names, in that order
+            sizes = [int(onp.prod(old['z'][name].shape[1:])) for name in names]
+            blocks = np.split(imm[idx], onp.cumsum(sizes)[:-1], axis=1)
+            inverse_mass_matrix[names] = np.concatenate(
+                [extend(name, b, ones) for name, b in zip(names, blocks)], axis=1)
+        # Whitened latents, in the order of the training points
+        latents = [name for name in shapes if name == 'eta' or name.startswith('eta_')]
+        grown = [name for name in latents if shapes[name][0] > old['z'][name].shape[1]]
+        if len(grown) > 1 or (len(grown) == 1 and grown[0] != latents[-1]):
+            sizes = {name: old['z'][name].shape[1] for name in latents}
+            z = self.rewhiten(batch, z, sizes)
+        return {'z': z, 'step_size': old['step_size'][idx],
+                'inverse_mass_matrix': inverse_mass_matrix}
+
+    def rewhiten(self, batch, z, sizes):
+        """ Whitened latents of the current batch that keep the latent
+            function of the previous run at its training points. z holds
+            per-chain unconstrained values in which the latent sites
+            (eta...) are the old coordinates padded with fresh ones, and
+            sizes the number of old points of each latent site. The model
+            computes f = L eta + beta, so L is the Jacobian of the logits of
+            y with respect to the stacked latents. With the old points moved
+            first, the Cholesky factor of the permuted covariance starts with
+            the factor of the previous run, so the old coordinates followed
+            by the fresh ones give the old latent function at the old points
+            and a draw from its conditional at the new ones; eta is then
+            recovered with a triangular solve against L. """
+        latents = list(sizes)
+        counts = [z[name].shape[1] for name in latents]
+        offsets = onp.cumsum(counts) - counts
+        old_idx = onp.concatenate([o + onp.arange(sizes[name])
+                                   for name, o in zip(latents, offsets)])
+        new_idx = onp.concatenate([o + onp.arange(sizes[name], n)
+                                   for name, n, o in zip(latents, counts, offsets)])
+        perm = onp.concatenate([old_idx, new_idx])
+        def chain_fn(z):
+            def logits(eta):
+                params = dict(z, **dict(zip(latents, np.split(eta, onp.cumsum(counts)[:-1]))))
+                with validation_enabled(False):
+                    values = constrain_fn(self.model, (batch,), {}, params)
+                    trace = handlers.trace(handlers.substitute(self.model, data = values)).get_trace(batch)
+                return trace['y']['fn'].logits
+            eta = np.concatenate([z[name] for name in latents])
+            L = jacfwd(logits)(eta)
+            L_perm = cholesky(np.matmul(L, L.T)[perm][:,perm], lower=True)
+            f = np.zeros_like(eta).at[perm].set(np.matmul(L_perm, eta[perm]))
+            eta = solve_triangular(L, f, lower=True)
+            return dict(zip(latents, np.split(eta, onp.cumsum(counts)[:-1])))
+        num_chains = z[latents[0]].shape[0]
+        chains = [chain_fn(tree_map(lambda x: x[c], z)) for c in range(num_chains)]
+        return dict(z, **tree_map(lambda *x: np.stack(x), *chains))
+
+    # helper function for doing variational inference
+    def train_svi(self, batch, rng_key, settings, verbose = False):
+        """ Fit a variational approximation to the posterior of model() and
+            return settings['num_samples'] draws from it, in the same layout
+            as the NUTS samples. Settings:
+              guide: 'normal' (mean-field, default) or 'lowrank' (multivariate
+                     normal with a low-rank plus diagonal covariance)
+              rank: rank of the 'lowrank' covariance (default sqrt of the
+                    number of latent dimensions)
+              num_steps: number of optimization steps (default 5000)
+              learning_rate: Adam step size (default 1e-2)
+            The ELBO loss history is stored in self.svi_losses. """
+        batch = self.prepare_batch(batch)
+        if settings.get('guide', 'normal') == 'lowrank':
+            guide = AutoLowRankMultivariateNormal(self.model,
+                                                  rank = settings.get('rank', None))
+        else:
+            guide = AutoNormal(self.model)
+        optimizer = Adam(settings.get('learning_rate', 1e-2))
+        svi = SVI(self.model, guide, optimizer, loss = Trace_ELBO())
+        key_fit, key_sample = random.split(rng_key)
+        result = svi.run(key_fit, settings.get('num_steps', 5000), batch,
+                         progress_bar = verbose)
+        self.svi_losses = result.losses
+        predictive = Predictive(self.model, guide = guide, params = result.params,
+                                num_samples = settings['num_samples'],
+                                return_sites = self.sample_sites(batch, key_fit))
+        return predictive(key_sample, batch)
+
+    # helper function for Laplace approximate inference
+    def train_laplace(self, batch, rng_key, settings, verbose = False):
+        """ Laplace approximation for classifiers of the form
+              f = A(theta) z + m(theta),  z ~ N(0, I),  y ~ Bernoulli(logits = f),
+            where z gathers the standard normal sites of model() (eta, ws,
+            beta) and theta the remaining hyper-parameters. Newton iterations
+            find the mode of p(z | y, theta), and theta maximizes the Laplace
+            approximation of p(y | theta) p(theta), in a single jitted loop
+            (see laplace_fit) that is compiled once per training set size.
+            Returns settings['num_samples'] draws with theta fixed and
+            z ~ N(z_hat, (I + A^T W A)^{-1}), in the layout of the NUTS
+            samples, so that predict and predict_conditional apply unchanged;
+            predict_laplace gives the Gaussian predictive mean and standard
+            deviation directly. Settings:
+              num_steps: Adam steps on theta (default 500)
+              learning_rate: Adam step size (default 5e-2)
+              num_newton: warm-started Newton steps per Adam step (default 5)
+            The hyper-parameters, the mode z_hat, the factors of the posterior
+            covariance of z and the negative log evidence history are stored
+            in self.laplace. """
+        batch = self.prepare_batch(batch)
+        key_init, key_sample = random.split(rng_key)
+        num_samples = settings['num_samples']
+        # Split the latent sites into whitened coordinates z and theta; only
+        # the structure of the trace is used, so a prior draw may be singular
+        with validation_enabled(False):
+            trace = handlers.trace(handlers.seed(self.model, key_init)).get_trace(batch)
+        latent = {name: site for name, site in trace.items()
+                  if site['type'] == 'sample' and not site['is_observed']}
+        white = lambda fn: isinstance(fn, dist.Normal) and \
+                           onp.all(onp.asarray(fn.loc) == 0.) and \
+                           onp.all(onp.asarray(fn.scale) == 1.)
+        hyper_names = tuple(name for name, site in latent.items() if not white(site['fn']))
+        # Uniform(-2, 2) initialization in unconstrained space, as in NUTS
+        keys = random.split(key_init, len(hyper_names))
+        u0 = {}
+        for key, name in zip(keys, hyper_names):
+            T = biject_to(latent[name]['fn'].support)
+            u0[name] = random.uniform(key, np.shape(T.inv(latent[name]['value'])),
+                                      minval = -2., maxval = 2.)
+        num_obs = [site for site in trace.values()
+                   if site['type'] == 'sample' and site['is_observed']][0]['value'].shape[0]
+        theta, z, Z, L, sWA, losses = self.laplace_fit(batch, u0, np.zeros(num_obs), key_sample,
+                                                       hyper_names,
+                                                       settings.get('num_steps', 500),
+                                                       settings.get('num_newton', 5),
+                                                       settings.get('learning_rate', 5e-2),
+                                                       num_samples)
+        unravel = ravel_pytree({name: site['value'] for name, site in latent.items()
+                                if name not in hyper_names})[1]
+        self.laplace = {'params': theta, 'mode': unravel(z), 'L': L, 'sWA': sWA,
+                        'losses': losses}
+        if verbose:
+            print('Laplace: negative log evidence %.3f' % losses[-1])
+        # Posterior draws of z, with theta at its optimum
+        draws = vmap(unravel)(Z)
+        draws.update({name: np.broadcast_to(v, (num_samples,) + v.shape)
+                      for name, v in theta.items()})
+        predictive = Predictive(self.model, posterior_samples = draws,
+                                return_sites = self.sample_sites(batch, key_init))
+        return predictive(key_sample, batch)
+
+    @partial(jit, static_argnums=(0,5,6,7,8,9))
+    def laplace_fit(self, batch, u, a, key, hyper_names, num_steps,
+                    num_newton, learning_rate, num_samples):
+        """ Adam on the unconstrained hyper-parameters u (the sites in
+            hyper_names), with warm-started Newton iterations for the mode,
+            followed by num_samples draws of z. Returns the constrained
+            hyper-parameters, the mode, the draws, the Cholesky factor L of
+            B = I + W^{1/2} A A^T W^{1/2}, W^{1/2} A and the loss history. """
+        # The model constants do not depend on the seed
+        trace = handlers.trace(handlers.seed(self.model, random.PRNGKey(0))).get_trace(batch)
+        obs = [name for name, site in trace.items()
+               if site['type'] == 'sample' and site['is_observed']][0]
+        y = trace[obs]['value']
+        latent = {name: site for name, site in trace.items()
+                  if site['type'] == 'sample' and not site['is_observed']}
+        hyper = {name: biject_to(latent[name]['fn'].support) for name in hyper_names}
+        z0, unravel = ravel_pytree({name: np.zeros_like(site['value'])
+                                    for name, site in latent.items()
+                                    if name not in hyper})
+        def log_prior(u):
+            lp = 0.
+            for name, T in hyper.items():
+                v = T(u[name])
+                lp += np.sum(latent[name]['fn'].log_prob(v)) + \
+                      np.sum(T.log_abs_det_jacobian(u[name], v))
+            return lp
+        def logits(u, z):
+            data = {name: T(u[name]) for name, T in hyper.items()}
+            data.update(unravel(z))
+            model = handlers.substitute(self.model, data = data)
+            return handlers.trace(model).get_trace(batch)[obs]['fn'].logits
+        def newton(u, a, num_iter):
+            # f = A z + m is affine in z, so iterate on g = A z with K = A A^T
+            # (Rasmussen & Williams, Algorithm 3.1); a = K^{-1} g, z = A^T a
+            m = logits(u, np.zeros_like(z0))
+            A = jacfwd(lambda z: logits(u, z))(np.zeros_like(z0))
+            K = np.matmul(A, A.T)
+            def factor(g):
+                p = sigmoid(g + m)
+                sW = np.sqrt(p*(1.0 - p))
+                B = np.eye(K.shape[0]) + sW[:,None]*K*sW[None,:]
+                return cholesky(B, lower=True), sW, p
+            def step(carry, _):
+                g, a = carry
+                L, sW, p = factor(g)
+                b = sW**2*g + y - p
+                c = solve_triangular(L.T, solve_triangular(L, sW*np.matmul(K, b), lower=True))
+                a = b - sW*c
+                return (np.matmul(K, a), a), None
+            (g, a), _ = lax.scan(step, (np.matmul(K, a), a), None, length = num_iter)
+            L, sW, _ = factor(g)
+            return a, g + m, g, L, sW, A
+        def neg_evidence(u, a):
+            a, f, g, L, _, _ = newton(u, lax.stop_gradient(a), num_newton)
+            log_lik = np.sum(y*f - np.logaddexp(0., f))
+            evidence = log_lik - 0.5*np.dot(a, g) - np.sum(np.log(np.diag(L)))
+            return -(evidence + log_prior(u)), lax.stop_gradient(a)
+        optimizer = Adam(learning_rate)
+        def step(carry, _):
+            state, a = carry
+            u = optimizer.get_params(state)
+            (loss, a), grad = value_and_grad(neg_evidence, has_aux=True)(u, a)
+            return (optimizer.update(grad, state), a), loss
+        (state, a), losses = lax.scan(step, (optimizer.init(u), a), None,
+                                      length = num_steps)
+        u = optimizer.get_params(state)
+        a, _, _, L, sW, A = newton(u, a, 4*num_newton)
+        z = np.matmul(A.T, a)
+        # Draws from N(z_hat, (I + A^T W A)^{-1}) by conditioning prior
+        # draws on pseudo-observations with noise W^{-1} (Matheron's rule)
+        key_z, key_e = random.split(key)
+        z0 = random.normal(key_z, (num_samples, z.shape[0]))
+        e = random.normal(key_e, (num_samples, a.shape[0]))
+        r = sW[:,None]*np.matmul(A, z0.T) + e.T
+        c = solve_triangular(L.T, solve_triangular(L, r, lower=True))
+        Z = z + z0 - np.matmul(A.T, sW[:,None]*c).T
+        theta = {name: T(u[name]) for name, T in hyper.items()}
+        return theta, z, Z, L, sW[:,None]*A, losses
+
+    def predict_laplace(self, X_star, point_chunk = None, laplace = None, **kwargs):
+        """ Gaussian predictive mean and standard deviation of the latent
+            function under the Laplace approximation of the last call to
+            train_laplace (or the given laplace dict): the conditional mean
+            at theta_hat is affine in z ~ N(z_hat, (I + A^T W A)^{-1}), so its
+            variance is added in closed form to the conditional variance.
+            Returned with shape (1, N*), as a single sample of
+            predict_conditional, and evaluated over chunks of point_chunk
+            test points. """
+        laplace = self.laplace if laplace is None else laplace
+        point_chunk = X_star.shape[0] if point_chunk is None else min(point_chunk, X_star.shape[0])
+        return self.predict_laplace_tiles(X_star, int(point_chunk), laplace, **kwargs)
+
+    @partial(jit, static_argnums=(0,2))
+    def predict_laplace_tiles(self, X_star, point_chunk, laplace, **kwargs):
+        # Normalize to [0,1]
+        bounds = kwargs['bounds']
+        X_star = (X_star - bounds['lb'])/(bounds['ub'] - bounds['lb'])
+        # Training-data constants, shared by all tiles
+        kwargs['batch'] = self.prepare_batch(kwargs['batch'])
+        z_hat, unravel = ravel_pytree(laplace['mode'])
+        L, sWA = laplace['L'], laplace['sWA']
+        def conditional(z, X):
+            sample = dict(laplace['params'])
+            sample.update(unravel(z))
+            return self.conditional(sample, X, **kwargs)
+        def tile_fn(z, X):
+            mu, std = conditional(z, X)
+            # Rows of J (I + A^T W A)^{-1} J^T by the matrix inversion lemma
+            J = jacfwd(lambda z: conditional(z, X)[0])(z)
+            V = solve_triangular(L, np.matmul(sWA, J.T), lower=True)
+            var = std**2 + np.sum(J**2, axis=1) - np.sum(V**2, axis=0)
+            return mu, np.sqrt(np.clip(var, 0.))
+        return utils.map_tiles(tile_fn, (z_hat[None],), X_star, 1, point_chunk)
+
+    def sample_sites(self, batch, rng_key):
+        """ Sites returned as posterior samples, as in MCMC.get_samples():
+            the latent sample sites and the deterministic sites of model(). """
+        with validation_enabled(False):
+            trace = handlers.trace(handlers.seed(self.model, rng_key)).get_trace(batch)
+        return [name for name, site in trace.items()
+                if (site['type'] == 'sample' and not site['is_observed'])
+                or site['type'] == 'deterministic']
+
+    def mcmc(self, settings, num_chains, chain_method, warm = None):
+        if warm is None:
+            kernel = NUTS(self.model,
+                          target_accept_prob = settings['target_accept_prob'])
+        else:
+            kernel = NUTS(self.model,
+                          target_accept_prob = settings['target_accept_prob'],
+                          step_size = warm['step_size'],
+                          inverse_mass_matrix = warm['inverse_mass_matrix'],
+                          adapt_mass_matrix = False)
         #kernel = SA(self.model)
-        mcmc = MCMC(kernel,
+        return MCMC(kernel,
                     num_warmup = settings['num_warmup'],
                     num_samples = settings['num_samples'],
-                    num_chains = settings['num_chains'],
+                    num_chains = num_chains,
+                    chain_method = chain_method,
                     progress_bar=True,
                     jit_model_args=True)
-        mcmc.run(rng_key, batch)
-        if verbose:
-            mcmc.print_summary()
-        return mcmc.get_samples()
 
-    @partial(jit, static_argnums=(0,))
-    def predict(self, X_star, **kwargs):
+    def prepare_batch(self, batch):
+        """ Precompute the model constants derived from the training data. """
+        return batch
+
+    def chunk_sizes(self, num_points, sample_chunk = None, point_chunk = None,
+                    max_memory = None, **kwargs):
+        """ Number of posterior samples and test points evaluated at once.
+            Explicit chunk sizes take precedence; otherwise, if max_memory
+            (in bytes) is given, the tiles are sized so that their footprint
+            fits in it: per sample, the N x N training covariance (and its
+            Cholesky factor) plus the N x n_eig gathered eigenfunctions, and
+            per (sample, point) pair, a cross-covariance row against the N
+            training inputs plus an eigenfunction row, all with headroom for
+            temporaries. The sizes must be concrete: pass them as static
+            arguments (as acquisition does) when calling from jitted code. """
+        num_samples = tree_leaves(kwargs['samples'])[0].shape[0]
+        if max_memory is not None and sample_chunk is None and point_chunk is None:
+            # Training points only, not the labels or precomputed features
+            num_train = sum(x.shape[0] for name, x in kwargs['batch'].items()
+                            if name.startswith('X'))
+            num_basis = getattr(self, 'eigenvalues', np.zeros(0)).shape[0]
+            sample_bytes = 4*8*num_train*(num_train + num_basis)
+            pair_bytes = 4*8*(num_train + num_basis + 1)
+            tile_bytes = sample_bytes + num_points*pair_bytes
+            if tile_bytes <= max_memory:
+                point_chunk = num_points
+                sample_chunk = max(1, min(num_samples, max_memory // tile_bytes))
+            else:
+                sample_chunk = 1
+                point_chunk = max(1, (max_memory - sample_bytes) // pair_bytes)
+        sample_chunk = num_samples if sample_chunk is None else min(sample_chunk, num_samples)
+        point_chunk = num_points if point_chunk is None else min(point_chunk, num_points)
+        return int(sample_chunk), int(point_chunk)
+
+    def predict(self, X_star, sample_chunk = None, point_chunk = None,
+                max_memory = None, **kwargs):
+        """ Posterior predictive mean and standard deviation, evaluated over
+            tiles of posterior samples and test points (see chunk_sizes). """
+        chunks = self.chunk_sizes(X_star.shape[0], sample_chunk, point_chunk,
+                                  max_memory, **kwargs)
+        return self.predict_tiles(X_star, *chunks, **kwargs)
+
+    @partial(jit, static_argnums=(0,2,3))
+    def predict_tiles(self, X_star, sample_chunk, point_chunk, **kwargs):
         # Normalize to [0,1]
         bounds = kwargs['bounds']
         X_star = (X_star - bounds['lb'])/(bounds['ub'] - bounds['lb'])
+        # Training-data constants, shared by all samples and tiles
+        kwargs['batch'] = self.prepare_batch(kwargs['batch'])
         # Vectorized predictions
         rng_keys = kwargs['rng_keys']
         samples = kwargs['samples']
-        sample_fn = lambda key, sample: self.posterior_sample(key,
-                                                              sample,
-                                                              X_star,
-                                                              **kwargs)
-        means, predictions = vmap(sample_fn)(rng_keys, samples)
+        sample_fn = lambda key, sample, X: self.posterior_sample(key,
+                                                                 sample,
+                                                                 X,
+                                                                 **kwargs)
+        means, predictions = utils.map_tiles(sample_fn, (rng_keys, samples),
+                                             X_star, sample_chunk, point_chunk)
         mean_prediction = np.mean(means, axis=0)
         std_prediction = np.std(predictions, axis=0)
         return mean_prediction, std_prediction
+
+    @partial(jit, static_argnums=(0,))
+    def correlation(self, X_cand, x, **kwargs):
+        """ Correlation of the candidates with x across the posterior samples
+            of the predictive mean (see posterior_sample), i.e. the part of
+            the predictive covariance due to the parameter uncertainty.
+            Models with a kernel override it with a closed form. """
+        bounds = kwargs['bounds']
+        X = (np.concatenate([x, X_cand]) - bounds['lb'])/(bounds['ub'] - bounds['lb'])
+        kwargs['batch'] = self.prepare_batch(kwargs['batch'])
+        sample_fn = lambda key, sample: self.posterior_sample(key, sample, X, **kwargs)[0]
+        means = vmap(sample_fn)(kwargs['rng_keys'], kwargs['samples'])
+        means = means - np.mean(means, axis=0)
+        cov = np.mean(means[:,1:]*means[:,:1], axis=0)
+        var = np.mean(means**2, axis=0)
+        return cov/np.sqrt(var[1:]*var[0] + 1e-16)
         
 class MCMCGPmodel(MCMCmodel):
     # Initialize the class
@@ -58,18 +524,103 @@ class MCMCGPmodel(MCMCmodel):
         super().__init__(options)
 
 
-    @partial(jit, static_argnums=(0,))
-    def predict_conditional(self, X_star, **kwargs):
+    def predict_conditional(self, X_star, sample_chunk = None, point_chunk = None,
+                            max_memory = None, **kwargs):
+        """ Per-sample conditional means and standard deviations, evaluated
+            over tiles of posterior samples and test points. """
+        chunks = self.chunk_sizes(X_star.shape[0], sample_chunk, point_chunk,
+                                  max_memory, **kwargs)
+        return self.predict_conditional_tiles(X_star, *chunks, **kwargs)
+
+    @partial(jit, static_argnums=(0,2,3))
+    def predict_conditional_tiles(self, X_star, sample_chunk, point_chunk, **kwargs):
         # Normalize to [0,1]
         bounds = kwargs['bounds']
         X_star = (X_star - bounds['lb'])/(bounds['ub'] - bounds['lb'])
+        # Training-data constants, shared by all samples and tiles
+        kwargs['batch'] = self.prepare_batch(kwargs['batch'])
         # Vectorized predictions
-       # rng_keys = kwargs['rng_keys']
         samples = kwargs['samples']
-        sample_fn = lambda sample: self.conditional(sample, X_star, **kwargs)
-        means, stds = vmap(sample_fn)(samples)
-
+        sample_fn = lambda sample, X: self.conditional(sample, X, **kwargs)
+        means, stds = utils.map_tiles(sample_fn, (samples,), X_star,
+                                      sample_chunk, point_chunk)
         return means, stds
+
+    def predict_summary(self, X_star, sample_chunk = None, point_chunk = None,
+                        max_memory = None, quantiles = None, num_bins = 200, **kwargs):
+        """ Per-point posterior summaries accumulated over sample chunks,
+            without storing per-sample predictions. Returns a dict with
+              mean:     posterior mean of the latent function
+              std:      sqrt of the mean conditional variance
+              mean_std: spread of the conditional means across samples
+              prob:     posterior class probability E[sigmoid(f)], using the
+                        probit approximation for each conditional Gaussian
+              quantiles (if given): quantiles of the per-sample class
+                        probability, from a num_bins histogram on [0, 1] """
+        chunks = self.chunk_sizes(X_star.shape[0], sample_chunk, point_chunk,
+                                  max_memory, **kwargs)
+        quantiles = None if quantiles is None else tuple(quantiles)
+        return self.predict_summary_tiles(X_star, *chunks, quantiles, num_bins, **kwargs)
+
+    @partial(jit, static_argnums=(0,2,3,4,5))
+    def predict_summary_tiles(self, X_star, sample_chunk, point_chunk,
+                              quantiles, num_bins, **kwargs):
+        # Normalize to [0,1]
+        bounds = kwargs['bounds']
+        X_star = (X_star - bounds['lb'])/(bounds['ub'] - bounds['lb'])
+        # Training-data constants, shared by all samples and tiles
+        kwargs['batch'] = self.prepare_batch(kwargs['batch'])
+        samples = kwargs['samples']
+        sample_fn = lambda sample, X: self.conditional(sample, X, **kwargs)
+        bins = num_bins if quantiles is not None else 0
+        def init(n):
+            return {'n': np.zeros(n), 'mean': np.zeros(n), 'M2': np.zeros(n),
+                    'var': np.zeros(n), 'prob': np.zeros(n),
+                    'hist': np.zeros((n, bins))}
+        def update(state, out, mask):
+            mu, std = out
+            w = mask[:,None].astype(mu.dtype)
+            # Moments of this chunk, merged with the running ones (Chan et al.)
+            n_b = np.sum(w, axis=0)
+            n = state['n'] + n_b
+            mean_b = np.sum(w*mu, axis=0)/n_b
+            M2_b = np.sum(w*(mu - mean_b)**2, axis=0)
+            delta = mean_b - state['mean']
+            mean = state['mean'] + delta*n_b/n
+            M2 = state['M2'] + M2_b + delta**2*state['n']*n_b/n
+            # Running averages of the conditional variance and class probability
+            p = sigmoid(mu/np.sqrt(1.0 + np.pi*std**2/8.0))
+            var = state['var'] + (np.sum(w*std**2, axis=0) - n_b*state['var'])/n
+            prob = state['prob'] + (np.sum(w*p, axis=0) - n_b*state['prob'])/n
+            hist = state['hist']
+            if bins > 0:
+                idx = np.clip(np.floor(p*bins).astype(int), 0, bins-1)
+                cols = np.broadcast_to(np.arange(mu.shape[1])[None,:], idx.shape)
+                hist = hist.at[cols, idx].add(np.broadcast_to(w, idx.shape))
+            return {'n': n, 'mean': mean, 'M2': M2, 'var': var,
+                    'prob': prob, 'hist': hist}
+        state = utils.reduce_tiles(sample_fn, update, init, (samples,), X_star,
+                                   sample_chunk, point_chunk)
+        summary = {'mean': state['mean'],
+                   'std': np.sqrt(state['var']),
+                   'mean_std': np.sqrt(state['M2']/state['n']),
+                   'prob': state['prob']}
+        if quantiles is not None:
+            summary['quantiles'] = utils.histogram_quantiles(state['hist'], quantiles)
+        return summary
+
+    @partial(jit, static_argnums=(0,))
+    def predict_conditional_cov(self, X_star, **kwargs):
+        """ Per-sample conditional means and full N* x N* covariances. """
+        # Normalize to [0,1]
+        bounds = kwargs['bounds']
+        X_star = (X_star - bounds['lb'])/(bounds['ub'] - bounds['lb'])
+        # Training-data constants, shared by all samples
+        kwargs['batch'] = self.prepare_batch(kwargs['batch'])
+        samples = kwargs['samples']
+        sample_fn = lambda sample: self.conditional(sample, X_star, True, **kwargs)
+        means, covs = vmap(sample_fn)(samples)
+        return means, covs
     
 
 
@@ -119,15 +670,13 @@ class GP(MCMCmodel):
         params = np.concatenate([np.array([var]), np.array(length), np.array([noise])])
         theta = params[:-1]
         # Compute kernels
-        k_pp = self.kernel(X_star, X_star, theta) + np.eye(X_star.shape[0])*(noise + 1e-8)
+        k_pp = self.prior_cov(X_star, theta, False, noise + 1e-8)
         k_pX = self.kernel(X_star, X, theta)
         L = self.compute_cholesky(params, batch)
         alpha = solve_triangular(L.T,solve_triangular(L, y, lower=True))
-        beta  = solve_triangular(L.T,solve_triangular(L, k_pX.T, lower=True))
         # Compute predictive mean, std
         mu = np.matmul(k_pX, alpha)
-        cov = k_pp - np.matmul(k_pX, beta)
-        std = np.sqrt(np.clip(np.diag(cov), a_min=0.))
+        std = self.posterior_cov(k_pp, k_pX, L, False)
         sample = mu + std * random.normal(key, mu.shape)
         mu = mu*norm_const['sigma_y'] + norm_const['mu_y']
         sample = sample*norm_const['sigma_y'] + norm_const['mu_y']
@@ -136,6 +685,17 @@ class GP(MCMCmodel):
         else:
             return mu, sample
 
+    def correlation(self, X_cand, x, **kwargs):
+        """ Correlation of the candidates with x under the prior kernel
+            averaged over the posterior samples. """
+        bounds = kwargs['bounds']
+        X_cand = (X_cand - bounds['lb'])/(bounds['ub'] - bounds['lb'])
+        x = (x - bounds['lb'])/(bounds['ub'] - bounds['lb'])
+        samples = kwargs['samples']
+        theta = np.concatenate([samples['kernel_var'][:,None], samples['kernel_length']], axis=1)
+        k = vmap(lambda theta: self.kernel(X_cand, x, theta)[:,0])(theta)
+        return np.mean(k, axis=0)/np.mean(samples['kernel_var'])
+
 # A minimal Gaussian process classification class (inherits from MCMCmodel)
 class GPclassifier(MCMCGPmodel):
     # Initialize the class
@@ -160,10 +720,8 @@ class GPclassifier(MCMCGPmodel):
         # Bernoulli likelihood
         sample('y', dist.Bernoulli(logits=f), obs=y)
 
-    @partial(jit, static_argnums=(0,))
-    def posterior_sample(self, key, sample, X_star, **kwargs):
+    def conditional(self, sample, X_star, **kwargs):
         # Fetch training data
-        MAP = kwargs.get('MAP', False)
         batch = kwargs['batch']
         X = batch['X']
         # Fetch params
@@ -174,21 +732,36 @@ class GPclassifier(MCMCGPmodel):
         theta = np.concatenate([var, length])
         # Compute kernels
         K_xx = self.kernel(X, X, theta) + np.eye(X.shape[0])*1e-8
-        k_pp = self.kernel(X_star, X_star, theta) + np.eye(X_star.shape[0])*1e-8
+        k_pp = self.prior_cov(X_star, theta, False, 1e-8)
         k_pX = self.kernel(X_star, X, theta)
         L = cholesky(K_xx, lower=True)
         f = np.matmul(L, eta) + beta
         tmp_1 = solve_triangular(L.T,solve_triangular(L, f, lower=True))
-        tmp_2  = solve_triangular(L.T,solve_triangular(L, k_pX.T, lower=True))
-        # Compute predictive mean
+        # Compute predictive mean, std
         mu = np.matmul(k_pX, tmp_1)
-        cov = k_pp - np.matmul(k_pX, tmp_2)
-        std = np.sqrt(np.clip(np.diag(cov), a_min=0.))
+        std = self.posterior_cov(k_pp, k_pX, L, False)
+        return mu, std
+
+    @partial(jit, static_argnums=(0,))
+    def posterior_sample(self, key, sample, X_star, **kwargs):
+        MAP = kwargs.get('MAP', False)
+        mu, std = self.conditional(sample, X_star, **kwargs)
         sample = mu + std * random.normal(key, mu.shape)
         if MAP:
             return mu, std
         else:
             return mu, sample
+
+    def correlation(self, X_cand, x, **kwargs):
+        """ Correlation of the candidates with x under the prior kernel
+            averaged over the posterior samples. """
+        bounds = kwargs['bounds']
+        X_cand = (X_cand - bounds['lb'])/(bounds['ub'] - bounds['lb'])
+        x = (x - bounds['lb'])/(bounds['ub'] - bounds['lb'])
+        samples = kwargs['samples']
+        theta = np.concatenate([samples['kernel_var'], samples['kernel_length']], axis=1)
+        k = vmap(lambda theta: self.kernel(X_cand, x, theta)[:,0])(theta)
+        return np.mean(k, axis=0)/np.mean(samples['kernel_var'])
     
 class ReimannianGPclassifier(MCMCGPmodel):
     # Initialize the class
@@ -202,7 +775,8 @@ class ReimannianGPclassifier(MCMCGPmodel):
         self.norm_const = np.average((Sn[None,:]*self.eigenfunctions**2).sum(1))
 
     def model(self, batch):
-        X = batch['X']
+        batch = self.prepare_batch(batch)
+        X, phi = batch['X'], batch['phi']
         y = batch['y']
         N = X.shape[0]
         D = 1
@@ -211,7 +785,7 @@ class ReimannianGPclassifier(MCMCGPmodel):
         length = sample('kernel_length', dist.Gamma(1.0, 1.0), sample_shape = (D,))
         # Compute kernel
         S = self.eval_S(length, var)
-        K = self.eval_K(X, X, S) + np.eye(N)*1e-8
+        K = self.eval_K(phi, phi, S) + np.eye(N)*1e-8
         L = cholesky(K, lower=True)
         # Generate latent function
         beta = sample('beta', dist.Normal(0.0, 1.0))
@@ -220,12 +794,40 @@ class ReimannianGPclassifier(MCMCGPmodel):
         # Bernoulli likelihood
         sample('y', dist.Bernoulli(logits=f), obs=y)
         
-    def eval_K(self, X, Xp, S):
-        """ Compute the matrix K(X, X). """
-        K = (self.eigenfunctions[X] * S[None, :]) @ \
-            self.eigenfunctions[Xp].T  # shape (n,n)
+    def prepare_batch(self, batch):
+        """ Gather the eigenfunction rows of the training nodes once, so that
+            they enter the model as constants instead of being re-indexed
+            at every leapfrog step. """
+        if 'phi' in batch:
+            return batch
+        batch = dict(batch)
+        batch['phi'] = self.eigenfunctions[batch['X'].ravel().astype(int)]
+        return batch
+
+    def eval_K(self, phi, phip, S):
+        """ Compute the matrix K(X, X') from the eigenfunction rows
+            phi = eigenfunctions[X] and phip = eigenfunctions[X']. """
+        K = (phi * S[None, :]) @ phip.T  # shape (n,n)
         return K/self.norm_const
 
+    def eval_K_diag(self, phi, S):
+        """ Compute the diagonal of K(X, X) from phi = eigenfunctions[X]. """
+        return (phi**2 * S[None, :]).sum(1)/self.norm_const
+
+    def correlation(self, X_cand, x, **kwargs):
+        """ Correlation of the candidate vertices with the vertex x under the
+            prior kernel averaged over the posterior samples, a spectral
+            (geodesic-aware) similarity on the mesh. """
+        bounds = kwargs['bounds']
+        X_cand = (X_cand - bounds['lb'])/(bounds['ub'] - bounds['lb'])
+        x = (x - bounds['lb'])/(bounds['ub'] - bounds['lb'])
+        samples = kwargs['samples']
+        S = np.mean(vmap(self.eval_S)(samples['kernel_length'], samples['kernel_var']), axis=0)
+        phi = self.eigenfunctions[X_cand.ravel().astype(int)]
+        phi_x = self.eigenfunctions[x.ravel().astype(int)]
+        k = self.eval_K(phi, phi_x, S)[:,0]
+        return k/np.sqrt(self.eval_K_diag(phi, S)*self.eval_K_diag(phi_x, S))
+
     def eval_S(self, kappa, sigma_f):
         """ Compute spectral density. """
         d = self.nu + 0.5 * self.dim
@@ -235,32 +837,35 @@ class ReimannianGPclassifier(MCMCGPmodel):
         S *= sigma_f
         return S
 
-    @partial(jit, static_argnums=(0,))
-    def posterior_sample(self, key, sample, X_star, **kwargs):
+    def conditional(self, sample, X_star, **kwargs):
         X_star = X_star.ravel().astype(int)
-        MAP = kwargs.get('MAP', False)
+        phi_star = self.eigenfunctions[X_star]
         # Fetch training data
-        batch = kwargs['batch']
-        X = batch['X']
+        batch = self.prepare_batch(kwargs['batch'])
+        X, phi = batch['X'], batch['phi']
         # Fetch params
         var = sample['kernel_var']
         length = sample['kernel_length']
         beta = sample['beta']
         eta = sample['eta']
         S = self.eval_S(length, var)
-        K = self.eval_K(X, X, S) + np.eye(X.shape[0])*1e-8
+        K = self.eval_K(phi, phi, S) + np.eye(X.shape[0])*1e-8
         L = cholesky(K, lower=True)
         # Compute kernels
         #X_all = np.arange(self.eigenfunctions.shape[0])
-        k_pp = self.eval_K(X_star, X_star, S) + np.eye(X_star.shape[0])*1e-8
-        k_pX = self.eval_K(X_star, X, S)
+        k_pp = self.eval_K_diag(phi_star, S) + 1e-8
+        k_pX = self.eval_K(phi_star, phi, S)
         f = np.matmul(L, eta) + beta
         tmp_1 = solve_triangular(L.T,solve_triangular(L, f, lower=True))
-        tmp_2  = solve_triangular(L.T,solve_triangular(L, k_pX.T, lower=True))
-        # Compute predictive mean
+        # Compute predictive mean, std
         mu = np.matmul(k_pX, tmp_1)
-        cov = k_pp - np.matmul(k_pX, tmp_2)
-        std = np.sqrt(np.clip(np.diag(cov), a_min=0.))
+        std = self.posterior_cov(k_pp, k_pX, L, False)
+        return mu, std
+
+    @partial(jit, static_argnums=(0,))
+    def posterior_sample(self, key, sample, X_star, **kwargs):
+        MAP = kwargs.get('MAP', False)
+        mu, std = self.conditional(sample, X_star, **kwargs)
         sample = mu + std * random.normal(key, mu.shape)
         if MAP:
             return mu, std
@@ -279,7 +884,9 @@ class ReimannianMFGPclassifier(MCMCGPmodel):
         self.norm_const = np.average((Sn[None,:]*self.eigenfunctions**2).sum(1))
 
     def model(self, batch):
+        batch = self.prepare_batch(batch)
         XL, XH = batch['XL'], batch['XH']
+        phi_L, phi_H = batch['phi_L'], batch['phi_H']
         y = batch['y']
         NL, NH = XL.shape[0], XH.shape[0]
         D = 1
@@ -296,9 +903,9 @@ class ReimannianMFGPclassifier(MCMCGPmodel):
         S_L = self.eval_S(length_L, var_L)
         S_H = self.eval_S(length_H, var_H)
         
-        K_LL = self.eval_K(XL, XL, S_L) + np.eye(NL)*1e-8
-        K_LH = rho*self.eval_K(XL, XH, S_L)
-        K_HH = rho**2*self.eval_K(XH, XH, S_L) + self.eval_K(XH, XH, S_H) + np.eye(NH)*1e-8
+        K_LL = self.eval_K(phi_L, phi_L, S_L) + np.eye(NL)*1e-8
+        K_LH = rho*self.eval_K(phi_L, phi_H, S_L)
+        K_HH = rho**2*self.eval_K(phi_H, phi_H, S_L) + self.eval_K(phi_H, phi_H, S_H) + np.eye(NH)*1e-8
         
         K = np.vstack((np.hstack((K_LL,K_LH)),
                        np.hstack((K_LH.T,K_HH))))
@@ -315,12 +922,42 @@ class ReimannianMFGPclassifier(MCMCGPmodel):
         # Bernoulli likelihood
         sample('y', dist.Bernoulli(logits=f), obs=y)
         
-    def eval_K(self, X, Xp, S):
-        """ Compute the matrix K(X, X). """
-        K = (self.eigenfunctions[X] * S[None, :]) @ \
-            self.eigenfunctions[Xp].T  # shape (n,n)
+    def prepare_batch(self, batch):
+        """ Gather the eigenfunction rows of the low and high fidelity
+            training nodes once (see ReimannianGPclassifier.prepare_batch). """
+        if 'phi_L' in batch:
+            return batch
+        batch = dict(batch)
+        batch['phi_L'] = self.eigenfunctions[batch['XL'].ravel().astype(int)]
+        batch['phi_H'] = self.eigenfunctions[batch['XH'].ravel().astype(int)]
+        return batch
+
+    def eval_K(self, phi, phip, S):
+        """ Compute the matrix K(X, X') from the eigenfunction rows
+            phi = eigenfunctions[X] and phip = eigenfunctions[X']. """
+        K = (phi * S[None, :]) @ phip.T  # shape (n,n)
         return K/self.norm_const
 
+    def eval_K_diag(self, phi, S):
+        """ Compute the diagonal of K(X, X) from phi = eigenfunctions[X]. """
+        return (phi**2 * S[None, :]).sum(1)/self.norm_const
+
+    def correlation(self, X_cand, x, **kwargs):
+        """ Correlation of the candidate vertices with the vertex x under the
+            high fidelity prior kernel (rho^2 k_L + k_H) averaged over the
+            posterior samples. """
+        bounds = kwargs['bounds']
+        X_cand = (X_cand - bounds['lb'])/(bounds['ub'] - bounds['lb'])
+        x = (x - bounds['lb'])/(bounds['ub'] - bounds['lb'])
+        samples = kwargs['samples']
+        S_L = vmap(self.eval_S)(samples['kernel_length_L'], samples['kernel_var_L'])
+        S_H = vmap(self.eval_S)(samples['kernel_length_H'], samples['kernel_var_H'])
+        S = np.mean(samples['rho']**2*S_L + S_H, axis=0)
+        phi = self.eigenfunctions[X_cand.ravel().astype(int)]
+        phi_x = self.eigenfunctions[x.ravel().astype(int)]
+        k = self.eval_K(phi, phi_x, S)[:,0]
+        return k/np.sqrt(self.eval_K_diag(phi, S)*self.eval_K_diag(phi_x, S))
+
     def eval_S(self, kappa, sigma_f):
         """ Compute spectral density. """
         d = self.nu + 0.5 * self.dim
@@ -330,13 +967,13 @@ class ReimannianMFGPclassifier(MCMCGPmodel):
         S *= sigma_f
         return S
 
-    @partial(jit, static_argnums=(0,))
-    def posterior_sample(self, key, sample, X_star, **kwargs):
+    def conditional(self, sample, X_star, **kwargs):
         X_star = X_star.ravel().astype(int)
-        MAP = kwargs.get('MAP', False)
+        phi_star = self.eigenfunctions[X_star]
         # Fetch training data
-        batch = kwargs['batch']
+        batch = self.prepare_batch(kwargs['batch'])
         XL, XH = batch['XL'], batch['XH']
+        phi_L, phi_H = batch['phi_L'], batch['phi_H']
         NL, NH = XL.shape[0], XH.shape[0]
         # Fetch params
         var_L = sample['kernel_var_L']
@@ -356,17 +993,16 @@ class ReimannianMFGPclassifier(MCMCGPmodel):
         S_L = self.eval_S(length_L, var_L)
         S_H = self.eval_S(length_H, var_H)
         
-        k_pp = rho**2 * self.eval_K(X_star, X_star, S_L) + \
-                        self.eval_K(X_star, X_star, S_H) + \
-                        np.eye(X_star.shape[0])*1e-8
-        psi1 = rho*self.eval_K(X_star, XL, S_L)
-        psi2 = rho**2 * self.eval_K(X_star, XH, S_L) + \
-                        self.eval_K(X_star, XH, S_H)
+        k_pp = rho**2 * self.eval_K_diag(phi_star, S_L) + \
+                        self.eval_K_diag(phi_star, S_H) + 1e-8
+        psi1 = rho*self.eval_K(phi_star, phi_L, S_L)
+        psi2 = rho**2 * self.eval_K(phi_star, phi_H, S_L) + \
+                        self.eval_K(phi_star, phi_H, S_H)
         k_pX = np.hstack((psi1,psi2))
         # Compute K_xx
-        K_LL = self.eval_K(XL, XL, S_L) + np.eye(NL)*1e-8
-        K_LH = rho*self.eval_K(XL, XH, S_L)
-        K_HH = rho**2*self.eval_K(XH, XH, S_L) + self.eval_K(XH, XH, S_H) + np.eye(NH)*1e-8
+        K_LL = self.eval_K(phi_L, phi_L, S_L) + np.eye(NL)*1e-8
+        K_LH = rho*self.eval_K(phi_L, phi_H, S_L)
+        K_HH = rho**2*self.eval_K(phi_H, phi_H, S_L) + self.eval_K(phi_H, phi_H, S_H) + np.eye(NH)*1e-8
         
         K_xx = np.vstack((np.hstack((K_LL,K_LH)),
                        np.hstack((K_LH.T,K_HH))))
@@ -374,11 +1010,15 @@ class ReimannianMFGPclassifier(MCMCGPmodel):
         # Sample latent function
         f = np.matmul(L, eta) + beta
         tmp_1 = solve_triangular(L.T,solve_triangular(L, f, lower=True))
-        tmp_2  = solve_triangular(L.T,solve_triangular(L, k_pX.T, lower=True))
-        # Compute predictive mean
+        # Compute predictive mean, std
         mu = np.matmul(k_pX, tmp_1)
-        cov = k_pp - np.matmul(k_pX, tmp_2)
-        std = np.sqrt(np.clip(np.diag(cov), a_min=0.))
+        std = self.posterior_cov(k_pp, k_pX, L, False)
+        return mu, std
+
+    @partial(jit, static_argnums=(0,))
+    def posterior_sample(self, key, sample, X_star, **kwargs):
+        MAP = kwargs.get('MAP', False)
+        mu, std = self.conditional(sample, X_star, **kwargs)
         sample = mu + std * random.normal(key, mu.shape)
         if MAP:
             return mu, std
@@ -387,18 +1027,22 @@ class ReimannianMFGPclassifier(MCMCGPmodel):
 
 class ReimannianGPclassifierFourier(MCMCGPmodel):
     # Initialize the class
-    def __init__(self, options, eigenpairs, dim = 2, nu = 3/2):
+    def __init__(self, options, eigenpairs, dim = 2, nu = 3/2, collapsed = False):
         super().__init__(options)
         self.eigenvalues, self.eigenfunctions = eigenpairs
         self.eigenfunctions = self.eigenfunctions.T
         self.n_eig = self.eigenvalues.shape[0]
         self.dim = dim
         self.nu = nu
+        # Sample whitened latent values at the training nodes instead of the
+        # spectral weights; the weights are recovered when predicting
+        self.collapsed = collapsed
         Sn = self.eval_S(1.0,1.0)
         self.norm_const = np.average((Sn[None,:]*self.eigenfunctions**2).sum(1))
 
     def model(self, batch):
-        X = batch['X']
+        batch = self.prepare_batch(batch)
+        X, phi = batch['X'], batch['phi']
         y = batch['y']
         N = X.shape[0]
         D = 1
@@ -411,18 +1055,50 @@ class ReimannianGPclassifierFourier(MCMCGPmodel):
       #  L = cholesky(K, lower=True)
         # Generate latent function
         beta = sample('beta', dist.Normal(0.0, 1.0))
-        ws = sample('ws', dist.Normal(0.0, 1.0), sample_shape=(self.n_eig,))
-        
-        f = np.dot(self.eigenfunctions[X],ws*np.sqrt(S)) + beta
+        if self.collapsed:
+            A = self.features(phi, S)
+            L = cholesky(np.matmul(A, A.T) + np.eye(N)*1e-8, lower=True)
+            eta = sample('eta', dist.Normal(0.0, 1.0), sample_shape=(N,))
+            f = np.matmul(L, eta) + beta
+        else:
+            ws = sample('ws', dist.Normal(0.0, 1.0), sample_shape=(self.n_eig,))
+            f = np.dot(phi,ws*np.sqrt(S)) + beta
         # Bernoulli likelihood
         sample('y', dist.Bernoulli(logits=f), obs=y)
         
-    def eval_K(self, X, Xp, S):
-        """ Compute the matrix K(X, X). """
-        K = (self.eigenfunctions[X] * S[None, :]) @ \
-            self.eigenfunctions[Xp].T  # shape (n,n)
+    def prepare_batch(self, batch):
+        """ Gather the eigenfunction rows of the training nodes once
+            (see ReimannianGPclassifier.prepare_batch). """
+        if 'phi' in batch:
+            return batch
+        batch = dict(batch)
+        batch['phi'] = self.eigenfunctions[batch['X'].ravel().astype(int)]
+        return batch
+
+    def eval_K(self, phi, phip, S):
+        """ Compute the matrix K(X, X') from the eigenfunction rows
+            phi = eigenfunctions[X] and phip = eigenfunctions[X']. """
+        K = (phi * S[None, :]) @ phip.T  # shape (n,n)
         return K/self.norm_const
 
+    def eval_K_diag(self, phi, S):
+        """ Compute the diagonal of K(X, X) from phi = eigenfunctions[X]. """
+        return (phi**2 * S[None, :]).sum(1)/self.norm_const
+
+    def correlation(self, X_cand, x, **kwargs):
+        """ Correlation of the candidate vertices with the vertex x under the
+            prior kernel averaged over the posterior samples, a spectral
+            (geodesic-aware) similarity on the mesh. """
+        bounds = kwargs['bounds']
+        X_cand = (X_cand - bounds['lb'])/(bounds['ub'] - bounds['lb'])
+        x = (x - bounds['lb'])/(bounds['ub'] - bounds['lb'])
+        samples = kwargs['samples']
+        S = np.mean(vmap(self.eval_S)(samples['kernel_length'], samples['kernel_var']), axis=0)
+        phi = self.eigenfunctions[X_cand.ravel().astype(int)]
+        phi_x = self.eigenfunctions[x.ravel().astype(int)]
+        k = self.eval_K(phi, phi_x, S)[:,0]
+        return k/np.sqrt(self.eval_K_diag(phi, S)*self.eval_K_diag(phi_x, S))
+
     def eval_S(self, kappa, sigma_f):
         """ Compute spectral density. """
         d = self.nu + 0.5 * self.dim
@@ -432,55 +1108,118 @@ class ReimannianGPclassifierFourier(MCMCGPmodel):
         S *= sigma_f
         return S
 
+    def features(self, phi, S):
+        """ Weight-space features at the nodes with eigenfunction rows phi,
+            f = features(phi, S) @ ws + beta. """
+        return phi*np.sqrt(S)[None,:]
+
+    def latent(self, sample, batch):
+        """ Latent function at the training nodes for a posterior sample. """
+        phi = self.prepare_batch(batch)['phi']
+        S = self.eval_S(sample['kernel_length'], sample['kernel_var'])
+        A = self.features(phi, S)
+        if self.collapsed:
+            L = cholesky(np.matmul(A, A.T) + np.eye(phi.shape[0])*1e-8, lower=True)
+            return np.matmul(L, sample['eta']) + sample['beta']
+        return np.matmul(A, sample['ws']) + sample['beta']
+
     @partial(jit, static_argnums=(0,))
-    def conditional(self, sample, X_star, **kwargs):
+    def spectral_weights(self, samples, rng_key, batch):
+        """ Draw the spectral weights ws of a collapsed model given the latent
+            values at the training nodes (Matheron's rule: a prior draw of ws
+            corrected by the residual at the training nodes). """
+        phi = self.prepare_batch(batch)['phi']
+        def draw(key, sample):
+            S = self.eval_S(sample['kernel_length'], sample['kernel_var'])
+            A = self.features(phi, S)
+            L = cholesky(np.matmul(A, A.T) + np.eye(phi.shape[0])*1e-8, lower=True)
+            z = random.normal(key, (self.n_eig,))
+            r = np.matmul(L, sample['eta']) - np.matmul(A, z)
+            return z + np.matmul(A.T, solve_triangular(L.T, solve_triangular(L, r, lower=True)))
+        keys = random.split(rng_key, tree_leaves(samples)[0].shape[0])
+        samples = dict(samples)
+        samples['ws'] = vmap(draw)(keys, samples)
+        return samples
+
+    def conditional(self, sample, X_star, full_cov = False, **kwargs):
         X_star = X_star.ravel().astype(int)
+        phi_star = self.eigenfunctions[X_star]
         # Fetch training data
-        batch = kwargs['batch']
-        X = batch['X']
+        batch = self.prepare_batch(kwargs['batch'])
+        X, phi = batch['X'], batch['phi']
         # Fetch params
         var = sample['kernel_var']
         length = sample['kernel_length']
-        beta = sample['beta']
-      #  eta = sample['eta']
-        ws = sample['ws']
         S = self.eval_S(length, var)
-        K = self.eval_K(X, X, S) + np.eye(X.shape[0])*1e-8
+        K = self.eval_K(phi, phi, S) + np.eye(X.shape[0])*1e-8
         L = cholesky(K, lower=True)
         # Compute kernels
         #X_all = np.arange(self.eigenfunctions.shape[0])
-        k_pp = self.eval_K(X_star, X_star, S) + np.eye(X_star.shape[0])*1e-8
-        k_pX = self.eval_K(X_star, X, S)
-       # f = np.matmul(L, eta) + beta
-        f = np.dot(self.eigenfunctions[X],ws*np.sqrt(S)) + beta
+        if full_cov:
+            k_pp = self.eval_K(phi_star, phi_star, S) + np.eye(X_star.shape[0])*1e-8
+        else:
+            k_pp = self.eval_K_diag(phi_star, S) + 1e-8
+        k_pX = self.eval_K(phi_star, phi, S)
+        f = self.latent(sample, batch)
         tmp_1 = solve_triangular(L.T,solve_triangular(L, f, lower=True))
-        tmp_2  = solve_triangular(L.T,solve_triangular(L, k_pX.T, lower=True))
-        # Compute predictive mean
+        # Compute predictive mean, std (covariance if full_cov)
         mu = np.matmul(k_pX, tmp_1)
-        cov = k_pp - np.matmul(k_pX, tmp_2)
-        std = np.sqrt(np.clip(np.diag(cov), a_min=0.))
+        std = self.posterior_cov(k_pp, k_pX, L, full_cov)
         return mu, std
     @partial(jit, static_argnums=(0,))
     def posterior_sample(self, key, sample, X_star, **kwargs): 
         mu, std = self.conditional(sample, X_star, **kwargs)
         sample = mu + std * random.normal(key, mu.shape)
         return mu, sample
-    
+
+    @partial(jit, static_argnums=(0,))
+    def latent_field(self, samples, X_star = None):
+        """ Latent function at the vertices X_star (all vertices by default)
+            for every posterior sample, evaluated in weight space. """
+        phi = self.eigenfunctions if X_star is None else \
+              self.eigenfunctions[X_star.ravel().astype(int)]
+        S = vmap(self.eval_S)(samples['kernel_length'], samples['kernel_var'])
+        W = samples['ws']*np.sqrt(S)
+        # (num_samples, n_eig) x (n_eig, n_nodes)
+        return np.matmul(W, phi.T) + samples['beta'][:,None]
+
+    @partial(jit, static_argnums=(0,))
+    def predict_field(self, X_star = None, **kwargs):
+        """ Posterior mean and standard deviation of the latent function
+            from the sampled weights. Cost is linear in the number of
+            vertices and needs no Cholesky factorization. Collapsed models
+            first draw the weights with spectral_weights. The standard
+            deviation is taken across the posterior samples of the field,
+            i.e. it is the total posterior uncertainty of the latent
+            function, not the root mean square of the per-sample
+            conditional standard deviations of predict_conditional (which
+            leaves out the spread of the conditional means). """
+        samples = kwargs['samples']
+        if self.collapsed:
+            samples = self.spectral_weights(samples, kwargs['rng_key'], kwargs['batch'])
+        F = self.latent_field(samples, X_star)
+        return np.mean(F, axis=0), np.std(F, axis=0)
+
 
 class ReimannianMFGPclassifierFourier(MCMCGPmodel):
     # Initialize the class
-    def __init__(self, options, eigenpairs, dim = 2, nu = 3/2):
+    def __init__(self, options, eigenpairs, dim = 2, nu = 3/2, collapsed = False):
         super().__init__(options)
         self.eigenvalues, self.eigenfunctions = eigenpairs
         self.eigenfunctions = self.eigenfunctions.T
         self.n_eig = self.eigenvalues.shape[0]
         self.dim = dim
         self.nu = nu
+        # Sample whitened latent values at the training nodes instead of the
+        # spectral weights; the weights are recovered when predicting
+        self.collapsed = collapsed
         Sn = self.eval_S(1.0,1.0)
         self.norm_const = np.average((Sn[None,:]*self.eigenfunctions**2).sum(1))
 
     def model(self, batch):
+        batch = self.prepare_batch(batch)
         XL, XH = batch['XL'], batch['XH']
+        phi_L, phi_H = batch['phi_L'], batch['phi_H']
         y = batch['y']
         NL, NH = XL.shape[0], XH.shape[0]
         D = 1
@@ -500,23 +1239,60 @@ class ReimannianMFGPclassifierFourier(MCMCGPmodel):
         # Generate latent function
         beta_L = sample('beta_L', dist.Normal(0.0, 1.0))
         beta_H = sample('beta_H', dist.Normal(0.0, 1.0))
-        ws_L = sample('ws_L', dist.Normal(0.0, 1.0), sample_shape=(self.n_eig,))
-        ws_H = sample('ws_H', dist.Normal(0.0, 1.0), sample_shape=(self.n_eig,))
-        
-        
-        f_L = np.dot(self.eigenfunctions[XL],ws_L*np.sqrt(S_L)) + beta_L
-        f_H = rho*np.dot(self.eigenfunctions[XH],ws_L*np.sqrt(S_L)) + \
-                  np.dot(self.eigenfunctions[XH],ws_H*np.sqrt(S_H)) + beta_H
-        f = deterministic('f',np.concatenate([f_L, f_H]))
+        if self.collapsed:
+            B = self.features(phi_L, phi_H, S_L, S_H, rho)
+            L = cholesky(np.matmul(B, B.T) + np.eye(NL+NH)*1e-8, lower=True)
+            eta_L = sample('eta_L', dist.Normal(0.0, 1.0), sample_shape=(NL,))
+            eta_H = sample('eta_H', dist.Normal(0.0, 1.0), sample_shape=(NH,))
+            beta = np.concatenate([beta_L*np.ones(NL), beta_H*np.ones(NH)])
+            eta = np.concatenate([eta_L, eta_H])
+            f = deterministic('f', np.matmul(L, eta) + beta)
+        else:
+            ws_L = sample('ws_L', dist.Normal(0.0, 1.0), sample_shape=(self.n_eig,))
+            ws_H = sample('ws_H', dist.Normal(0.0, 1.0), sample_shape=(self.n_eig,))
+            f_L = np.dot(phi_L,ws_L*np.sqrt(S_L)) + beta_L
+            f_H = rho*np.dot(phi_H,ws_L*np.sqrt(S_L)) + \
+                      np.dot(phi_H,ws_H*np.sqrt(S_H)) + beta_H
+            f = deterministic('f',np.concatenate([f_L, f_H]))
         # Bernoulli likelihood
         y = sample('y', dist.Bernoulli(logits=f), obs=y)
         
-    def eval_K(self, X, Xp, S):
-        """ Compute the matrix K(X, X). """
-        K = (self.eigenfunctions[X] * S[None, :]) @ \
-            self.eigenfunctions[Xp].T  # shape (n,n)
+    def prepare_batch(self, batch):
+        """ Gather the eigenfunction rows of the low and high fidelity
+            training nodes once (see ReimannianGPclassifier.prepare_batch). """
+        if 'phi_L' in batch:
+            return batch
+        batch = dict(batch)
+        batch['phi_L'] = self.eigenfunctions[batch['XL'].ravel().astype(int)]
+        batch['phi_H'] = self.eigenfunctions[batch['XH'].ravel().astype(int)]
+        return batch
+
+    def eval_K(self, phi, phip, S):
+        """ Compute the matrix K(X, X') from the eigenfunction rows
+            phi = eigenfunctions[X] and phip = eigenfunctions[X']. """
+        K = (phi * S[None, :]) @ phip.T  # shape (n,n)
         return K/self.norm_const
 
+    def eval_K_diag(self, phi, S):
+        """ Compute the diagonal of K(X, X) from phi = eigenfunctions[X]. """
+        return (phi**2 * S[None, :]).sum(1)/self.norm_const
+
+    def correlation(self, X_cand, x, **kwargs):
+        """ Correlation of the candidate vertices with the vertex x under the
+            high fidelity prior kernel (rho^2 k_L + k_H) averaged over the
+            posterior samples. """
+        bounds = kwargs['bounds']
+        X_cand = (X_cand - bounds['lb'])/(bounds['ub'] - bounds['lb'])
+        x = (x - bounds['lb'])/(bounds['ub'] - bounds['lb'])
+        samples = kwargs['samples']
+        S_L = vmap(self.eval_S)(samples['kernel_length_L'], samples['kernel_var_L'])
+        S_H = vmap(self.eval_S)(samples['kernel_length_H'], samples['kernel_var_H'])
+        S = np.mean(samples['rho']**2*S_L + S_H, axis=0)
+        phi = self.eigenfunctions[X_cand.ravel().astype(int)]
+        phi_x = self.eigenfunctions[x.ravel().astype(int)]
+        k = self.eval_K(phi, phi_x, S)[:,0]
+        return k/np.sqrt(self.eval_K_diag(phi, S)*self.eval_K_diag(phi_x, S))
+
     def eval_S(self, kappa, sigma_f):
         """ Compute spectral density. """
         d = self.nu + 0.5 * self.dim
@@ -526,22 +1302,63 @@ class ReimannianMFGPclassifierFourier(MCMCGPmodel):
         S *= sigma_f
         return S
 
+    def features(self, phi_L, phi_H, S_L, S_H, rho):
+        """ Weight-space features of the stacked low and high fidelity
+            training nodes, f = features @ [ws_L, ws_H] + beta. """
+        A_L = phi_L*np.sqrt(S_L)[None,:]
+        A_HL = rho*phi_H*np.sqrt(S_L)[None,:]
+        A_H = phi_H*np.sqrt(S_H)[None,:]
+        return np.vstack((np.hstack((A_L, np.zeros_like(A_L))),
+                          np.hstack((A_HL, A_H))))
+
+    def latent(self, sample, batch):
+        """ Latent function at the stacked training nodes for a posterior sample. """
+        batch = self.prepare_batch(batch)
+        phi_L, phi_H = batch['phi_L'], batch['phi_H']
+        NL, NH = phi_L.shape[0], phi_H.shape[0]
+        S_L = self.eval_S(sample['kernel_length_L'], sample['kernel_var_L'])
+        S_H = self.eval_S(sample['kernel_length_H'], sample['kernel_var_H'])
+        B = self.features(phi_L, phi_H, S_L, S_H, sample['rho'])
+        beta = np.concatenate([sample['beta_L']*np.ones(NL), sample['beta_H']*np.ones(NH)])
+        if self.collapsed:
+            L = cholesky(np.matmul(B, B.T) + np.eye(NL+NH)*1e-8, lower=True)
+            return np.matmul(L, np.concatenate([sample['eta_L'], sample['eta_H']])) + beta
+        return np.matmul(B, np.concatenate([sample['ws_L'], sample['ws_H']])) + beta
+
     @partial(jit, static_argnums=(0,))
-    def conditional(self, sample, X_star, **kwargs):
+    def spectral_weights(self, samples, rng_key, batch):
+        """ Draw the spectral weights ws_L, ws_H of a collapsed model given the
+            latent values at the training nodes (Matheron's rule). """
+        batch = self.prepare_batch(batch)
+        phi_L, phi_H = batch['phi_L'], batch['phi_H']
+        def draw(key, sample):
+            S_L = self.eval_S(sample['kernel_length_L'], sample['kernel_var_L'])
+            S_H = self.eval_S(sample['kernel_length_H'], sample['kernel_var_H'])
+            B = self.features(phi_L, phi_H, S_L, S_H, sample['rho'])
+            L = cholesky(np.matmul(B, B.T) + np.eye(B.shape[0])*1e-8, lower=True)
+            z = random.normal(key, (2*self.n_eig,))
+            eta = np.concatenate([sample['eta_L'], sample['eta_H']])
+            r = np.matmul(L, eta) - np.matmul(B, z)
+            return z + np.matmul(B.T, solve_triangular(L.T, solve_triangular(L, r, lower=True)))
+        keys = random.split(rng_key, tree_leaves(samples)[0].shape[0])
+        ws = vmap(draw)(keys, samples)
+        samples = dict(samples)
+        samples['ws_L'], samples['ws_H'] = ws[:,:self.n_eig], ws[:,self.n_eig:]
+        return samples
+
+    def conditional(self, sample, X_star, full_cov = False, **kwargs):
         X_star = X_star.ravel().astype(int)
+        phi_star = self.eigenfunctions[X_star]
         # Fetch training data
-        batch = kwargs['batch']
+        batch = self.prepare_batch(kwargs['batch'])
         XL, XH = batch['XL'], batch['XH']
+        phi_L, phi_H = batch['phi_L'], batch['phi_H']
         NL, NH = XL.shape[0], XH.shape[0]
         # Fetch params
         var_L = sample['kernel_var_L']
         var_H = sample['kernel_var_H']
         length_L = sample['kernel_length_L']
         length_H = sample['kernel_length_H']
-        beta_L = sample['beta_L']
-        beta_H = sample['beta_H']
-        ws_L = sample['ws_L']
-        ws_H = sample['ws_H']
         rho = sample['rho']
         theta_L = np.concatenate([var_L, length_L])
         theta_H = np.concatenate([var_H, length_H])
@@ -550,22 +1367,23 @@ class ReimannianMFGPclassifierFourier(MCMCGPmodel):
         S_L = self.eval_S(length_L, var_L)
         S_H = self.eval_S(length_H, var_H)
         
-        f_L = np.dot(self.eigenfunctions[XL],ws_L*np.sqrt(S_L)) + beta_L
-        f_H = rho*np.dot(self.eigenfunctions[XH],ws_L*np.sqrt(S_L)) + \
-                  np.dot(self.eigenfunctions[XH],ws_H*np.sqrt(S_H)) + beta_H
-        f = np.concatenate([f_L, f_H])
+        f = self.latent(sample, batch)
         
-        k_pp = rho**2 * self.eval_K(X_star, X_star, S_L) + \
-                        self.eval_K(X_star, X_star, S_H) + \
-                        np.eye(X_star.shape[0])*1e-8
-        psi1 = rho*self.eval_K(X_star, XL, S_L)
-        psi2 = rho**2 * self.eval_K(X_star, XH, S_L) + \
-                        self.eval_K(X_star, XH, S_H)
+        if full_cov:
+            k_pp = rho**2 * self.eval_K(phi_star, phi_star, S_L) + \
+                            self.eval_K(phi_star, phi_star, S_H) + \
+                            np.eye(X_star.shape[0])*1e-8
+        else:
+            k_pp = rho**2 * self.eval_K_diag(phi_star, S_L) + \
+                            self.eval_K_diag(phi_star, S_H) + 1e-8
+        psi1 = rho*self.eval_K(phi_star, phi_L, S_L)
+        psi2 = rho**2 * self.eval_K(phi_star, phi_H, S_L) + \
+                        self.eval_K(phi_star, phi_H, S_H)
         k_pX = np.hstack((psi1,psi2))
         # Compute K_xx
-        K_LL = self.eval_K(XL, XL, S_L) + np.eye(NL)*1e-8
-        K_LH = rho*self.eval_K(XL, XH, S_L)
-        K_HH = rho**2*self.eval_K(XH, XH, S_L) + self.eval_K(XH, XH, S_H) + np.eye(NH)*1e-8
+        K_LL = self.eval_K(phi_L, phi_L, S_L) + np.eye(NL)*1e-8
+        K_LH = rho*self.eval_K(phi_L, phi_H, S_L)
+        K_HH = rho**2*self.eval_K(phi_H, phi_H, S_L) + self.eval_K(phi_H, phi_H, S_H) + np.eye(NH)*1e-8
         
         K_xx = np.vstack((np.hstack((K_LL,K_LH)),
                        np.hstack((K_LH.T,K_HH))))
@@ -573,11 +1391,9 @@ class ReimannianMFGPclassifierFourier(MCMCGPmodel):
         # Sample latent function
       #  f = np.matmul(L, eta) + beta
         tmp_1 = solve_triangular(L.T,solve_triangular(L, f, lower=True))
-        tmp_2  = solve_triangular(L.T,solve_triangular(L, k_pX.T, lower=True))
-        # Compute predictive mean
+        # Compute predictive mean, std (covariance if full_cov)
         mu = np.matmul(k_pX, tmp_1)
-        cov = k_pp - np.matmul(k_pX, tmp_2)
-        std = np.sqrt(np.clip(np.diag(cov), a_min=0.))
+        std = self.posterior_cov(k_pp, k_pX, L, full_cov)
         
         return mu, std
 
@@ -588,11 +1404,94 @@ class ReimannianMFGPclassifierFourier(MCMCGPmodel):
         return mu, sample
 
     @partial(jit, static_argnums=(0,))
-    def conditional_delta(self, sample, X_star, **kwargs):
+    def latent_field(self, samples, X_star = None):
+        """ High fidelity latent function at the vertices X_star (all
+            vertices by default) for every posterior sample, evaluated in
+            weight space. """
+        phi = self.eigenfunctions if X_star is None else \
+              self.eigenfunctions[X_star.ravel().astype(int)]
+        S_L = vmap(self.eval_S)(samples['kernel_length_L'], samples['kernel_var_L'])
+        S_H = vmap(self.eval_S)(samples['kernel_length_H'], samples['kernel_var_H'])
+        W = samples['rho']*samples['ws_L']*np.sqrt(S_L) + \
+            samples['ws_H']*np.sqrt(S_H)
+        # (num_samples, n_eig) x (n_eig, n_nodes)
+        return np.matmul(W, phi.T) + samples['beta_H'][:,None]
+
+    @partial(jit, static_argnums=(0,))
+    def predict_field(self, X_star = None, **kwargs):
+        """ Posterior mean and standard deviation of the high fidelity
+            latent function from the sampled weights. Collapsed models
+            first draw the weights with spectral_weights. As for the single
+            fidelity model, the standard deviation is taken across the
+            posterior samples of the field. """
+        samples = kwargs['samples']
+        if self.collapsed:
+            samples = self.spectral_weights(samples, kwargs['rng_key'], kwargs['batch'])
+        F = self.latent_field(samples, X_star)
+        return np.mean(F, axis=0), np.std(F, axis=0)
+
+    @partial(jit, static_argnums=(0,))
+    def fidelity_fields(self, X_cand, X_target, **kwargs):
+        """ Posterior samples of the low and high fidelity latent functions
+            at the vertices X_cand and of the high fidelity one at X_target. """
+        samples = kwargs['samples']
+        if self.collapsed:
+            samples = self.spectral_weights(samples, kwargs['rng_key'], kwargs['batch'])
+        S_L = vmap(self.eval_S)(samples['kernel_length_L'], samples['kernel_var_L'])
+        phi = self.eigenfunctions[X_cand.ravel().astype(int)]
+        F_L = np.matmul(samples['ws_L']*np.sqrt(S_L), phi.T) + samples['beta_L'][:,None]
+        return F_L, self.latent_field(samples, X_cand), self.latent_field(samples, X_target)
+
+    def compute_next_batch_fidelity(self, X_cand, q, costs, X_target = None,
+                                    available = None, **kwargs):
+        """ Greedy selection of q (vertex, fidelity) pairs by the expected
+            reduction of the integrated variance of the high fidelity latent
+            function over X_target (default: X_cand) per unit cost.
+              costs: (cost_LF, cost_HF) of one simulation
+              available: optional (2, M) boolean mask of the (LF, HF) pairs
+                         that may be picked
+            The posterior covariances come from the sampled weights, i.e.
+            from the rho, S_L and S_H samples. A label is treated as a
+            Gaussian observation of the latent function with variance
+            1/(p(1 - p)), p being the class probability (as in Laplace).
+            After each pick the samples are conditioned on it (serial
+            square-root ensemble update, mean kept). Returns the q picked
+            rows of X_cand (vertex indices, of shape (M,) or (M, 1)) and the
+            list of fidelities ('LF' or 'HF'). """
+        X_target = X_cand if X_target is None else X_target
+        M = X_cand.shape[0]
+        F_L, F_H, F_T = self.fidelity_fields(X_cand, X_target, **kwargs)
+        p = np.stack([sigmoid(F_L).mean(0), sigmoid(F_H).mean(0)])
+        noise = 1.0/(p*(1.0 - p) + 1e-6)
+        # Scaled deviations: covariances are E^T E
+        E = np.concatenate([F_L, F_H, F_T], axis=1)
+        E = (E - E.mean(0))/np.sqrt(E.shape[0] - 1.0)
+        allowed = np.ones((2, M), dtype=bool) if available is None else np.asarray(available)
+        costs = np.asarray(costs)[:,None]
+        idx, fidelities = [], []
+        for i in range(q):
+            E_obs = np.stack([E[:,:M], E[:,M:2*M]])
+            var = np.sum(E_obs**2, axis=1)
+            cov = np.einsum('st,fsm->ftm', E[:,2*M:], E_obs)
+            gain = np.sum(cov**2, axis=1)/(var + noise)/costs
+            f, j = divmod(int(np.argmax(np.where(allowed, gain, -np.inf))), M)
+            idx.append(j)
+            fidelities.append(('LF', 'HF')[f])
+            allowed = allowed.at[f, j].set(False)
+            # Condition the samples on the picked label
+            v = E_obs[f][:,j]
+            vv = np.dot(v, v)
+            alpha = (1.0 - np.sqrt(noise[f, j]/(vv + noise[f, j])))/vv
+            E = E - alpha*np.outer(v, np.matmul(v, E))
+        return X_cand[np.array(idx)], fidelities
+
+    def conditional_delta(self, sample, X_star, full_cov = False, **kwargs):
         X_star = X_star.ravel().astype(int)
+        phi_star = self.eigenfunctions[X_star]
         # Fetch training data
-        batch = kwargs['batch']
+        batch = self.prepare_batch(kwargs['batch'])
         XL, XH = batch['XL'], batch['XH']
+        phi_L, phi_H = batch['phi_L'], batch['phi_H']
         NL, NH = XL.shape[0], XH.shape[0]
         # Fetch params
         var_H = sample['kernel_var_H']
@@ -601,33 +1500,43 @@ class ReimannianMFGPclassifierFourier(MCMCGPmodel):
       #  eta = sample['eta']
         ws_H = sample['ws_H']
         S_H = self.eval_S(length_H, var_H)
-        K = self.eval_K(XH, XH, S_H) + np.eye(XH.shape[0])*1e-8
+        K = self.eval_K(phi_H, phi_H, S_H) + np.eye(XH.shape[0])*1e-8
         L = cholesky(K, lower=True)
         # Compute kernels
         #X_all = np.arange(self.eigenfunctions.shape[0])
-        k_pp = self.eval_K(X_star, X_star, S_H) + np.eye(X_star.shape[0])*1e-8
-        k_pX = self.eval_K(X_star, XH, S_H)
+        if full_cov:
+            k_pp = self.eval_K(phi_star, phi_star, S_H) + np.eye(X_star.shape[0])*1e-8
+        else:
+            k_pp = self.eval_K_diag(phi_star, S_H) + 1e-8
+        k_pX = self.eval_K(phi_star, phi_H, S_H)
        # f = np.matmul(L, eta) + beta
-        f = np.dot(self.eigenfunctions[XH],ws_H*np.sqrt(S_H)) + beta_H
+        f = np.dot(phi_H,ws_H*np.sqrt(S_H)) + beta_H
         tmp_1 = solve_triangular(L.T,solve_triangular(L, f, lower=True))
-        tmp_2  = solve_triangular(L.T,solve_triangular(L, k_pX.T, lower=True))
-        # Compute predictive mean
+        # Compute predictive mean, std (covariance if full_cov)
         mu = np.matmul(k_pX, tmp_1)
-        cov = k_pp - np.matmul(k_pX, tmp_2)
-        std = np.sqrt(np.clip(np.diag(cov), a_min=0.))
+        std = self.posterior_cov(k_pp, k_pX, L, full_cov)
 
         return mu, std
-    @partial(jit, static_argnums=(0,))
-    def predict_conditional_delta(self, X_star, **kwargs):
+    def predict_conditional_delta(self, X_star, sample_chunk = None, point_chunk = None,
+                                  max_memory = None, **kwargs):
+        chunks = self.chunk_sizes(X_star.shape[0], sample_chunk, point_chunk,
+                                  max_memory, **kwargs)
+        return self.predict_conditional_delta_tiles(X_star, *chunks, **kwargs)
+
+    @partial(jit, static_argnums=(0,2,3))
+    def predict_conditional_delta_tiles(self, X_star, sample_chunk, point_chunk, **kwargs):
         # Normalize to [0,1]
         bounds = kwargs['bounds']
         X_star = (X_star - bounds['lb'])/(bounds['ub'] - bounds['lb'])
+        # Training-data constants, shared by all samples and tiles
+        kwargs['batch'] = self.prepare_batch(kwargs['batch'])
         # Vectorized predictions
-       # rng_keys = kwargs['rng_keys']
         samples = kwargs['samples']
-        sample_fn = lambda sample: self.conditional_delta(sample, X_star, **kwargs)
-        means, stds = vmap(sample_fn)(samples)
-
+        if self.collapsed:
+            samples = self.spectral_weights(samples, kwargs['rng_key'], kwargs['batch'])
+        sample_fn = lambda sample, X: self.conditional_delta(sample, X, **kwargs)
+        means, stds = utils.map_tiles(sample_fn, (samples,), X_star,
+                                      sample_chunk, point_chunk)
         return means, stds
 # A minimal Gaussian process classification class (inherits from MCMCmodel)
 class MultifidelityGPclassifier(MCMCmodel):
@@ -669,10 +1578,8 @@ class MultifidelityGPclassifier(MCMCmodel):
         # Bernoulli likelihood
         sample('y', dist.Bernoulli(logits=f), obs=y)
 
-    @partial(jit, static_argnums=(0,))
-    def posterior_sample(self, key, sample, X_star, **kwargs):
+    def conditional(self, sample, X_star, **kwargs):
         # Fetch training data
-        MAP = kwargs.get('MAP', False)
         batch = kwargs['batch']
         XL, XH = batch['XL'], batch['XH']
         NL, NH = XL.shape[0], XH.shape[0]
@@ -691,9 +1598,8 @@ class MultifidelityGPclassifier(MCMCmodel):
         beta = np.concatenate([beta_L*np.ones(NL), beta_H*np.ones(NH)])
         eta = np.concatenate([eta_L, eta_H])
         # Compute kernels
-        k_pp = rho**2 * self.kernel(X_star, X_star, theta_L) + \
-                        self.kernel(X_star, X_star, theta_H) + \
-                        np.eye(X_star.shape[0])*1e-8
+        k_pp = rho**2 * self.prior_cov(X_star, theta_L, False) + \
+                        self.prior_cov(X_star, theta_H, False, 1e-8)
         psi1 = rho*self.kernel(X_star, XL, theta_L)
         psi2 = rho**2 * self.kernel(X_star, XH, theta_L) + \
                         self.kernel(X_star, XH, theta_H)
@@ -709,17 +1615,37 @@ class MultifidelityGPclassifier(MCMCmodel):
         # Sample latent function
         f = np.matmul(L, eta) + beta
         tmp_1 = solve_triangular(L.T,solve_triangular(L, f, lower=True))
-        tmp_2  = solve_triangular(L.T,solve_triangular(L, k_pX.T, lower=True))
-        # Compute predictive mean
+        # Compute predictive mean, std
         mu = np.matmul(k_pX, tmp_1)
-        cov = k_pp - np.matmul(k_pX, tmp_2)
-        std = np.sqrt(np.clip(np.diag(cov), a_min=0.))
+        std = self.posterior_cov(k_pp, k_pX, L, False)
+        return mu, std
+
+    @partial(jit, static_argnums=(0,))
+    def posterior_sample(self, key, sample, X_star, **kwargs):
+        MAP = kwargs.get('MAP', False)
+        mu, std = self.conditional(sample, X_star, **kwargs)
         sample = mu + std * random.normal(key, mu.shape)
         if MAP:
             return mu, std
         else:
             return mu, sample
 
+    def correlation(self, X_cand, x, **kwargs):
+        """ Correlation of the candidates with x under the high-fidelity
+            prior kernel rho^2 k_L + k_H, averaged over the posterior
+            samples. """
+        bounds = kwargs['bounds']
+        X_cand = (X_cand - bounds['lb'])/(bounds['ub'] - bounds['lb'])
+        x = (x - bounds['lb'])/(bounds['ub'] - bounds['lb'])
+        samples = kwargs['samples']
+        theta_L = np.concatenate([samples['kernel_var_L'], samples['kernel_length_L']], axis=1)
+        theta_H = np.concatenate([samples['kernel_var_H'], samples['kernel_length_H']], axis=1)
+        k_fn = lambda theta_L, theta_H, rho: rho**2*self.kernel(X_cand, x, theta_L)[:,0] + \
+                                             self.kernel(X_cand, x, theta_H)[:,0]
+        k = vmap(k_fn)(theta_L, theta_H, samples['rho'])
+        var = samples['rho'][:,0]**2*samples['kernel_var_L'][:,0] + samples['kernel_var_H'][:,0]
+        return np.mean(k, axis=0)/np.mean(var)
+
 # A minimal Gaussian process regression class (inherits from MCMCmodel)
 class BayesianMLP(MCMCmodel):
     # Initialize the class
@@ -832,15 +1758,13 @@ class MissingInputsGP(MCMCmodel):
         params = np.concatenate([np.array([var]), np.array(length), np.array([noise])])
         theta = params[:-1]
         # Compute kernels
-        k_pp = self.kernel(X_star, X_star, theta) + np.eye(X_star.shape[0])*(noise + 1e-8)
+        k_pp = self.prior_cov(X_star, theta, False, noise + 1e-8)
         k_pX = self.kernel(X_star, X, theta)
         L = self.compute_cholesky(params, batch)
         alpha = solve_triangular(L.T,solve_triangular(L, y, lower=True))
-        beta  = solve_triangular(L.T,solve_triangular(L, k_pX.T, lower=True))
         # Compute predictive mean, std
         mu = np.matmul(k_pX, alpha)
-        cov = k_pp - np.matmul(k_pX, beta)
-        std = np.sqrt(np.clip(np.diag(cov), a_min=0.))
+        std = self.posterior_cov(k_pp, k_pX, L, False)
         sample = mu + std * random.normal(key, mu.shape)
         # De-normalize
         norm_const = kwargs['norm_const']
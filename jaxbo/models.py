@@ -15,6 +15,10 @@ from jaxbo.optimizers import minimize_lbfgs
 from sklearn import mixture
 from pyDOE import lhs
 
+# Keyword arguments that size the prediction tiles of the MCMC models (see
+# MCMCmodel.chunk_sizes); they stay static when passed through jitted code
+TILE_ARGS = ('sample_chunk', 'point_chunk', 'max_memory')
+
 
 # Define a general master class
 class GPmodel():
@@ -52,6 +56,56 @@ class GPmodel():
         grads = f_vjp(np.ones_like(primals))[0]
         return primals, grads
 
+    @partial(jit, static_argnums=(0,))
+    def posterior_state(self, params, batch, norm_const):
+        """ Everything predictive needs from the training data, computed
+            once for fixed params and batch: the Cholesky factor L of the
+            training covariance, alpha = K^{-1} y, the (warped) training
+            inputs (see training_inputs), the best (lowest, normalized)
+            observed target y_best for EI and the normalization constants.
+            Passed to predict/acquisition as state (train returns it too if
+            given norm_const), a prediction only costs the cross-kernel and
+            one triangular solve. """
+        L = self.compute_cholesky(params, batch)
+        alpha = solve_triangular(L.T,solve_triangular(L, batch['y'], lower=True))
+        return {'params': params, 'L': L, 'alpha': alpha,
+                'X': self.training_inputs(params, batch),
+                'y_best': np.min(batch['y']),
+                'norm_const': norm_const}
+
+    def fetch_state(self, **kwargs):
+        """ The posterior state in kwargs['state'] if given, else the one of
+            kwargs['params'], kwargs['batch'] and kwargs['norm_const']. """
+        if 'state' in kwargs:
+            return kwargs['state']
+        return self.posterior_state(kwargs['params'], kwargs['batch'], kwargs['norm_const'])
+
+    @partial(jit, static_argnums=(0,))
+    def predict(self, X_star, **kwargs):
+        """ Predictive mean and standard deviation. Only the diagonal of the
+            predictive covariance is computed. """
+        return self.predictive(X_star, False, **kwargs)
+
+    @partial(jit, static_argnums=(0,))
+    def predict_cov(self, X_star, **kwargs):
+        """ Predictive mean and full N* x N* covariance matrix. """
+        return self.predictive(X_star, True, **kwargs)
+
+    def prior_cov(self, X_star, theta, full_cov, noise = 0.):
+        """ Compute K(X_star, X_star) + noise*I, or only its diagonal. """
+        if full_cov:
+            return self.kernel(X_star, X_star, theta) + np.eye(X_star.shape[0])*noise
+        return kernels.diag(self.kernel, X_star, theta) + noise
+
+    def posterior_cov(self, k_pp, k_pX, L, full_cov):
+        """ Compute k_pp - k_pX K^{-1} k_Xp given the Cholesky factor L of K.
+            If full_cov is False, k_pp holds only the prior variances and the
+            predictive standard deviation is returned instead. """
+        v = solve_triangular(L, k_pX.T, lower=True)
+        if full_cov:
+            return k_pp - np.matmul(v.T, v)
+        return np.sqrt(np.clip(k_pp - np.sum(v**2, axis=0), 0.))
+
     def fit_gmm(self, num_comp = 2, N_samples = 10000, **kwargs):
         bounds = kwargs['bounds']
         rng_key = kwargs['rng_key']
@@ -87,33 +141,52 @@ class GPmodel():
         clf.fit(X_train)
         return clf.weights_, clf.means_, clf.covariances_
 
-    @partial(jit, static_argnums=(0,))
+    @partial(jit, static_argnums=(0,), static_argnames=TILE_ARGS)
     def acquisition(self, x, **kwargs):
         x = x[None,:]
         mean, std = self.predict(x, **kwargs)
+        return self.criterion(mean, std, x, **kwargs)
+
+    def acquisition_batch(self, X_cand, **kwargs):
+        """ Acquisition values at all M candidates X_cand (M x D, or vertex
+            indices for the mesh models), given the fitted posterior in
+            kwargs (params or samples, batch, norm_const, ...). The training
+            covariance is factorized once, in a single call to predict,
+            rather than once per candidate as with vmap over acquisition. """
+        mean, std = self.predict(X_cand, **kwargs)
+        return self.criterion_batch(mean, std, X_cand, **kwargs)
+
+    def criterion(self, mean, std, x, **kwargs):
+        """ Acquisition value from the predictive mean and std at x. """
+        return self.criterion_batch(mean, std, x, **kwargs)[0]
+
+    def criterion_batch(self, mean, std, X, **kwargs):
+        """ Acquisition values from the predictive means and stds at X. """
         if self.options['criterion'] == 'LW-LCB':
-            weights = utils.compute_w_gmm(x, **kwargs)
-            return acquisitions.LW_LCB(mean, std, weights, kappa = self.options['kappa'])
+            weights = utils.compute_w_gmm(X, **kwargs)
+            return acquisitions.LW_LCB_batch(mean, std, weights, kappa = self.options['kappa'])
         elif self.options['criterion'] == 'LCB':
-            return acquisitions.LCB(mean, std, kappa = self.options['kappa'])
+            return acquisitions.LCB_batch(mean, std, kappa = self.options['kappa'])
         elif self.options['criterion'] == 'EI':
-            batch = kwargs['batch']
-            best = np.min(batch['y'])
-            return acquisitions.EI(mean, std, best)
+            if 'state' in kwargs:
+                best = kwargs['state']['y_best']
+            else:
+                best = np.min(kwargs['batch']['y'])
+            return acquisitions.EI_batch(mean, std, best)
         elif self.options['criterion'] == 'US':
-            return acquisitions.US(std)
+            return acquisitions.US_batch(std)
         elif self.options['criterion'] == 'LW-US':
-            weights = utils.compute_w_gmm(x, **kwargs)
-            return acquisitions.LW_US(std, weights)
+            weights = utils.compute_w_gmm(X, **kwargs)
+            return acquisitions.LW_US_batch(std, weights)
         elif self.options['criterion'] == 'CLSF':
-            return acquisitions.CLSF(mean, std, kappa = self.options['kappa'])
+            return acquisitions.CLSF_batch(mean, std, kappa = self.options['kappa'])
         elif self.options['criterion'] == 'LW_CLSF':
-            weights = utils.compute_w_gmm(x, **kwargs)
-            return acquisitions.LW_CLSF(mean, std, weights, kappa = self.options['kappa'])
+            weights = utils.compute_w_gmm(X, **kwargs)
+            return acquisitions.LW_CLSF_batch(mean, std, weights, kappa = self.options['kappa'])
         else:
             raise NotImplementedError
 
-    @partial(jit, static_argnums=(0,))
+    @partial(jit, static_argnums=(0,), static_argnames=TILE_ARGS)
     def acq_value_and_grad(self, x, **kwargs):
         fun = lambda x: self.acquisition(x, **kwargs)
         primals, f_vjp = vjp(fun, x)
@@ -146,12 +219,39 @@ class GPmodel():
         return x_new
 
     def compute_next_point_gs(self, X_cand, **kwargs):
-        fun = lambda x: self.acquisition(x, **kwargs)
-        acq = vmap(fun)(X_cand)
+        acq = self.acquisition_batch(X_cand, **kwargs)
         idx_best = np.argmin(acq)
         x_new = X_cand[idx_best:idx_best+1,:]
         return x_new
 
+    def compute_next_batch_gs(self, X_cand, q, **kwargs):
+        """ Select q distinct candidates to evaluate in parallel. The
+            predictive mean and std are computed once for all candidates;
+            after each pick the std is shrunk to std*sqrt(1 - corr^2), with
+            corr the correlation to the picked point (see correlation),
+            as after observing it with the mean kept (kriging believer), and
+            the criterion is re-evaluated. Later picks are thereby pushed
+            away from earlier ones. """
+        mean, std = self.predict(X_cand, **kwargs)
+        idx = []
+        for i in range(q):
+            acq = self.criterion_batch(mean, std, X_cand, **kwargs)
+            acq = acq.at[np.array(idx, dtype=int)].set(np.inf)
+            idx.append(int(np.argmin(acq)))
+            corr = self.correlation(X_cand, X_cand[idx[-1]:idx[-1]+1], **kwargs)
+            std = std*np.sqrt(np.maximum(1.0 - corr**2, 0.0))
+        return X_cand[np.array(idx)]
+
+    def correlation(self, X_cand, x, **kwargs):
+        """ Posterior correlation of the candidates with the point x, from
+            the 2 x 2 predictive covariance of every (candidate, x) pair.
+            The training factorization does not depend on the candidate, so
+            vmap computes it only once. Models with a cheaper closed form
+            override it. """
+        pair_cov = lambda c: self.predict_cov(np.concatenate([c[None], x]), **kwargs)[1]
+        cov = vmap(pair_cov)(X_cand)
+        return cov[:,0,1]/np.sqrt(cov[:,0,0]*cov[:,1,1])
+
 
 # A minimal Gaussian process regression class (inherits from GPmodel)
 class GP(GPmodel):
@@ -171,7 +271,7 @@ class GP(GPmodel):
         L = cholesky(K, lower=True)
         return L
 
-    def train(self, batch, rng_key, num_restarts = 10):
+    def train(self, batch, rng_key, num_restarts = 10, norm_const = None):
         # Define objective that returns NumPy arrays
         def objective(params):
             value, grads = self.likelihood_value_and_grad(params, batch)
@@ -194,32 +294,31 @@ class GP(GPmodel):
         idx_best = np.where(likelihood == bestlikelihood)
         idx_best = idx_best[0][0]
         best_params = params[idx_best,:]
-
+        if norm_const is not None:
+            return best_params, self.posterior_state(best_params, batch, norm_const)
         return best_params
 
-    @partial(jit, static_argnums=(0,))
-    def predict(self, X_star, **kwargs):
-        params = kwargs['params']
-        batch = kwargs['batch']
+    def training_inputs(self, params, batch):
+        return batch['X']
+
+    def predictive(self, X_star, full_cov, **kwargs):
+        state = self.fetch_state(**kwargs)
+        params = state['params']
         bounds = kwargs['bounds']
-        norm_const = kwargs['norm_const']
+        norm_const = state['norm_const']
         # Normalize to [0,1]
         X_star = (X_star - bounds['lb'])/(bounds['ub'] - bounds['lb'])
         # Fetch normalized training data
-        X, y = batch['X'], batch['y']
+        X = state['X']
         # Fetch params
         sigma_n = np.exp(params[-1])
         theta = np.exp(params[:-1])
         # Compute kernels
-        k_pp = self.kernel(X_star, X_star, theta) + np.eye(X_star.shape[0])*(sigma_n + 1e-8)
+        k_pp = self.prior_cov(X_star, theta, full_cov, sigma_n + 1e-8)
         k_pX = self.kernel(X_star, X, theta)
-        L = self.compute_cholesky(params, batch)
-        alpha = solve_triangular(L.T,solve_triangular(L, y, lower=True))
-        beta  = solve_triangular(L.T,solve_triangular(L, k_pX.T, lower=True))
-        # Compute predictive mean, std
-        mu = np.matmul(k_pX, alpha)
-        cov = k_pp - np.matmul(k_pX, beta)
-        std = np.sqrt(np.clip(np.diag(cov), a_min=0.))
+        # Compute predictive mean, std (covariance if full_cov)
+        mu = np.matmul(k_pX, state['alpha'])
+        std = self.posterior_cov(k_pp, k_pX, state['L'], full_cov)
         # Denormalize
         mu = mu*norm_const['sigma_y'] + norm_const['mu_y']
         std = std*norm_const['sigma_y']**2
@@ -256,7 +355,7 @@ class ManifoldGP(GPmodel):
         L = cholesky(K, lower=True)
         return L
 
-    def train(self, batch, rng_key, num_restarts = 10):
+    def train(self, batch, rng_key, num_restarts = 10, norm_const = None):
         # Define objective that returns NumPy arrays
         def objective(params):
             value, grads = self.likelihood_value_and_grad(params, batch)
@@ -282,37 +381,37 @@ class ManifoldGP(GPmodel):
         idx_best = np.where(likelihood == bestlikelihood)
         idx_best = idx_best[0][0]
         best_params = params[idx_best,:]
-
+        if norm_const is not None:
+            return best_params, self.posterior_state(best_params, batch, norm_const)
         return best_params
 
-    @partial(jit, static_argnums=(0,))
-    def predict(self, X_star, **kwargs):
-        params = kwargs['params']
-        batch = kwargs['batch']
+    def training_inputs(self, params, batch):
+        # Warp inputs
+        nn_params = self.unravel(params[self.nn_params_ids])
+        return self.net_apply(nn_params, batch['X'])
+
+    def predictive(self, X_star, full_cov, **kwargs):
+        state = self.fetch_state(**kwargs)
+        params = state['params']
         bounds = kwargs['bounds']
-        norm_const = kwargs['norm_const']
+        norm_const = state['norm_const']
         # Normalize to [0,1]
         X_star = (X_star - bounds['lb'])/(bounds['ub'] - bounds['lb'])
-        # Fetch normalized training data
-        X, y = batch['X'], batch['y']
+        # Fetch warped training data
+        X = state['X']
         # Warp inputs
         gp_params = params[self.gp_params_ids]
         nn_params = self.unravel(params[self.nn_params_ids])
-        X = self.net_apply(nn_params, X)
         X_star = self.net_apply(nn_params, X_star)
         # Fetch params
         sigma_n = np.exp(gp_params[-1])
         theta = np.exp(gp_params[:-1])
         # Compute kernels
-        k_pp = self.kernel(X_star, X_star, theta) + np.eye(X_star.shape[0])*(sigma_n + 1e-8)
+        k_pp = self.prior_cov(X_star, theta, full_cov, sigma_n + 1e-8)
         k_pX = self.kernel(X_star, X, theta)
-        L = self.compute_cholesky(params, batch)
-        alpha = solve_triangular(L.T,solve_triangular(L, y, lower=True))
-        beta  = solve_triangular(L.T,solve_triangular(L, k_pX.T, lower=True))
-        # Compute predictive mean, std
-        mu = np.matmul(k_pX, alpha)
-        cov = k_pp - np.matmul(k_pX, beta)
-        std = np.sqrt(np.clip(np.diag(cov), a_min=0.))
+        # Compute predictive mean, std (covariance if full_cov)
+        mu = np.matmul(k_pX, state['alpha'])
+        std = self.posterior_cov(k_pp, k_pX, state['L'], full_cov)
         # Denormalize
         mu = mu*norm_const['sigma_y'] + norm_const['mu_y']
         std = std*norm_const['sigma_y']**2
@@ -346,7 +445,7 @@ class MultifidelityGP(GPmodel):
         L = cholesky(K, lower=True)
         return L
 
-    def train(self, batch, rng_key, num_restarts = 10):
+    def train(self, batch, rng_key, num_restarts = 10, norm_const = None):
         # Define objective that returns NumPy arrays
         def objective(params):
             value, grads = self.likelihood_value_and_grad(params, batch)
@@ -369,21 +468,23 @@ class MultifidelityGP(GPmodel):
         idx_best = np.where(likelihood == bestlikelihood)
         idx_best = idx_best[0][0]
         best_params = params[idx_best,:]
-
+        if norm_const is not None:
+            return best_params, self.posterior_state(best_params, batch, norm_const)
         return best_params
 
-    @partial(jit, static_argnums=(0,))
-    def predict(self, X_star, **kwargs):
-        params = kwargs['params']
-        batch = kwargs['batch']
+    def training_inputs(self, params, batch):
+        return batch['XL'], batch['XH']
+
+    def predictive(self, X_star, full_cov, **kwargs):
+        state = self.fetch_state(**kwargs)
+        params = state['params']
         bounds = kwargs['bounds']
-        norm_const = kwargs['norm_const']
+        norm_const = state['norm_const']
         # Normalize to [0,1]
         X_star = (X_star - bounds['lb'])/(bounds['ub'] - bounds['lb'])
         # Fetch normalized training data
-        XL, XH = batch['XL'], batch['XH']
-        D = batch['XH'].shape[1]
-        y = batch['y']
+        XL, XH = state['X']
+        D = XH.shape[1]
         # Fetch params
         rho = params[-3]
         sigma_n_L = np.exp(params[-2])
@@ -391,20 +492,15 @@ class MultifidelityGP(GPmodel):
         theta_L = np.exp(params[:D+1])
         theta_H = np.exp(params[D+1:-3])
         # Compute kernels
-        k_pp = rho**2 * self.kernel(X_star, X_star, theta_L) + \
-                        self.kernel(X_star, X_star, theta_H) + \
-                        np.eye(X_star.shape[0])*(sigma_n_H + 1e-8)
+        k_pp = rho**2 * self.prior_cov(X_star, theta_L, full_cov) + \
+                        self.prior_cov(X_star, theta_H, full_cov, sigma_n_H + 1e-8)
         psi1 = rho*self.kernel(X_star, XL, theta_L)
         psi2 = rho**2 * self.kernel(X_star, XH, theta_L) + \
                         self.kernel(X_star, XH, theta_H)
         k_pX = np.hstack((psi1,psi2))
-        L = self.compute_cholesky(params, batch)
-        alpha = solve_triangular(L.T,solve_triangular(L, y, lower=True))
-        beta  = solve_triangular(L.T,solve_triangular(L, k_pX.T, lower=True))
-        # Compute predictive mean, std
-        mu = np.matmul(k_pX, alpha)
-        cov = k_pp - np.matmul(k_pX, beta)
-        std = np.sqrt(np.clip(np.diag(cov), a_min=0.))
+        # Compute predictive mean, std (covariance if full_cov)
+        mu = np.matmul(k_pX, state['alpha'])
+        std = self.posterior_cov(k_pp, k_pX, state['L'], full_cov)
         # Denormalize
         mu = mu*norm_const['sigma_y'] + norm_const['mu_y']
         std = std*norm_const['sigma_y']**2
@@ -445,7 +541,7 @@ class GradientGP(GPmodel):
         L = cholesky(K, lower=True)
         return L
 
-    def train(self, batch, rng_key, num_restarts = 10):
+    def train(self, batch, rng_key, num_restarts = 10, norm_const = None):
         # Define objective that returns NumPy arrays
         def objective(params):
             value, grads = self.likelihood_value_and_grad(params, batch)
@@ -469,34 +565,33 @@ class GradientGP(GPmodel):
         idx_best = np.where(likelihood == bestlikelihood)
         idx_best = idx_best[0][0]
         best_params = params[idx_best,:]
+        if norm_const is not None:
+            return best_params, self.posterior_state(best_params, batch, norm_const)
         return best_params
 
-    @partial(jit, static_argnums=(0,))
-    def predict(self, X_star, **kwargs):
-        params = kwargs['params']
-        batch = kwargs['batch']
-        norm_const = kwargs['norm_const']
+    def training_inputs(self, params, batch):
+        return batch['XF'], batch['XG']
+
+    def predictive(self, X_star, full_cov, **kwargs):
+        state = self.fetch_state(**kwargs)
+        params = state['params']
+        norm_const = state['norm_const']
         # (do not Normalize!)
         # X_star = (X_star - norm_const['mu_X'])/norm_const['sigma_X']
         # Fetch training data
-        XF, XG = batch['XF'], batch['XG']
-        y = batch['y']
+        XF, XG = state['X']
         # Fetch params
         sigma_n_F = np.exp(params[-2])
         sigma_n_G = np.exp(params[-1])
         theta = np.exp(params[:-2])
         # Compute kernels
-        k_pp = self.kernel(X_star, X_star, theta) + np.eye(X_star.shape[0])*(sigma_n_F + 1e-8)
+        k_pp = self.prior_cov(X_star, theta, full_cov, sigma_n_F + 1e-8)
         psi1 = self.kernel(X_star, XF, theta)
         psi2 = self.k_dx2(X_star, XG, theta)
         k_pX = np.hstack((psi1,psi2))
-        L = self.compute_cholesky(params, batch)
-        alpha = solve_triangular(L.T,solve_triangular(L, y, lower=True))
-        beta  = solve_triangular(L.T,solve_triangular(L, k_pX.T, lower=True))
-        # Compute predictive mean, std
-        mu = np.matmul(k_pX, alpha)
-        cov = k_pp - np.matmul(k_pX, beta)
-        std = np.sqrt(np.clip(np.diag(cov), a_min=0.))
+        # Compute predictive mean, std (covariance if full_cov)
+        mu = np.matmul(k_pX, state['alpha'])
+        std = self.posterior_cov(k_pp, k_pX, state['L'], full_cov)
         # Denormalize
         mu = mu*norm_const['sigma_y'] + norm_const['mu_y']
         std = std*norm_const['sigma_y']**2
@@ -535,7 +630,7 @@ class MissingInputsGP(GPmodel):
         L = cholesky(K, lower=True)
         return L
 
-    def train(self, batch, rng_key, num_restarts = 10):
+    def train(self, batch, rng_key, num_restarts = 10, norm_const = None):
         # Define objective that returns NumPy arrays
         def objective(params):
             value, grads = self.likelihood_value_and_grad(params, batch)
@@ -561,36 +656,36 @@ class MissingInputsGP(GPmodel):
         idx_best = np.where(likelihood == bestlikelihood)
         idx_best = idx_best[0][0]
         best_params = params[idx_best,:]
+        if norm_const is not None:
+            return best_params, self.posterior_state(best_params, batch, norm_const)
         return best_params
 
-    @partial(jit, static_argnums=(0,))
-    def predict(self, X_star, **kwargs):
-        params = kwargs['params']
-        batch = kwargs['batch']
+    def training_inputs(self, params, batch):
+        # Warp inputs
+        nn_params = self.unravel(params[self.nn_params_ids])
+        X = batch['X']
+        Xm = sigmoid(self.net_apply(nn_params, X[:,self.missing_dims]))
+        return index_update(X, index[:,self.missing_dims], Xm)
+
+    def predictive(self, X_star, full_cov, **kwargs):
+        state = self.fetch_state(**kwargs)
+        params = state['params']
         bounds = kwargs['bounds']
-        norm_const = kwargs['norm_const']
+        norm_const = state['norm_const']
         # Normalize to [0,1]
         X_star = (X_star - bounds['lb'])/(bounds['ub'] - bounds['lb'])
-        # Fetch normalized training data
-        X, y = batch['X'], batch['y']
-        # Warp inputs
+        # Fetch warped training data
+        X = state['X']
         gp_params = params[self.gp_params_ids]
-        nn_params = self.unravel(params[self.nn_params_ids])
-        Xm = sigmoid(self.net_apply(nn_params, X[:,self.missing_dims]))
-        X = index_update(X, index[:,self.missing_dims], Xm)
         # Fetch params
         sigma_n = np.exp(gp_params[-1])
         theta = np.exp(gp_params[:-1])
         # Compute kernels
-        k_pp = self.kernel(X_star, X_star, theta) + np.eye(X_star.shape[0])*(sigma_n + 1e-8)
+        k_pp = self.prior_cov(X_star, theta, full_cov, sigma_n + 1e-8)
         k_pX = self.kernel(X_star, X, theta)
-        L = self.compute_cholesky(params, batch)
-        alpha = solve_triangular(L.T,solve_triangular(L, y, lower=True))
-        beta  = solve_triangular(L.T,solve_triangular(L, k_pX.T, lower=True))
-        # Compute predictive mean, std
-        mu = np.matmul(k_pX, alpha)
-        cov = k_pp - np.matmul(k_pX, beta)
-        std = np.sqrt(np.clip(np.diag(cov), a_min=0.))
+        # Compute predictive mean, std (covariance if full_cov)
+        mu = np.matmul(k_pX, state['alpha'])
+        std = self.posterior_cov(k_pp, k_pX, state['L'], full_cov)
         # Denormalize
         mu = mu*norm_const['sigma_y'] + norm_const['mu_y']
         std = std*norm_const['sigma_y']**2
@@ -637,7 +732,7 @@ class DeepMultifidelityGP(GPmodel):
         L = cholesky(K, lower=True)
         return L
 
-    def train(self, batch, rng_key, num_restarts = 10):
+    def train(self, batch, rng_key, num_restarts = 10, norm_const = None):
         # Define objective that returns NumPy arrays
         def objective(params):
             value, grads = self.likelihood_value_and_grad(params, batch)
@@ -663,25 +758,27 @@ class DeepMultifidelityGP(GPmodel):
         idx_best = np.where(likelihood == bestlikelihood)
         idx_best = idx_best[0][0]
         best_params = params[idx_best,:]
-
+        if norm_const is not None:
+            return best_params, self.posterior_state(best_params, batch, norm_const)
         return best_params
 
-    @partial(jit, static_argnums=(0,))
-    def predict(self, X_star, **kwargs):
-        params = kwargs['params']
-        batch = kwargs['batch']
+    def training_inputs(self, params, batch):
+        # Warp inputs
+        nn_params = self.unravel(params[self.nn_params_ids])
+        return self.net_apply(nn_params, batch['XL']), self.net_apply(nn_params, batch['XH'])
+
+    def predictive(self, X_star, full_cov, **kwargs):
+        state = self.fetch_state(**kwargs)
+        params = state['params']
         bounds = kwargs['bounds']
-        norm_const = kwargs['norm_const']
+        norm_const = state['norm_const']
         # Normalize to [0,1]
         X_star = (X_star - bounds['lb'])/(bounds['ub'] - bounds['lb'])
-        # Fetch normalized training data
-        XL, XH = batch['XL'], batch['XH']
-        y = batch['y']
+        # Fetch warped training data
+        XL, XH = state['X']
         gp_params = params[self.gp_params_ids]
         nn_params = self.unravel(params[self.nn_params_ids])
         # Warp inputs
-        XL = self.net_apply(nn_params, XL)
-        XH = self.net_apply(nn_params, XH)
         X_star = self.net_apply(nn_params, X_star)
         D = XH.shape[1]
         # Fetch params
@@ -691,20 +788,15 @@ class DeepMultifidelityGP(GPmodel):
         theta_L = np.exp(gp_params[:D+1])
         theta_H = np.exp(gp_params[D+1:-3])
         # Compute kernels
-        k_pp = rho**2 * self.kernel(X_star, X_star, theta_L) + \
-                        self.kernel(X_star, X_star, theta_H) + \
-                        np.eye(X_star.shape[0])*(sigma_n_H + 1e-8)
+        k_pp = rho**2 * self.prior_cov(X_star, theta_L, full_cov) + \
+                        self.prior_cov(X_star, theta_H, full_cov, sigma_n_H + 1e-8)
         psi1 = rho*self.kernel(X_star, XL, theta_L)
         psi2 = rho**2 * self.kernel(X_star, XH, theta_L) + \
                         self.kernel(X_star, XH, theta_H)
         k_pX = np.hstack((psi1,psi2))
-        L = self.compute_cholesky(params, batch)
-        alpha = solve_triangular(L.T,solve_triangular(L, y, lower=True))
-        beta  = solve_triangular(L.T,solve_triangular(L, k_pX.T, lower=True))
-        # Compute predictive mean, std
-        mu = np.matmul(k_pX, alpha)
-        cov = k_pp - np.matmul(k_pX, beta)
-        std = np.sqrt(np.clip(np.diag(cov), a_min=0.))
+        # Compute predictive mean, std (covariance if full_cov)
+        mu = np.matmul(k_pX, state['alpha'])
+        std = self.posterior_cov(k_pp, k_pX, state['L'], full_cov)
         # Denormalize
         mu = mu*norm_const['sigma_y'] + norm_const['mu_y']
         std = std*norm_const['sigma_y']**2
@@ -752,7 +844,7 @@ class HeterogeneousMultifidelityGP_v2(GPmodel):
         L = cholesky(K, lower=True)
         return L
 
-    def train(self, batch, rng_key, num_restarts = 10):
+    def train(self, batch, rng_key, num_restarts = 10, norm_const = None):
         # Define objective that returns NumPy arrays
         def objective(params):
             value, grads = self.likelihood_value_and_grad(params, batch)
@@ -778,25 +870,28 @@ class HeterogeneousMultifidelityGP_v2(GPmodel):
         idx_best = np.where(likelihood == bestlikelihood)
         idx_best = idx_best[0][0]
         best_params = params[idx_best,:]
+        if norm_const is not None:
+            return best_params, self.posterior_state(best_params, batch, norm_const)
         return best_params
 
-    @partial(jit, static_argnums=(0,))
-    def predict(self, X_star, **kwargs):
-        params = kwargs['params']
-        batch = kwargs['batch']
+    def training_inputs(self, params, batch):
+        # Warp low-fidelity inputs
+        nn_params = self.unravel(params[self.nn_params_ids])
+        XL = batch['XL']
+        XL_missing = XL[:,self.missing_dims] + sigmoid(self.net_apply(nn_params, XL))
+        return index_update(XL, index[:,self.missing_dims], XL_missing), batch['XH']
+
+    def predictive(self, X_star, full_cov, **kwargs):
+        state = self.fetch_state(**kwargs)
+        params = state['params']
         bounds = kwargs['bounds']
-        norm_const = kwargs['norm_const']
+        norm_const = state['norm_const']
         # Normalize to [0,1]
         X_star = (X_star - bounds['lb'])/(bounds['ub'] - bounds['lb'])
-        # Fetch normalized training data
-        XL, XH = batch['XL'], batch['XH']
-        D = batch['XH'].shape[1]
-        y = batch['y']
-        # Warp low-fidelity inputs
+        # Fetch warped training data
+        XL, XH = state['X']
+        D = XH.shape[1]
         gp_params = params[self.gp_params_ids]
-        nn_params = self.unravel(params[self.nn_params_ids])
-        XL_missing = XL[:,self.missing_dims] + sigmoid(self.net_apply(nn_params, XL))
-        XL = index_update(XL, index[:,self.missing_dims], XL_missing)
         # Fetch params
         rho = gp_params[-3]
         sigma_n_L = np.exp(gp_params[-2])
@@ -804,20 +899,15 @@ class HeterogeneousMultifidelityGP_v2(GPmodel):
         theta_L = np.exp(gp_params[:D+1])
         theta_H = np.exp(gp_params[D+1:-3])
         # Compute kernels
-        k_pp = rho**2 * self.kernel(X_star, X_star, theta_L) + \
-                        self.kernel(X_star, X_star, theta_H) + \
-                        np.eye(X_star.shape[0])*(sigma_n_H + 1e-8)
+        k_pp = rho**2 * self.prior_cov(X_star, theta_L, full_cov) + \
+                        self.prior_cov(X_star, theta_H, full_cov, sigma_n_H + 1e-8)
         psi1 = rho*self.kernel(X_star, XL, theta_L)
         psi2 = rho**2 * self.kernel(X_star, XH, theta_L) + \
                         self.kernel(X_star, XH, theta_H)
         k_pX = np.hstack((psi1,psi2))
-        L = self.compute_cholesky(params, batch)
-        alpha = solve_triangular(L.T,solve_triangular(L, y, lower=True))
-        beta  = solve_triangular(L.T,solve_triangular(L, k_pX.T, lower=True))
-        # Compute predictive mean, std
-        mu = np.matmul(k_pX, alpha)
-        cov = k_pp - np.matmul(k_pX, beta)
-        std = np.sqrt(np.clip(np.diag(cov), a_min=0.))
+        # Compute predictive mean, std (covariance if full_cov)
+        mu = np.matmul(k_pX, state['alpha'])
+        std = self.posterior_cov(k_pp, k_pX, state['L'], full_cov)
         # Denormalize
         mu = mu*norm_const['sigma_y'] + norm_const['mu_y']
         std = std*norm_const['sigma_y']**2
@@ -872,7 +962,7 @@ class ManifoldMultifidelityGP(GPmodel):
         L = cholesky(K, lower=True)
         return L
 
-    def train(self, batch, rng_key, num_restarts = 10):
+    def train(self, batch, rng_key, num_restarts = 10, norm_const = None):
         # Define objective that returns NumPy arrays
         def objective(params):
             value, grads = self.likelihood_value_and_grad(params, batch)
@@ -901,25 +991,29 @@ class ManifoldMultifidelityGP(GPmodel):
         idx_best = np.where(likelihood == bestlikelihood)
         idx_best = idx_best[0][0]
         best_params = params[idx_best,:]
+        if norm_const is not None:
+            return best_params, self.posterior_state(best_params, batch, norm_const)
         return best_params
 
-    @partial(jit, static_argnums=(0,))
-    def predict(self, X_star, **kwargs):
-        params = kwargs['params']
-        batch = kwargs['batch']
+    def training_inputs(self, params, batch):
+        # Warp inputs to [0,1]^D_H
+        nn_L_params = self.unravel_L(params[self.nn_L_params_ids])
+        nn_H_params = self.unravel_H(params[self.nn_H_params_ids])
+        return sigmoid(self.net_L_apply(nn_L_params, batch['XL'])), \
+               sigmoid(self.net_H_apply(nn_H_params, batch['XH']))
+
+    def predictive(self, X_star, full_cov, **kwargs):
+        state = self.fetch_state(**kwargs)
+        params = state['params']
         bounds = kwargs['bounds']
-        norm_const = kwargs['norm_const']
+        norm_const = state['norm_const']
         # Normalize to [0,1]
         X_star = (X_star - bounds['lb'])/(bounds['ub'] - bounds['lb'])
-        # Fetch normalized training data
-        XL, XH = batch['XL'], batch['XH']
-        y = batch['y']
+        # Fetch warped training data
+        XL, XH = state['X']
         # Warp inputs to [0,1]^D_H
         gp_params = params[self.gp_params_ids]
-        nn_L_params = self.unravel_L(params[self.nn_L_params_ids])
         nn_H_params = self.unravel_H(params[self.nn_H_params_ids])
-        XL = sigmoid(self.net_L_apply(nn_L_params, XL))
-        XH = sigmoid(self.net_H_apply(nn_H_params, XH))
         X_star = sigmoid(self.net_H_apply(nn_H_params, X_star))
         # Fetch params
         D = self.layers_H[-1]
@@ -929,20 +1023,15 @@ class ManifoldMultifidelityGP(GPmodel):
         theta_L = np.exp(gp_params[:D+1])
         theta_H = np.exp(gp_params[D+1:-3])
         # Compute kernels
-        k_pp = rho**2 * self.kernel(X_star, X_star, theta_L) + \
-                        self.kernel(X_star, X_star, theta_H) + \
-                        np.eye(X_star.shape[0])*(sigma_n_H + 1e-8)
+        k_pp = rho**2 * self.prior_cov(X_star, theta_L, full_cov) + \
+                        self.prior_cov(X_star, theta_H, full_cov, sigma_n_H + 1e-8)
         psi1 = rho*self.kernel(X_star, XL, theta_L)
         psi2 = rho**2 * self.kernel(X_star, XH, theta_L) + \
                         self.kernel(X_star, XH, theta_H)
         k_pX = np.hstack((psi1,psi2))
-        L = self.compute_cholesky(params, batch)
-        alpha = solve_triangular(L.T,solve_triangular(L, y, lower=True))
-        beta  = solve_triangular(L.T,solve_triangular(L, k_pX.T, lower=True))
-        # Compute predictive mean, std
-        mu = np.matmul(k_pX, alpha)
-        cov = k_pp - np.matmul(k_pX, beta)
-        std = np.sqrt(np.clip(np.diag(cov), a_min=0.))
+        # Compute predictive mean, std (covariance if full_cov)
+        mu = np.matmul(k_pX, state['alpha'])
+        std = self.posterior_cov(k_pp, k_pX, state['L'], full_cov)
         # Denormalize
         mu = mu*norm_const['sigma_y'] + norm_const['mu_y']
         std = std*norm_const['sigma_y']**2
@@ -988,7 +1077,7 @@ class HeterogeneousMultifidelityGP(GPmodel):
         L = cholesky(K, lower=True)
         return L
 
-    def train(self, batch, rng_key, num_restarts = 10):
+    def train(self, batch, rng_key, num_restarts = 10, norm_const = None):
         # Define objective that returns NumPy arrays
         def objective(params):
             value, grads = self.likelihood_value_and_grad(params, batch)
@@ -1015,25 +1104,26 @@ class HeterogeneousMultifidelityGP(GPmodel):
         idx_best = np.where(likelihood == bestlikelihood)
         idx_best = idx_best[0][0]
         best_params = params[idx_best,:]
-
+        if norm_const is not None:
+            return best_params, self.posterior_state(best_params, batch, norm_const)
         return best_params
 
-    @partial(jit, static_argnums=(0,))
-    def predict(self, X_star, **kwargs):
-        params = kwargs['params']
-        batch = kwargs['batch']
+    def training_inputs(self, params, batch):
+        # Warp low-fidelity inputs
+        nn_params = self.unravel(params[self.nn_params_ids])
+        return self.net_apply(nn_params, batch['XL']), batch['XH']
+
+    def predictive(self, X_star, full_cov, **kwargs):
+        state = self.fetch_state(**kwargs)
+        params = state['params']
         bounds = kwargs['bounds']
-        norm_const = kwargs['norm_const']
+        norm_const = state['norm_const']
         # Normalize to [0,1]
         X_star = (X_star - bounds['lb'])/(bounds['ub'] - bounds['lb'])
-        # Fetch normalized training data
-        XL, XH = batch['XL'], batch['XH']
-        D = batch['XH'].shape[1]
-        y = batch['y']
-        # Warp low-fidelity inputs
+        # Fetch warped training data
+        XL, XH = state['X']
+        D = XH.shape[1]
         gp_params = params[self.gp_params_ids]
-        nn_params = self.unravel(params[self.nn_params_ids])
-        XL = self.net_apply(nn_params, XL)
         # Fetch params
         rho = gp_params[-3]
         sigma_n_L = np.exp(gp_params[-2])
@@ -1041,20 +1131,15 @@ class HeterogeneousMultifidelityGP(GPmodel):
         theta_L = np.exp(gp_params[:D+1])
         theta_H = np.exp(gp_params[D+1:-3])
         # Compute kernels
-        k_pp = rho**2 * self.kernel(X_star, X_star, theta_L) + \
-                        self.kernel(X_star, X_star, theta_H) + \
-                        np.eye(X_star.shape[0])*(sigma_n_H + 1e-8)
+        k_pp = rho**2 * self.prior_cov(X_star, theta_L, full_cov) + \
+                        self.prior_cov(X_star, theta_H, full_cov, sigma_n_H + 1e-8)
         psi1 = rho*self.kernel(X_star, XL, theta_L)
         psi2 = rho**2 * self.kernel(X_star, XH, theta_L) + \
                         self.kernel(X_star, XH, theta_H)
         k_pX = np.hstack((psi1,psi2))
-        L = self.compute_cholesky(params, batch)
-        alpha = solve_triangular(L.T,solve_triangular(L, y, lower=True))
-        beta  = solve_triangular(L.T,solve_triangular(L, k_pX.T, lower=True))
-        # Compute predictive mean, std
-        mu = np.matmul(k_pX, alpha)
-        cov = k_pp - np.matmul(k_pX, beta)
-        std = np.sqrt(np.clip(np.diag(cov), a_min=0.))
+        # Compute predictive mean, std (covariance if full_cov)
+        mu = np.matmul(k_pX, state['alpha'])
+        std = self.posterior_cov(k_pp, k_pX, state['L'], full_cov)
         # Denormalize
         mu = mu*norm_const['sigma_y'] + norm_const['mu_y']
         std = std*norm_const['sigma_y']**2
@@ -1090,6 +1175,10 @@ class ReimannianGP(GPmodel):
             self.eigenfunctions[Xp].T  # shape (n,n)
         return K
 
+    def eval_K_diag(self, X, S):
+        """ Compute the diagonal of K(X, X). """
+        return (self.eigenfunctions[X]**2 * S[None, :]).sum(1)
+
     def eval_S(self, kappa, sigma_f):
         """ Compute spectral density. """
         d = self.nu + 0.5 * self.dim
@@ -1099,7 +1188,7 @@ class ReimannianGP(GPmodel):
         S *= sigma_f
         return S
 
-    def train(self, batch, rng_key, num_restarts = 10):
+    def train(self, batch, rng_key, num_restarts = 10, norm_const = None):
         # Define objective that returns NumPy arrays
         def objective(params):
             value, grads = self.likelihood_value_and_grad(params, batch)
@@ -1122,57 +1211,49 @@ class ReimannianGP(GPmodel):
         idx_best = np.where(likelihood == bestlikelihood)
         idx_best = idx_best[0][0]
         best_params = params[idx_best,:]
-
+        if norm_const is not None:
+            return best_params, self.posterior_state(best_params, batch, norm_const)
         return best_params
 
-    @partial(jit, static_argnums=(0,))
-    def predict(self, X_all, **kwargs):
-        params = kwargs['params']
-        batch = kwargs['batch']
-        norm_const = kwargs['norm_const']
+    def training_inputs(self, params, batch):
+        return batch['X']
+
+    def predictive(self, X_all, full_cov, **kwargs):
+        X_all = X_all.ravel().astype(int)
+        state = self.fetch_state(**kwargs)
+        params = state['params']
+        norm_const = state['norm_const']
         # Fetch normalized training data
-        X, y = batch['X'], batch['y']
+        X = state['X']
         # Fetch params
         sigma_f = np.exp(params[0])
         kappa = np.exp(params[1])
         sigma_n = np.exp(params[2])
         # Compute kernels
         S = self.eval_S(kappa, sigma_f)
-        k_pp = self.eval_K(X_all, X_all, S) + np.eye(X_all.shape[0])*(sigma_n + 1e-8)
+        if full_cov:
+            k_pp = self.eval_K(X_all, X_all, S) + np.eye(X_all.shape[0])*(sigma_n + 1e-8)
+        else:
+            k_pp = self.eval_K_diag(X_all, S) + sigma_n + 1e-8
         k_pX = self.eval_K(X_all, X, S) 
-        L = self.compute_cholesky(params, batch)
-        alpha = solve_triangular(L.T,solve_triangular(L, y, lower=True))
-        beta  = solve_triangular(L.T,solve_triangular(L, k_pX.T, lower=True))
-        # Compute predictive mean, std
-        mu = np.matmul(k_pX, alpha)
-        cov = k_pp - np.matmul(k_pX, beta)
-        std = np.sqrt(np.clip(np.diag(cov), a_min=0.))
+        # Compute predictive mean, std (covariance if full_cov)
+        mu = np.matmul(k_pX, state['alpha'])
+        std = self.posterior_cov(k_pp, k_pX, state['L'], full_cov)
         # Denormalize
         mu = mu*norm_const['sigma_y'] + norm_const['mu_y']
         std = std*norm_const['sigma_y']**2
         return mu, std
     
-    @partial(jit, static_argnums=(0,))
+    @partial(jit, static_argnums=(0,), static_argnames=TILE_ARGS)
     def acquisition(self, x, **kwargs):
         mean, std = self.predict(x, **kwargs)
-        if self.options['criterion'] == 'LW-LCB':
-            weights = utils.compute_w_gmm(x, **kwargs)
-            return acquisitions.LW_LCB(mean, std, weights, kappa = self.options['kappa'])
-        elif self.options['criterion'] == 'LCB':
-            return acquisitions.LCB(mean, std, kappa = self.options['kappa'])
-        elif self.options['criterion'] == 'EI':
-            batch = kwargs['batch']
-            best = np.min(batch['y'])
-            return acquisitions.EI(mean, std, best)
-        elif self.options['criterion'] == 'US':
-            return acquisitions.US(std)
-        elif self.options['criterion'] == 'LW-US':
-            weights = utils.compute_w_gmm(x, **kwargs)
-            return acquisitions.LW_US(std, weights)
-        elif self.options['criterion'] == 'CLSF':
-            return acquisitions.CLSF(mean, std, kappa = self.options['kappa'])
-        elif self.options['criterion'] == 'LW_CLSF':
-            weights = utils.compute_w_gmm(x, **kwargs)
-            return acquisitions.LW_CLSF(mean, std, weights, kappa = self.options['kappa'])
-        else:
-            raise NotImplementedError
+        return self.criterion(mean, std, x, **kwargs)
+
+    def correlation(self, X_cand, x, **kwargs):
+        """ Kernel correlation of the candidate vertices with the vertex x,
+            a spectral (geodesic-aware) similarity on the mesh. """
+        params = kwargs['state']['params'] if 'state' in kwargs else kwargs['params']
+        S = self.eval_S(np.exp(params[1]), np.exp(params[0]))
+        X_cand, x = X_cand.ravel().astype(int), x.ravel().astype(int)
+        k = self.eval_K(X_cand, x, S)[:,0]
+        return k/np.sqrt(self.eval_K_diag(X_cand, S)*self.eval_K_diag(x, S))
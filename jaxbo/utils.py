@@ -1,6 +1,7 @@
 import numpy as onp
 import jax.numpy as np
-from jax import jit, vmap
+from jax import jit, vmap, lax
+from jax.tree_util import tree_map, tree_leaves
 from jax.example_libraries import stax
 from jax.example_libraries.stax import Dense, Tanh
 from jax.nn.initializers import glorot_normal, normal
@@ -154,3 +155,66 @@ def init_NN(Q):
                   b_init=normal(dtype=np.float64)))
     net_init, net_apply = stax.serial(*layers)
     return net_init, net_apply
+
+def pad_to_multiple(x, n):
+    """ Pad the leading axis of x to a multiple of n by repeating its last entry. """
+    pad = -x.shape[0] % n
+    if pad == 0:
+        return x
+    return np.concatenate([x, np.repeat(x[-1:], pad, axis=0)], axis=0)
+
+def map_tiles(fn, per_sample, X, sample_chunk, point_chunk):
+    """ Evaluate vmap(fn)(*per_sample, X) over tiles of sample_chunk posterior
+        samples by point_chunk test points, so that only one tile is live at a
+        time. Every output of fn(*sample, X) must have shape (X.shape[0],) and
+        is returned as a (num_samples, num_points) array. """
+    num_samples = tree_leaves(per_sample)[0].shape[0]
+    num_points = X.shape[0]
+    # Pad and split samples and points into equally sized chunks
+    per_sample = tree_map(lambda x: pad_to_multiple(x, sample_chunk).reshape((-1, sample_chunk) + x.shape[1:]), per_sample)
+    X = pad_to_multiple(X, point_chunk).reshape((-1, point_chunk) + X.shape[1:])
+    def point_tile(x):
+        sample_tile = lambda args: vmap(lambda *a: fn(*a, x))(*args)
+        return lax.map(sample_tile, per_sample)
+    # Outputs have shape (num_point_chunks, num_sample_chunks, sample_chunk, point_chunk)
+    out = lax.map(point_tile, X)
+    merge = lambda y: np.transpose(y, (1, 2, 0, 3)).reshape((-1, y.shape[0]*y.shape[3]))[:num_samples, :num_points]
+    return tree_map(merge, out)
+
+def reduce_tiles(fn, update, init, per_sample, X, sample_chunk, point_chunk):
+    """ Like map_tiles, but each tile of outputs of vmap(fn)(*per_sample, X)
+        is folded into a running state, state = update(state, outputs, mask),
+        inside a scan over sample chunks. mask flags the samples of the tile
+        that are not padding. init(num_points) builds the initial state, whose
+        leaves must have the points on their leading axis. Only the final
+        state is returned, so memory does not grow with the number of samples. """
+    num_samples = tree_leaves(per_sample)[0].shape[0]
+    num_points = X.shape[0]
+    num_chunks = -(-num_samples // sample_chunk)
+    mask = (np.arange(num_chunks*sample_chunk) < num_samples).reshape((num_chunks, sample_chunk))
+    # Pad and split samples and points into equally sized chunks
+    per_sample = tree_map(lambda x: pad_to_multiple(x, sample_chunk).reshape((-1, sample_chunk) + x.shape[1:]), per_sample)
+    X = pad_to_multiple(X, point_chunk).reshape((-1, point_chunk) + X.shape[1:])
+    def point_tile(x):
+        def body(state, args):
+            tile, m = args
+            out = vmap(lambda *a: fn(*a, x))(*tile)
+            return update(state, out, m), None
+        state, _ = lax.scan(body, init(point_chunk), (per_sample, mask))
+        return state
+    out = lax.map(point_tile, X)
+    merge = lambda y: y.reshape((-1,) + y.shape[2:])[:num_points]
+    return tree_map(merge, out)
+
+def histogram_quantiles(hist, quantiles, lb = 0.0, ub = 1.0):
+    """ Quantiles from per-point histograms hist of shape (N, num_bins) with
+        equally spaced bins on [lb, ub], interpolating linearly in each bin. """
+    num_bins = hist.shape[1]
+    cdf = np.cumsum(hist, axis=1)/np.sum(hist, axis=1, keepdims=True)
+    def quantile(q):
+        idx = np.clip(np.sum(cdf < q, axis=1), 0, num_bins-1)
+        c_hi = np.take_along_axis(cdf, idx[:,None], axis=1)[:,0]
+        c_lo = np.where(idx > 0, np.take_along_axis(cdf, np.maximum(idx-1, 0)[:,None], axis=1)[:,0], 0.)
+        frac = np.clip((q - c_lo)/np.maximum(c_hi - c_lo, 1e-12), 0., 1.)
+        return lb + (ub - lb)*(idx + frac)/num_bins
+    return np.stack([quantile(q) for q in quantiles])
@@ -0,0 +1,27 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+DATA = os.path.join(ROOT, 'data')
+
+from jaxbo.Mesh import Mesh
+
+
+def grid_mesh(n = 12, bump = 0.3):
+    """ A curved, open triangulated surface z = bump*sin(x)cos(y) on an n x n
+        grid, small enough for the dense reference code. """
+    x, y = np.meshgrid(np.linspace(0., np.pi, n), np.linspace(0., np.pi, n))
+    verts = np.stack((x.ravel(), y.ravel(), bump*(np.sin(x)*np.cos(y)).ravel()), axis = 1)
+    idx = np.arange(n*n).reshape(n, n)
+    a, b, c, d = idx[:-1,:-1].ravel(), idx[:-1,1:].ravel(), idx[1:,:-1].ravel(), idx[1:,1:].ravel()
+    connectivity = np.concatenate((np.stack((a, b, d), axis = 1), np.stack((a, d, c), axis = 1)))
+    return Mesh(verts = verts, connectivity = connectivity)
+
+
+@pytest.fixture
+def mesh():
+    return grid_mesh()
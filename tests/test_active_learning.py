@@ -0,0 +1,63 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as onp
+import jax.numpy as np
+from jax import random
+import pytest
+
+from conftest import DATA
+from jaxbo.active_learning import ActiveLearner, ReplaySimulator
+
+
+class NearestModel():
+    """ A cheap model with the interface used by ActiveLearner: training
+        returns the observations and the batch picks the first candidates. """
+    def train(self, batch, rng_key, settings):
+        return {'y': np.asarray(batch['y'])}
+
+    def compute_next_batch_gs(self, X_cand, q, **kwargs):
+        return X_cand[:q]
+
+
+def test_replay_simulator_default_data_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    simulator = ReplaySimulator('70PF-PVI', 'HF')
+    points = onp.genfromtxt(os.path.join(DATA, 'train_points.csv'))[:,3].astype(int)
+    labels = onp.load(os.path.join(DATA, 'HF_train-70PF-PVI.npz'))['output']
+    assert simulator(points[3]) == float(labels[3])
+
+
+def test_checkpoint_restores_history(tmp_path):
+    X_cand = onp.arange(20)
+    simulators = {'HF': lambda x: float(x[0] % 2)}
+    checkpoint = str(tmp_path / 'run.npz')
+    learner = ActiveLearner(NearestModel(), simulators, X_cand, {}, num_workers = 2,
+                            checkpoint = checkpoint)
+    learner.add([19], 1.)
+    learner.run(4, random.PRNGKey(0))
+    assert len(learner.history) == 4
+    resumed = ActiveLearner(NearestModel(), simulators, X_cand, {}, checkpoint = checkpoint)
+    assert resumed.y == learner.y
+    assert [type(v) for v in resumed.y['HF']] == [float]*5
+    for h, r in zip(learner.history, resumed.history):
+        assert r['time'] == h['time'] and r['train_time'] == h['train_time']
+        assert r['num_obs'] == h['num_obs'] and r['num_running'] == h['num_running']
+        assert type(r['num_obs']['HF']) is int and type(r['num_running']) is int
+    assert resumed.history[-1]['num_obs'] == {'HF': 5}
+
+
+def test_run_shuts_down_pool_on_error():
+    def simulator(x):
+        raise RuntimeError('simulation failed')
+    pools = []
+    class Learner(ActiveLearner):
+        def pool(self):
+            pools.append(ThreadPoolExecutor(self.num_workers))
+            return pools[-1]
+    learner = Learner(NearestModel(), {'HF': simulator}, onp.arange(10), {})
+    learner.add([9], 0.)
+    with pytest.raises(RuntimeError):
+        learner.run(2, random.PRNGKey(0))
+    assert pools[0]._shutdown
+    assert len(learner.pending) == 2
@@ -0,0 +1,448 @@
+import numpy as onp
+import jax
+import jax.numpy as np
+from jax import random
+from jax.tree_util import tree_map
+import pytest
+
+from jaxbo.mcmc_models import GP, MultifidelityGPclassifier
+
+
+def options(criterion = 'US'):
+    return {'kernel': 'RBF', 'criterion': criterion, 'input_prior': None,
+            'kappa': 1.0, 'nIter': 0}
+
+
+def bounds(D = 2):
+    return {'lb': np.zeros(D), 'ub': np.ones(D)}
+
+
+def prior_samples(shapes, rng_key, num_samples = 32):
+    """ Stand-in posterior samples: positive kernel parameters near one
+        and standard normal latents, in the layout of MCMC.get_samples(). """
+    keys = random.split(rng_key, len(shapes))
+    samples = {}
+    for key, (name, shape) in zip(keys, shapes.items()):
+        z = random.normal(key, (num_samples,) + shape)
+        samples[name] = np.exp(0.1*z - 1.) if name.startswith(('kernel', 'noise')) else z
+    return samples
+
+
+def double(tree):
+    """ Cast the floating point leaves to double precision. """
+    return tree_map(lambda x: np.asarray(x, np.float64)
+                    if np.issubdtype(np.result_type(x), np.floating) else x, tree)
+
+
+@pytest.fixture
+def gp():
+    X = random.uniform(random.PRNGKey(0), (20, 2))
+    y = np.sin(6*X[:,0])
+    samples = prior_samples({'kernel_var': (), 'kernel_length': (2,), 'noise_var': ()},
+                            random.PRNGKey(1))
+    kwargs = {'samples': samples, 'batch': {'X': X, 'y': y}, 'bounds': bounds(),
+              'norm_const': {'mu_y': 0., 'sigma_y': 1.}, 'rng_key': random.PRNGKey(2),
+              'rng_keys': random.split(random.PRNGKey(2), 32)}
+    return GP(options()), kwargs
+
+
+@pytest.fixture
+def mf_classifier():
+    XL = random.uniform(random.PRNGKey(0), (20, 2))
+    XH = XL[:8]
+    y = np.concatenate([XL[:,0] > 0.5, XH[:,0] > 0.4]).astype(float)
+    samples = prior_samples({'kernel_var_L': (1,), 'kernel_length_L': (2,),
+                             'kernel_var_H': (1,), 'kernel_length_H': (2,),
+                             'rho': (1,), 'beta_L': (), 'beta_H': (),
+                             'eta_L': (20,), 'eta_H': (8,)}, random.PRNGKey(1))
+    kwargs = {'samples': samples, 'batch': {'XL': XL, 'XH': XH, 'y': y}, 'bounds': bounds(),
+              'rng_key': random.PRNGKey(2), 'rng_keys': random.split(random.PRNGKey(2), 32)}
+    return MultifidelityGPclassifier(options()), kwargs
+
+
+def test_compute_next_batch_gs(gp, mf_classifier):
+    X_cand = random.uniform(random.PRNGKey(3), (200, 2))
+    for model, kwargs in [gp, mf_classifier]:
+        corr = model.correlation(X_cand, X_cand[5:6], **kwargs)
+        assert corr.shape == (200,)
+        assert abs(float(corr[5]) - 1.) < 1e-5
+        assert np.all(np.abs(corr) <= 1. + 1e-5)
+        X_new = model.compute_next_batch_gs(X_cand, 4, **kwargs)
+        assert X_new.shape == (4, 2)
+        assert len({tuple(onp.asarray(x)) for x in X_new}) == 4
+
+
+def test_default_correlation(gp):
+    # The generic correlation of the sampled predictive means, used by the
+    # models without a closed form
+    from jaxbo.mcmc_models import MCMCmodel
+    model, kwargs = gp
+    X_cand = random.uniform(random.PRNGKey(3), (50, 2))
+    corr = MCMCmodel.correlation(model, X_cand, X_cand[7:8], **kwargs)
+    assert corr.shape == (50,)
+    assert abs(float(corr[7]) - 1.) < 1e-4
+    assert np.all(np.abs(corr) <= 1. + 1e-4)
+
+
+def test_laplace_reuses_compiled_fit():
+    from jaxbo.mcmc_models import GPclassifier, MCMCmodel
+    X = random.uniform(random.PRNGKey(0), (30, 2))
+    y = (X[:,0] + 0.3*X[:,1] > 0.6).astype(float)
+    model = GPclassifier(options())
+    settings = {'method': 'laplace', 'num_samples': 2000, 'num_steps': 100}
+    samples = model.train({'X': X, 'y': y}, random.PRNGKey(1), settings)
+    size = MCMCmodel.laplace_fit._cache_size()
+    # A new training set of the same size runs the compiled fit again
+    samples = model.train({'X': X, 'y': 1. - y}, random.PRNGKey(2), settings)
+    assert MCMCmodel.laplace_fit._cache_size() == size
+    assert samples['eta'].shape == (2000, 30)
+    # The closed-form Laplace predictive matches the moments of the draws
+    X_star = random.uniform(random.PRNGKey(3), (40, 2))
+    kwargs = {'samples': samples, 'batch': {'X': X, 'y': 1. - y}, 'bounds': bounds(),
+              'rng_keys': random.split(random.PRNGKey(4), 2000)}
+    mean, std = model.predict_laplace(X_star, point_chunk = 16, **kwargs)
+    assert mean.shape == (1, 40) and std.shape == (1, 40)
+    mc_mean, mc_std = model.predict(X_star, **kwargs)
+    onp.testing.assert_allclose(mean[0], mc_mean, atol = 0.1*float(np.max(std)))
+    onp.testing.assert_allclose(std[0], mc_std, rtol = 0.1)
+
+
+def test_compute_next_batch_fidelity(mesh):
+    from jaxbo.mcmc_models import ReimannianMFGPclassifierFourier
+    vals, vecs = mesh.eigenpairs(20)
+    model = ReimannianMFGPclassifierFourier(options(), (np.array(vals), np.array(vecs)))
+    samples = prior_samples({'kernel_var_L': (1,), 'kernel_length_L': (1,),
+                             'kernel_var_H': (1,), 'kernel_length_H': (1,),
+                             'rho': (1,), 'beta_L': (), 'beta_H': (),
+                             'ws_L': (20,), 'ws_H': (20,)}, random.PRNGKey(1))
+    kwargs = {'samples': samples, 'bounds': bounds(1)}
+    nodes = np.arange(mesh.verts.shape[0])
+    # Vertex indices are used as a flat array or as a column
+    for X_cand in [nodes, nodes[:,None]]:
+        X_new, fidelities = model.compute_next_batch_fidelity(X_cand, 3, (1., 10.), **kwargs)
+        assert X_new.shape == (3,) + X_cand.shape[1:]
+        assert len(fidelities) == 3 and set(fidelities) <= {'LF', 'HF'}
+    onp.testing.assert_array_equal(X_new.ravel(), model.compute_next_batch_fidelity(
+        nodes, 3, (1., 10.), **kwargs)[0])
+
+
+def test_predict_field_matches_conditional(mesh):
+    # With fewer eigenpairs than training nodes, the latent field is
+    # determined by its values at the training nodes, so the conditional
+    # mean of the original dense code reproduces the weight-space field
+    from jaxbo.mcmc_models import ReimannianGPclassifierFourier, ReimannianMFGPclassifierFourier
+    vals, vecs = mesh.eigenpairs(10)
+    nodes = np.arange(mesh.verts.shape[0])
+    X = random.permutation(random.PRNGKey(0), nodes)[:40]
+    with jax.enable_x64(True):
+        eigenpairs = (np.array(vals), np.array(vecs))
+        shapes = {'kernel_var': (1,), 'kernel_length': (1,), 'beta': (), 'ws': (10,)}
+        mf_shapes = {name + fidelity: shape for name, shape in shapes.items() for fidelity in ['_L', '_H']}
+        mf_shapes['rho'] = (1,)
+        for model, samples, batch in [
+                (ReimannianGPclassifierFourier(options(), eigenpairs),
+                 prior_samples(shapes, random.PRNGKey(1), 8),
+                 {'X': X, 'y': np.zeros(40)}),
+                (ReimannianMFGPclassifierFourier(options(), eigenpairs),
+                 prior_samples(mf_shapes, random.PRNGKey(1), 8),
+                 {'XL': X[:30], 'XH': X[10:], 'y': np.zeros(60)})]:
+            samples = double(samples)
+            kwargs = {'samples': samples, 'batch': batch, 'bounds': bounds(1)}
+            F = model.latent_field(samples)
+            mean, std = model.predict_conditional(nodes, **kwargs)
+            onp.testing.assert_allclose(mean, F, atol = 1e-5*float(np.max(np.abs(F))))
+            field_mean, field_std = model.predict_field(**kwargs)
+            onp.testing.assert_allclose(field_mean, np.mean(F, axis=0))
+            onp.testing.assert_allclose(field_std, np.std(F, axis=0))
+
+
+def vmap_predict(model, X_star, **kwargs):
+    """ The original MCMCmodel.predict, vmapped over all the samples at once. """
+    from jax import vmap
+    bounds = kwargs['bounds']
+    X_star = (X_star - bounds['lb'])/(bounds['ub'] - bounds['lb'])
+    sample_fn = lambda key, sample: model.posterior_sample(key, sample, X_star, **kwargs)
+    means, predictions = vmap(sample_fn)(kwargs['rng_keys'], kwargs['samples'])
+    return np.mean(means, axis=0), np.std(predictions, axis=0)
+
+
+def test_tiled_predict_matches_vmap(gp, mf_classifier):
+    # The classifier kernels only have a 1e-8 jitter, so the Cholesky solves
+    # need double precision to compare different orderings of operations
+    with jax.enable_x64(True):
+        X_star = random.uniform(random.PRNGKey(3), (50, 2), np.float64)
+        for model, kwargs in [gp, mf_classifier]:
+            kwargs = double(kwargs)
+            mean_ref, std_ref = vmap_predict(model, X_star, **kwargs)
+            # Every sample keeps its key, so whole-row tiles give the same draws
+            for sample_chunk in [None, 5, 32]:
+                mean, std = model.predict(X_star, sample_chunk = sample_chunk, **kwargs)
+                onp.testing.assert_allclose(mean, mean_ref, rtol = 1e-8, atol = 1e-8)
+                onp.testing.assert_allclose(std, std_ref, rtol = 1e-8, atol = 1e-8)
+            # Point tiles change the draws but not the means
+            for chunks in [(7, 16), (32, 50), (1, 1)]:
+                mean, std = model.predict(X_star, *chunks, **kwargs)
+                onp.testing.assert_allclose(mean, mean_ref, rtol = 1e-8, atol = 1e-8)
+                assert std.shape == (50,) and np.all(np.isfinite(std))
+            # A memory bound smaller than one row of tiles splits the points
+            # (the labels do not count as training points, the covariance does)
+            num_train = sum(x.shape[0] for name, x in kwargs['batch'].items() if name[0] == 'X')
+            sample_bytes = 4*8*num_train**2
+            pair_bytes = 4*8*(num_train + 1)
+            max_memory = sample_bytes + 30*pair_bytes
+            assert model.chunk_sizes(50, max_memory = max_memory, **kwargs) == (1, 30)
+            mean, _ = model.predict(X_star, max_memory = max_memory, **kwargs)
+            onp.testing.assert_allclose(mean, mean_ref, rtol = 1e-8, atol = 1e-8)
+            assert model.chunk_sizes(50, max_memory = 3*(sample_bytes + 50*pair_bytes),
+                                     **kwargs) == (3, 50)
+            # The sizes stay static through the jitted acquisition
+            acq = model.acquisition(X_star[0], max_memory = max_memory, **kwargs)
+            onp.testing.assert_allclose(acq, model.acquisition(X_star[0], **kwargs), rtol = 1e-8)
+
+
+def test_predict_summary_matches_conditional(mf_classifier):
+    from jaxbo.mcmc_models import GPclassifier
+    XL, y = mf_classifier[1]['batch']['XL'], mf_classifier[1]['batch']['y'][:20]
+    samples = prior_samples({'kernel_var': (1,), 'kernel_length': (2,), 'beta': (), 'eta': (20,)},
+                            random.PRNGKey(1))
+    model = GPclassifier(options())
+    # Double precision, as in test_tiled_predict_matches_vmap
+    with jax.enable_x64(True):
+        kwargs = double({'samples': samples, 'batch': {'X': XL, 'y': y}, 'bounds': bounds()})
+        X_star = random.uniform(random.PRNGKey(3), (50, 2), np.float64)
+        means, stds = model.predict_conditional(X_star, **kwargs)
+        p = 1./(1. + onp.exp(-means/onp.sqrt(1. + onp.pi*stds**2/8.)))
+        for chunks in [(None, None), (5, 16), (32, 1)]:
+            summary = model.predict_summary(X_star, *chunks, quantiles = [0.1, 0.5, 0.9],
+                                            num_bins = 400, **kwargs)
+            onp.testing.assert_allclose(summary['mean'], means.mean(0), rtol = 1e-8, atol = 1e-10)
+            onp.testing.assert_allclose(summary['std'], onp.sqrt((stds**2).mean(0)), rtol = 1e-8, atol = 1e-10)
+            onp.testing.assert_allclose(summary['mean_std'], means.std(0), rtol = 1e-8, atol = 1e-10)
+            onp.testing.assert_allclose(summary['prob'], p.mean(0), rtol = 1e-8, atol = 1e-10)
+            # Histogram quantiles are exact up to the bin width
+            assert summary['quantiles'].shape == (3, 50)
+            for q, row in zip([0.1, 0.5, 0.9], summary['quantiles']):
+                ref = onp.quantile(p, q, axis = 0, method = 'inverted_cdf')
+                assert onp.all(onp.abs(row - ref) <= 1./400 + 1e-6)
+
+
+def test_spectral_weights_reproduce_latent(mesh):
+    from jaxbo.mcmc_models import ReimannianGPclassifierFourier
+    vals, vecs = mesh.eigenpairs(30)
+    nodes = np.arange(mesh.verts.shape[0])
+    X = random.permutation(random.PRNGKey(0), nodes)[:12]
+    with jax.enable_x64(True):
+        model = ReimannianGPclassifierFourier(options(), (np.array(vals), np.array(vecs)),
+                                              collapsed = True)
+        batch = {'X': X, 'y': np.zeros(12)}
+        sample = double(prior_samples({'kernel_var': (1,), 'kernel_length': (1,),
+                                       'beta': (), 'eta': (12,)}, random.PRNGKey(1), 1))
+        # Many weight draws given the latent values of one sample
+        samples = tree_map(lambda x: np.repeat(x, 4000, axis = 0), sample)
+        weights = model.spectral_weights(samples, random.PRNGKey(2), batch)
+        F = model.latent_field(weights)
+        # Every draw interpolates the latent values at the training nodes, up to
+        # the 1e-8 jitter of the Cholesky factor
+        f = model.latent(tree_map(lambda x: x[0], sample), batch)
+        onp.testing.assert_allclose(F[:,X], np.broadcast_to(f, (4000, 12)), atol = 1e-4)
+        # and is centred on the dense GP conditional mean with prior mean beta
+        S = model.eval_S(sample['kernel_length'][0], sample['kernel_var'][0])
+        phi = model.eigenfunctions
+        K = model.features(phi[X], S) @ model.features(phi[X], S).T
+        k = model.features(phi, S) @ model.features(phi[X], S).T
+        beta = sample['beta'][0]
+        mean = beta + k @ np.linalg.solve(K + np.eye(12)*1e-8, f - beta)
+        err = np.abs(F.mean(0) - mean)
+        assert np.all(err <= 5.*F.std(0)/np.sqrt(4000.) + 1e-6)
+
+
+def index_conditional(model, sample, X_star, X):
+    """ The original ReimannianGPclassifier.posterior_sample (MAP), which
+        indexed the eigenfunctions inside every kernel evaluation. """
+    from jax.scipy.linalg import cholesky, solve_triangular
+    eval_K = lambda X, Xp, S: (model.eigenfunctions[X]*S[None,:]) @ model.eigenfunctions[Xp].T/model.norm_const
+    S = model.eval_S(sample['kernel_length'], sample['kernel_var'])
+    L = cholesky(eval_K(X, X, S) + np.eye(X.shape[0])*1e-8, lower=True)
+    k_pp = eval_K(X_star, X_star, S) + np.eye(X_star.shape[0])*1e-8
+    k_pX = eval_K(X_star, X, S)
+    f = np.matmul(L, sample['eta']) + sample['beta']
+    mu = np.matmul(k_pX, solve_triangular(L.T, solve_triangular(L, f, lower=True)))
+    cov = k_pp - np.matmul(k_pX, solve_triangular(L.T, solve_triangular(L, k_pX.T, lower=True)))
+    return mu, np.sqrt(np.clip(np.diag(cov), 0.))
+
+
+def test_gathered_kernels_match_indexing(mesh):
+    from jaxbo.mcmc_models import ReimannianGPclassifier
+    vals, vecs = mesh.eigenpairs(30)
+    nodes = np.arange(mesh.verts.shape[0])
+    X = random.permutation(random.PRNGKey(0), nodes)[:20]
+    with jax.enable_x64(True):
+        model = ReimannianGPclassifier(options(), (np.array(vals), np.array(vecs)))
+        samples = double(prior_samples({'kernel_var': (1,), 'kernel_length': (1,),
+                                        'beta': (), 'eta': (20,)}, random.PRNGKey(1), 4))
+        batch = model.prepare_batch({'X': X, 'y': np.zeros(20)})
+        assert model.prepare_batch(batch) is batch
+        onp.testing.assert_allclose(batch['phi'], model.eigenfunctions[X])
+        for i in range(4):
+            sample = tree_map(lambda x: x[i], samples)
+            mu_ref, std_ref = index_conditional(model, sample, nodes, X)
+            # Raw and prepared batches
+            for b in [{'X': X, 'y': np.zeros(20)}, batch]:
+                mu, std = model.conditional(sample, nodes, batch = b)
+                onp.testing.assert_allclose(mu, mu_ref, rtol = 1e-8, atol = 1e-10)
+                onp.testing.assert_allclose(std, std_ref, rtol = 1e-8, atol = 1e-10)
+        means, _ = model.predict_conditional(nodes, samples = samples, batch = batch, bounds = bounds(1))
+        onp.testing.assert_allclose(means[3], mu_ref, rtol = 1e-8, atol = 1e-10)
+
+
+def test_chain_methods_match_mcmc():
+    from numpyro.infer import MCMC, NUTS
+    from jaxbo.mcmc_models import GPclassifier
+    settings = {'num_warmup': 20, 'num_samples': 10, 'num_chains': 2, 'target_accept_prob': 0.8}
+    # Double precision, so that no initial point gives a singular kernel
+    with jax.enable_x64(True):
+        X = random.uniform(random.PRNGKey(0), (15, 2), np.float64)
+        batch = {'X': X, 'y': (X[:,0] > 0.5).astype(np.float64)}
+        model = GPclassifier(options())
+        refs = {}
+        for chain_method in ['sequential', 'vectorized']:
+            # The original train: one MCMC object running every chain
+            mcmc = MCMC(NUTS(model.model, target_accept_prob = 0.8), num_warmup = 20,
+                        num_samples = 10, num_chains = 2, chain_method = chain_method,
+                        progress_bar = False, jit_model_args = True)
+            mcmc.run(random.PRNGKey(1), batch)
+            refs[chain_method] = mcmc.get_samples()
+        # Without one device per chain, 'parallel' runs the chains in sequence
+        if jax.local_device_count() < 2:
+            refs['parallel'] = refs['sequential']
+        for chain_method, ref in refs.items():
+            if chain_method == 'parallel':
+                with pytest.warns(UserWarning, match = 'not enough devices'):
+                    samples = model.train(batch, random.PRNGKey(1), settings)
+            else:
+                samples = model.train(batch, random.PRNGKey(1), dict(settings, chain_method = chain_method))
+            assert model.wall_time > 0.
+            # Per-chain times only when the chains did not share a wall time
+            if chain_method == 'vectorized':
+                assert model.chain_times is None
+            else:
+                assert model.chain_times.shape == (2,)
+                assert model.chain_times.sum() <= model.wall_time
+            for name in ref:
+                assert samples[name].shape == ref[name].shape
+                onp.testing.assert_allclose(samples[name], ref[name], rtol = 1e-10)
+
+
+@pytest.mark.parametrize('guide', ['normal', 'lowrank'])
+def test_svi_samples_match_nuts_layout(guide):
+    from jaxbo.mcmc_models import GPclassifier
+    with jax.enable_x64(True):
+        X = random.uniform(random.PRNGKey(0), (15, 2), np.float64)
+        batch = {'X': X, 'y': (X[:,0] > 0.5).astype(np.float64)}
+        model = GPclassifier(options())
+        nuts = model.train(batch, random.PRNGKey(1),
+                           {'num_warmup': 10, 'num_samples': 8, 'num_chains': 1,
+                            'target_accept_prob': 0.8})
+        samples = model.train(batch, random.PRNGKey(1),
+                              {'method': 'svi', 'guide': guide, 'num_samples': 8,
+                               'num_steps': 200, 'rank': 2})
+        assert samples.keys() == nuts.keys()
+        for name in nuts:
+            assert samples[name].shape == nuts[name].shape
+        assert model.svi_losses.shape == (200,)
+        assert model.svi_losses[-20:].mean() < model.svi_losses[:20].mean()
+        # The draws plug into the existing predictive code
+        kwargs = {'samples': samples, 'batch': batch, 'bounds': bounds(),
+                  'rng_keys': random.split(random.PRNGKey(2), 8)}
+        mean, std = model.predict(random.uniform(random.PRNGKey(3), (5, 2), np.float64), **kwargs)
+        assert mean.shape == std.shape == (5,)
+        assert np.all(np.isfinite(mean)) and np.all(std >= 0)
+
+
+def test_warm_start_extends_last_state():
+    from jaxbo.mcmc_models import GPclassifier
+    settings = {'num_warmup': 10, 'num_samples': 5, 'num_chains': 2,
+                'target_accept_prob': 0.8, 'chain_method': 'sequential'}
+    with jax.enable_x64(True):
+        X = random.uniform(random.PRNGKey(0), (20, 2), np.float64)
+        y = (X[:,0] > 0.5).astype(np.float64)
+        model = GPclassifier(options())
+        model.train({'X': X[:15], 'y': y[:15]}, random.PRNGKey(1), settings)
+        old = model.warm_state
+        # Three chains reuse the two previous ones cyclically
+        warm = model.warm_start({'X': X, 'y': y}, random.PRNGKey(2), 3)
+        idx = onp.array([0, 1, 0])
+        for name, x in old['z'].items():
+            z = warm['z'][name]
+            if name == 'eta':
+                assert z.shape == (3, 20)
+                onp.testing.assert_array_equal(z[:,:15], x[idx])
+                assert np.all(np.isfinite(z[:,15:]))
+            else:
+                onp.testing.assert_array_equal(z, x[idx])
+        onp.testing.assert_array_equal(warm['step_size'], old['step_size'][idx])
+        for names, imm in old['inverse_mass_matrix'].items():
+            new = warm['inverse_mass_matrix'][names]
+            assert new.shape == (3, imm.shape[1] + 5*list(names).count('eta'))
+            # Old diagonal entries in place, unit entries for the new latents
+            old_start = new_start = 0
+            for name in names:
+                size = int(onp.prod(old['z'][name].shape[1:]))
+                onp.testing.assert_array_equal(new[:, new_start:new_start + size],
+                                               imm[idx, old_start:old_start + size])
+                old_start += size
+                new_start += size
+                if name == 'eta':
+                    onp.testing.assert_array_equal(new[:, new_start:new_start + 5], 1.)
+                    new_start += 5
+        # An incremental update with a short warmup runs from the extended state
+        samples = model.train({'X': X, 'y': y}, random.PRNGKey(3),
+                              dict(settings, num_warmup = 5, warm_start = True))
+        assert samples['eta'].shape == (10, 20)
+        assert all(np.all(np.isfinite(v)) for v in samples.values())
+
+
+def model_latent(model, batch, z):
+    """ The latent function the model computes from the unconstrained z. """
+    from numpyro import handlers, validation_enabled
+    from numpyro.infer.util import constrain_fn
+    with validation_enabled(False):
+        values = constrain_fn(model.model, (batch,), {}, z)
+        trace = handlers.trace(handlers.substitute(model.model, data = values)).get_trace(batch)
+    return trace['y']['fn'].logits
+
+
+def test_multifidelity_warm_start_keeps_latent(mf_classifier):
+    model = mf_classifier[0]
+    settings = {'num_warmup': 10, 'num_samples': 5, 'num_chains': 2,
+                'target_accept_prob': 0.8, 'chain_method': 'sequential'}
+    with jax.enable_x64(True):
+        XL = random.uniform(random.PRNGKey(0), (18, 2), np.float64)
+        XH = random.uniform(random.PRNGKey(1), (6, 2), np.float64)
+        yL, yH = (XL[:,0] > 0.5).astype(np.float64), (XH[:,0] > 0.4).astype(np.float64)
+        old_batch = {'XL': XL[:15], 'XH': XH, 'y': np.concatenate([yL[:15], yH])}
+        model.train(old_batch, random.PRNGKey(2), settings)
+        old = model.warm_state
+        # Low fidelity points are appended before the high fidelity block
+        batch = {'XL': XL, 'XH': XH, 'y': np.concatenate([yL, yH])}
+        warm = model.warm_start(batch, random.PRNGKey(3), 2)
+        assert warm['z']['eta_L'].shape == (2, 18) and warm['z']['eta_H'].shape == (2, 6)
+        for c in range(2):
+            f_old = model_latent(model, old_batch, tree_map(lambda x: x[c], old['z']))
+            f = model_latent(model, batch, tree_map(lambda x: x[c], warm['z']))
+            onp.testing.assert_allclose(f[:15], f_old[:15], rtol = 1e-8, atol = 1e-8)
+            onp.testing.assert_allclose(f[18:], f_old[15:], rtol = 1e-8, atol = 1e-8)
+            assert np.all(np.isfinite(f[15:18]))
+        for name in ['rho', 'kernel_var_H', 'beta_L']:
+            onp.testing.assert_array_equal(warm['z'][name], old['z'][name])
+        # Training points can only be appended
+        with pytest.raises(ValueError, match = 'eta_L'):
+            model.warm_start({'XL': XL[:12], 'XH': XH, 'y': np.concatenate([yL[:12], yH])},
+                             random.PRNGKey(3), 2)
+        samples = model.train(batch, random.PRNGKey(4), dict(settings, num_warmup = 5, warm_start = True))
+        assert samples['eta_L'].shape == (10, 18)
+        # Other training methods drop the NUTS state
+        model.train(batch, random.PRNGKey(5), {'method': 'svi', 'num_steps': 10, 'num_samples': 2})
+        assert model.warm_state is None
+        samples = model.train(batch, random.PRNGKey(6), dict(settings, warm_start = True))
+        assert samples['eta_L'].shape == (10, 18)
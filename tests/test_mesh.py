@@ -0,0 +1,245 @@
+import os
+import shutil
+
+import numpy as np
+import scipy.sparse as sp
+import pytest
+
+from conftest import DATA, grid_mesh
+from jaxbo.Mesh import Mesh, EigenpairsCache
+
+
+def test_writeVTU_round_trip(mesh, tmp_path):
+    vtk = pytest.importorskip('vtk')
+    from vtk.util.numpy_support import vtk_to_numpy
+    nNodes, nElem = mesh.verts.shape[0], mesh.connectivity.shape[0]
+    probs = np.linspace(0., 1., nNodes)
+    vectors = np.random.RandomState(0).randn(nElem, 3)
+    for compress in [False, True]:
+        filename = str(tmp_path / ('mesh_%i.vtu' % compress))
+        mesh.writeVTU(filename, point_data = {'probs': probs}, vectors = vectors, compress = compress)
+        reader = vtk.vtkXMLUnstructuredGridReader()
+        reader.SetFileName(filename)
+        reader.Update()
+        grid = reader.GetOutput()
+        assert grid.GetNumberOfPoints() == nNodes
+        assert grid.GetNumberOfCells() == nElem
+        np.testing.assert_allclose(vtk_to_numpy(grid.GetPoints().GetData()), mesh.verts)
+        cells = vtk_to_numpy(grid.GetCells().GetConnectivityArray())
+        np.testing.assert_array_equal(cells.reshape(-1, 3), mesh.connectivity)
+        assert all(grid.GetCellType(i) == vtk.VTK_TRIANGLE for i in range(nElem))
+        np.testing.assert_allclose(vtk_to_numpy(grid.GetPointData().GetArray('probs')), probs)
+        np.testing.assert_allclose(vtk_to_numpy(grid.GetCellData().GetArray('X')), vectors)
+
+
+def dense_laplacian(mesh):
+    """ The original computeLaplacian, assembled element by element into
+        dense matrices. """
+    nNodes = mesh.verts.shape[0]
+    K = np.zeros((nNodes,nNodes))
+    M = np.zeros((nNodes,nNodes))
+    for k,tri in enumerate(mesh.connectivity):
+        j, i = np.meshgrid(tri,tri)
+        B, J = mesh.Bmatrix(k)
+        K[i, j] += mesh.StiffnessMatrix(B,J)
+        M[i, j] += mesh.MassMatrix(J)
+    return K, M
+
+
+def test_computeLaplacian_matches_dense(mesh):
+    K_ref, M_ref = dense_laplacian(mesh)
+    K, M = mesh.computeLaplacian()
+    assert sp.issparse(K) and sp.issparse(M)
+    np.testing.assert_allclose(K.toarray(), K_ref, atol = 1e-12)
+    np.testing.assert_allclose(M.toarray(), M_ref, atol = 1e-12)
+    K, M = mesh.computeLaplacian(dense = True)
+    np.testing.assert_allclose(K, K_ref, atol = 1e-12)
+    np.testing.assert_allclose(M, M_ref, atol = 1e-12)
+
+
+def test_eigenpairs_match_dense_eigh(mesh):
+    from scipy.linalg import eigh
+    K, M = dense_laplacian(mesh)
+    vals_ref, vecs_ref = eigh(K, M, subset_by_index = [0, 7])
+    vals, vecs = mesh.eigenpairs(8)
+    assert vecs.shape == (8, mesh.verts.shape[0])
+    np.testing.assert_allclose(vals, vals_ref, rtol = 1e-8, atol = 1e-10)
+    # M-orthonormal, and equal to the reference up to sign (the spectrum is simple here)
+    np.testing.assert_allclose(vecs @ M @ vecs.T, np.eye(8), atol = 1e-8)
+    np.testing.assert_allclose(np.abs(np.sum(vecs*(M @ vecs_ref).T, axis = 1)), 1., atol = 1e-6)
+
+
+def test_eigenpairs_cache(mesh, tmp_path):
+    cache = EigenpairsCache(str(tmp_path))
+    vals, vecs = mesh.eigenpairs(6, cache = cache)
+    key = cache.key(mesh, 6, -1e-6, 0.)
+    assert [e[0] for e in cache.entries()] == [key]
+    # A hit returns the stored arrays memory-mapped, without solving again
+    mesh.computeLaplacian = None
+    cached_vals, cached_vecs = mesh.eigenpairs(6, cache = cache)
+    assert isinstance(cached_vecs, np.memmap)
+    np.testing.assert_array_equal(cached_vals, vals)
+    np.testing.assert_array_equal(cached_vecs, vecs)
+    # A scaled geometry or other solver parameters get their own entries
+    assert cache.key(mesh, 7, -1e-6, 0.) != key
+    assert cache.key(grid_mesh(bump = 0.5), 6, -1e-6, 0.) != key
+    # Least recently used entries are evicted beyond max_size
+    bounded = EigenpairsCache(str(tmp_path), max_size = cache.size() + 1)
+    grid_mesh(n = 8).eigenpairs(6, cache = bounded)
+    assert len(bounded.entries()) == 1 and bounded.entries()[0][0] != key
+
+
+def line_loadOBJ(filename):
+    """ The original loadOBJ, parsing the file line by line. """
+    verts = []
+    connectivity=[]
+    for line in open(filename, "r"):
+        vals = line.split()
+        if len(vals)>0:
+            if vals[0] == "v":
+                verts.append(list(map(float, vals[1:4])))
+            if vals[0] == "f":
+                connectivity.append([int(f.split("/")[0])-1 for f in vals[1:]])
+    return np.array(verts), np.array(connectivity)
+
+
+def test_loadOBJ_matches_line_parser(tmp_path):
+    filename = str(tmp_path / 'LA_geometry.obj')
+    shutil.copy(os.path.join(DATA, 'LA_geometry.obj'), filename)
+    verts_ref, connectivity_ref = line_loadOBJ(filename)
+    for sidecar in [False, True, True]:
+        mesh = Mesh(filename, sidecar = sidecar)
+        np.testing.assert_array_equal(mesh.verts, verts_ref)
+        np.testing.assert_array_equal(mesh.connectivity, connectivity_ref)
+    assert os.path.exists(filename + '.npz')
+    # Other face syntaxes give the same connectivity
+    lines = ['v %r %r %r' % tuple(map(float, v)) for v in verts_ref[:4]]
+    for face in ['%d', '%d/1', '%d/1/1']:
+        obj = tmp_path / 'quad.obj'
+        obj.write_text('\n'.join(lines + ['f ' + ' '.join(face % i for i in f) for f in [(1, 2, 3), (1, 3, 4)]]))
+        verts, connectivity = line_loadOBJ(str(obj))
+        np.testing.assert_array_equal(Mesh(str(obj)).connectivity, connectivity)
+    # Indented lines are not skipped
+    obj.write_text('\n'.join(['  ' + l for l in lines] + ['\tf 1 2 3', ' f 1 3 4']))
+    mesh = Mesh(str(obj))
+    np.testing.assert_array_equal(mesh.verts, verts_ref[:4])
+    np.testing.assert_array_equal(mesh.connectivity, [[0, 1, 2], [0, 2, 3]])
+
+
+def test_construction_matches_loops():
+    mesh = Mesh(os.path.join(DATA, 'LA_geometry.obj'))
+    # The original per-triangle loop
+    normals = np.zeros(mesh.connectivity.shape)
+    node_to_tri = {}
+    for i in range(len(mesh.connectivity)):
+        for j in range(3):
+            node_to_tri.setdefault(mesh.connectivity[i,j], []).append(i)
+        u=mesh.verts[mesh.connectivity[i,1],:]-mesh.verts[mesh.connectivity[i,0],:]
+        v=mesh.verts[mesh.connectivity[i,2],:]-mesh.verts[mesh.connectivity[i,0],:]
+        n=np.cross(u,v)
+        normals[i,:]=n/np.linalg.norm(n)
+    centroids = (mesh.verts[mesh.connectivity[:,0],:] + mesh.verts[mesh.connectivity[:,1],:] + mesh.verts[mesh.connectivity[:,2],:])/3.
+    np.testing.assert_allclose(mesh.normals, normals, atol = 1e-12)
+    np.testing.assert_allclose(mesh.centroids, centroids, atol = 1e-12)
+    for node in range(mesh.verts.shape[0]):
+        np.testing.assert_array_equal(mesh.node_to_tri[node], node_to_tri.get(node, []))
+    assert len(mesh.node_to_tri) == mesh.verts.shape[0]
+    assert sorted(mesh.node_to_tri) == list(range(mesh.verts.shape[0]))
+    with pytest.raises(KeyError):
+        mesh.node_to_tri[mesh.verts.shape[0]]
+
+
+def test_project_points_matches_project_new_point():
+    mesh = Mesh(os.path.join(DATA, 'LA_geometry.obj'))
+    rng = np.random.RandomState(0)
+    # Surface points pushed off along the normals, plus points far away
+    tri = rng.randint(mesh.connectivity.shape[0], size = 200)
+    points = mesh.centroids[tri] + rng.randn(200, 1)*mesh.normals[tri]
+    points = np.vstack((points, mesh.verts.mean(0) + 50.*rng.randn(20, 3)))
+    for verts_to_search in [1, 3]:
+        projected, intriangle, barycentric = mesh.project_points(points, verts_to_search)
+        for p, x, i, b in zip(points, projected, intriangle, barycentric):
+            x_ref, i_ref = mesh.project_new_point(p, verts_to_search)
+            assert i == i_ref
+            if i_ref != -1:
+                np.testing.assert_allclose(x, x_ref, atol = 1e-8)
+                np.testing.assert_allclose(b @ mesh.verts[mesh.connectivity[i]], x, atol = 1e-8)
+    # The vertex normals are computed once, as in project_point_check
+    assert mesh.vertex_normals is mesh.vertex_normals
+    for node in [0, 17, 300]:
+        n = np.sum(mesh.normals[mesh.node_to_tri[node]], axis = 0)
+        np.testing.assert_allclose(mesh.vertex_normals[node], n/np.linalg.norm(n), atol = 1e-12)
+
+
+def dense_geodesic(mesh, nodes, nodeVals, dt = 10.0):
+    """ The original computeGeodesic, with dense matrices and per-element
+        gradients. """
+    nNodes = mesh.verts.shape[0]
+    K, M = dense_laplacian(mesh)
+    F = np.zeros((nNodes,1))
+    u0 = np.zeros((nNodes,1))
+    u0[nodes] = 1e6
+    activeNodes = [n for n in range(nNodes) if n not in list(nodes)]
+    jActive, iActive = np.meshgrid(activeNodes, activeNodes)
+    jKnown, iKnown = np.meshgrid(nodes, activeNodes)
+    u = np.linalg.solve(M + dt*K, u0)
+    Xs = np.zeros((mesh.connectivity.shape[0],3))
+    for k,tri in enumerate(mesh.connectivity):
+        B, J = mesh.Bmatrix(k)
+        X = mesh.gradient(k,u[tri,0])
+        Xs[k,:] = X/np.linalg.norm(X)
+        Xnr = np.dot(B,u[tri,0])
+        Xnr /= np.linalg.norm(Xnr)
+        F[tri,0] -= mesh.ForceVector(B,J,Xnr)
+    AT = np.linalg.solve(K[iActive, jActive],F[activeNodes,0]-np.dot(K[iKnown, jKnown],nodeVals))
+    ATglobal = np.zeros(nNodes)
+    ATglobal[activeNodes] = AT
+    ATglobal[nodes] = nodeVals
+    return ATglobal, Xs
+
+
+def test_geodesic_matches_dense(mesh):
+    nodes, nodeVals = np.array([0, 77]), np.array([0., 0.5])
+    AT_ref, Xs_ref = dense_geodesic(mesh, nodes, nodeVals)
+    AT, Xs = mesh.computeGeodesic(nodes, nodeVals)
+    np.testing.assert_allclose(AT, AT_ref, rtol = 1e-10, atol = 1e-10)
+    np.testing.assert_allclose(Xs, Xs_ref, atol = 1e-8)
+    # Explicit matrices and the cached solver agree
+    K, M = mesh.computeLaplacian()
+    np.testing.assert_allclose(mesh.computeGeodesic(nodes, nodeVals, K = K, M = M)[0], AT_ref,
+                               rtol = 1e-10, atol = 1e-10)
+    # Every source at once, one column per source
+    sources = np.array([0, 5, 77, 143])
+    D = mesh.geodesicSolver().distances(sources)
+    for s, d in zip(sources, D):
+        np.testing.assert_allclose(d, dense_geodesic(mesh, [s], [0.])[0], rtol = 1e-10, atol = 1e-10)
+
+
+def test_computeLaplace_matches_dense(mesh):
+    nNodes = mesh.verts.shape[0]
+    K, _ = dense_laplacian(mesh)
+    # Different Dirichlet nodes reuse the same factorization
+    for nodes, nodeVals in [([0, 143], [0., 1.]), ([3, 50, 100], [1., -1., 2.])]:
+        activeNodes = [n for n in range(nNodes) if n not in nodes]
+        jActive, iActive = np.meshgrid(activeNodes, activeNodes)
+        jKnown, iKnown = np.meshgrid(nodes, activeNodes)
+        T_ref = np.zeros(nNodes)
+        T_ref[activeNodes] = np.linalg.solve(K[iActive, jActive], -np.dot(K[iKnown, jKnown], nodeVals))
+        T_ref[nodes] = nodeVals
+        np.testing.assert_allclose(mesh.computeLaplace(np.array(nodes), np.array(nodeVals)), T_ref,
+                                   rtol = 1e-10, atol = 1e-12)
+
+
+def test_gradients_match_per_element(mesh):
+    rng = np.random.RandomState(0)
+    u = rng.randn(mesh.verts.shape[0], 3)
+    nElem = mesh.connectivity.shape[0]
+    ref = np.stack([np.stack([mesh.gradient(k, u[tri,f]) for k, tri in enumerate(mesh.connectivity)])
+                    for f in range(3)], axis = 2)
+    np.testing.assert_allclose(mesh.gradients(u), ref, atol = 1e-12)
+    np.testing.assert_allclose(mesh.gradients(u[:,0]), ref[:,:,0], atol = 1e-12)
+    B, J = mesh.Bmatrices()
+    for k in [0, nElem//2, nElem - 1]:
+        B_ref, J_ref = mesh.Bmatrix(k)
+        np.testing.assert_allclose(B[k], B_ref, atol = 1e-12)
+        np.testing.assert_allclose(J[k], J_ref, atol = 1e-12)
@@ -0,0 +1,175 @@
+import numpy as onp
+import jax.numpy as np
+from jax import random, vmap
+import pytest
+
+from jaxbo.models import GP, MultifidelityGP, GradientGP, ReimannianGP
+from jaxbo.input_priors import uniform_prior
+
+
+def options(criterion = 'LCB'):
+    lb, ub = np.zeros(2), np.ones(2)
+    return {'kernel': 'RBF', 'criterion': criterion, 'input_prior': uniform_prior(lb, ub),
+            'kappa': 2.0, 'nIter': 1}
+
+
+def regression_data(N = 30, seed = 0):
+    X = random.uniform(random.PRNGKey(seed), (N, 2))
+    y = np.sin(6*X[:,0])*np.cos(4*X[:,1])
+    norm_const = {'mu_y': y.mean(), 'sigma_y': y.std()}
+    return X, (y - y.mean())/y.std(), norm_const
+
+
+@pytest.fixture
+def gp():
+    X, y, norm_const = regression_data()
+    model = GP(options())
+    params = np.array([0.1, -1.5, -1.2, -6.])
+    kwargs = {'params': params, 'batch': {'X': X, 'y': y}, 'norm_const': norm_const,
+              'bounds': {'lb': np.zeros(2), 'ub': np.ones(2)}}
+    return model, kwargs
+
+
+@pytest.fixture
+def mf_gp():
+    X, y, norm_const = regression_data(40)
+    model = MultifidelityGP(options())
+    params = np.array([0.1, -1.5, -1.2, -0.5, -1., -1., 0.8, -6., -6.])
+    batch = {'XL': X, 'XH': X[:10], 'y': np.concatenate([y, 0.8*y[:10]])}
+    kwargs = {'params': params, 'batch': batch, 'norm_const': norm_const,
+              'bounds': {'lb': np.zeros(2), 'ub': np.ones(2)}}
+    return model, kwargs
+
+
+def dense_gp_predict(model, X_star, params, batch, bounds, norm_const):
+    """ The original GP.predict, which built the full predictive covariance. """
+    from jax.scipy.linalg import solve_triangular
+    X_star = (X_star - bounds['lb'])/(bounds['ub'] - bounds['lb'])
+    X, y = batch['X'], batch['y']
+    sigma_n = np.exp(params[-1])
+    theta = np.exp(params[:-1])
+    k_pp = model.kernel(X_star, X_star, theta) + np.eye(X_star.shape[0])*(sigma_n + 1e-8)
+    k_pX = model.kernel(X_star, X, theta)
+    L = model.compute_cholesky(params, batch)
+    alpha = solve_triangular(L.T,solve_triangular(L, y, lower=True))
+    beta  = solve_triangular(L.T,solve_triangular(L, k_pX.T, lower=True))
+    mu = np.matmul(k_pX, alpha)
+    cov = k_pp - np.matmul(k_pX, beta)
+    std = np.sqrt(np.clip(np.diag(cov), 0.))
+    mu = mu*norm_const['sigma_y'] + norm_const['mu_y']
+    std = std*norm_const['sigma_y']**2
+    return mu, std
+
+
+def test_predict_matches_dense_covariance(gp, mf_gp):
+    X_star = random.uniform(random.PRNGKey(1), (50, 2))
+    model, kwargs = gp
+    mean, std = model.predict(X_star, **kwargs)
+    mean_ref, std_ref = dense_gp_predict(model, X_star, **kwargs)
+    onp.testing.assert_allclose(mean, mean_ref, rtol = 1e-5, atol = 1e-5)
+    onp.testing.assert_allclose(std, std_ref, rtol = 1e-4, atol = 1e-5)
+    # predict_cov denormalizes the covariance, predict keeps the std*sigma_y**2 scaling
+    for model, kwargs in [gp, mf_gp]:
+        mean, std = model.predict(X_star, **kwargs)
+        mean_full, cov = model.predict_cov(X_star, **kwargs)
+        onp.testing.assert_allclose(mean, mean_full, rtol = 1e-5, atol = 1e-5)
+        onp.testing.assert_allclose(std, np.sqrt(np.clip(np.diag(cov), 0.))*kwargs['norm_const']['sigma_y'],
+                                    rtol = 1e-4, atol = 1e-5)
+
+
+def test_correlation_matches_joint_covariance(gp):
+    model, kwargs = gp
+    X_cand = random.uniform(random.PRNGKey(2), (40, 2))
+    x = X_cand[3:4]
+    corr = model.correlation(X_cand, x, **kwargs)
+    # Reference: the joint predictive covariance of x and all the candidates
+    cov = model.predict_cov(np.concatenate([x, X_cand]), **kwargs)[1]
+    ref = cov[0,1:]/np.sqrt(cov[0,0]*np.diag(cov)[1:])
+    onp.testing.assert_allclose(corr, ref, rtol = 1e-3, atol = 1e-4)
+    # below one at x itself, since the predictive variances include the noise
+    assert int(np.argmax(corr)) == 3
+
+
+def test_compute_next_batch_gs(gp, mf_gp):
+    X_cand = random.uniform(random.PRNGKey(3), (300, 2))
+    for model, kwargs in [gp, mf_gp]:
+        X_new = model.compute_next_batch_gs(X_cand, 4, **kwargs)
+        assert X_new.shape == (4, 2)
+        assert len({tuple(onp.asarray(x)) for x in X_new}) == 4
+        onp.testing.assert_allclose(X_new[:1], model.compute_next_point_gs(X_cand, **kwargs))
+
+
+@pytest.mark.parametrize('criterion', ['LCB', 'EI', 'US', 'CLSF', 'LW-LCB', 'LW-US', 'LW_CLSF'])
+def test_acquisition_batch_matches_vmap(gp, criterion):
+    model, kwargs = gp
+    model.options['criterion'] = criterion
+    kwargs = dict(kwargs, gmm_vars = (np.array([0.3, 0.7]), np.array([[0.2, 0.3], [0.7, 0.6]]),
+                                      np.array([0.05*np.eye(2), 0.1*np.eye(2)])))
+    X_cand = random.uniform(random.PRNGKey(4), (64, 2))
+    acq = model.acquisition_batch(X_cand, **kwargs)
+    ref = vmap(lambda x: model.acquisition(x, **kwargs))(X_cand)
+    assert acq.shape == (64,)
+    onp.testing.assert_allclose(acq, ref, rtol = 1e-4, atol = 1e-5)
+
+
+def test_posterior_state_matches_params(gp, mf_gp):
+    X_star = random.uniform(random.PRNGKey(5), (50, 2))
+    for model, kwargs in [gp, mf_gp]:
+        state = model.posterior_state(kwargs['params'], kwargs['batch'], kwargs['norm_const'])
+        # The cached state stands in for params, batch and norm_const
+        state_kwargs = {'state': state, 'bounds': kwargs['bounds']}
+        for fun in [model.predict, model.predict_cov]:
+            for out, ref in zip(fun(X_star, **state_kwargs), fun(X_star, **kwargs)):
+                onp.testing.assert_allclose(out, ref, rtol = 1e-6, atol = 1e-7)
+        onp.testing.assert_allclose(model.acquisition(X_star[0], **state_kwargs),
+                                    model.acquisition(X_star[0], **kwargs), rtol = 1e-6)
+    model, kwargs = gp
+    state = model.posterior_state(kwargs['params'], kwargs['batch'], kwargs['norm_const'])
+    mean, std = model.predict(X_star, state = state, bounds = kwargs['bounds'])
+    mean_ref, std_ref = dense_gp_predict(model, X_star, **kwargs)
+    onp.testing.assert_allclose(mean, mean_ref, rtol = 1e-5, atol = 1e-5)
+    onp.testing.assert_allclose(std, std_ref, rtol = 1e-4, atol = 1e-5)
+
+
+def test_expected_improvement_from_state(gp):
+    model, kwargs = gp
+    model.options['criterion'] = 'EI'
+    # The state is built once and replaces params, batch and norm_const
+    state = model.posterior_state(kwargs['params'], kwargs['batch'], kwargs['norm_const'])
+    assert float(state['y_best']) == float(np.min(kwargs['batch']['y']))
+    state_kwargs = {'state': state, 'bounds': kwargs['bounds']}
+    X_cand = random.uniform(random.PRNGKey(7), (64, 2))
+    acq = model.acquisition_batch(X_cand, **state_kwargs)
+    onp.testing.assert_allclose(acq, model.acquisition_batch(X_cand, **kwargs), rtol = 1e-6, atol = 1e-7)
+    onp.testing.assert_allclose(model.acquisition(X_cand[0], **state_kwargs), acq[0], rtol = 1e-5, atol = 1e-6)
+    onp.testing.assert_array_equal(model.compute_next_point_gs(X_cand, **state_kwargs),
+                                   model.compute_next_point_gs(X_cand, **kwargs))
+    onp.testing.assert_array_equal(model.compute_next_batch_gs(X_cand, 3, **state_kwargs),
+                                   model.compute_next_batch_gs(X_cand, 3, **kwargs))
+
+
+def test_train_returns_posterior_state(gp):
+    model, kwargs = gp
+    batch, norm_const = kwargs['batch'], kwargs['norm_const']
+    params = model.train(batch, random.PRNGKey(6), num_restarts = 2)
+    params_state, state = model.train(batch, random.PRNGKey(6), num_restarts = 2,
+                                      norm_const = norm_const)
+    onp.testing.assert_array_equal(params_state, params)
+    ref = model.posterior_state(params, batch, norm_const)
+    for name in ['params', 'L', 'alpha', 'X']:
+        onp.testing.assert_allclose(state[name], ref[name])
+
+
+def test_reimannian_state_matches_params(mesh):
+    vals, vecs = mesh.eigenpairs(20)
+    model = ReimannianGP(options('US'), (np.array(vals), np.array(vecs)))
+    X = np.arange(0, mesh.verts.shape[0], 7)
+    y = np.asarray(mesh.verts[X,0])
+    kwargs = {'params': np.array([0., -0.5, -4.]), 'batch': {'X': X, 'y': (y - y.mean())/y.std()},
+              'norm_const': {'mu_y': y.mean(), 'sigma_y': y.std()}}
+    state = model.posterior_state(kwargs['params'], kwargs['batch'], kwargs['norm_const'])
+    nodes = np.arange(mesh.verts.shape[0])
+    for out, ref in zip(model.predict(nodes, state = state), model.predict(nodes, **kwargs)):
+        onp.testing.assert_allclose(out, ref, rtol = 1e-6, atol = 1e-7)
+    onp.testing.assert_allclose(model.acquisition_batch(nodes, state = state),
+                                model.acquisition_batch(nodes, **kwargs), rtol = 1e-6, atol = 1e-7)